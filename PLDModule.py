@@ -1,14 +1,94 @@
+import collections
+import heapq
 import random
+import selectors
+import socket
+import sys
 import utility
 import threading
+import time
 
+# NumPy is optional, with it the decisions for a whole batch of segments are drawn and made in one go.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-def set_random_seed(seed):
-    random.seed(seed)
+# Every segment uses the same number of random draws, whatever happens to it, so a segment's fate only depends on the
+# seed and how many segments came before it: drop, duplicate, corrupt, reorder, delay and how long to delay it for.
+DRAWS_PER_SEGMENT = 6
+DECISION_BATCH_SIZE = 1024
+
+# What the PLD does to a segment. A segment that is not dropped, duplicated or corrupted may also be a candidate for
+# reordering and for delaying, which are separate bits as reordering falls back to delaying when no slot is free.
+SEND = 0
+DROP = 1
+DUPLICATE = 2
+CORRUPT = 3
+REORDER = 4
+DELAY = 8
+
+
+class DelayLine:
+    # The segments the PLD is holding back, kept in a heap by the time they are due to go out. A single thread sleeps
+    # until the earliest one is due and sends it, so the number of threads does not grow with the number of delayed
+    # segments. Each entry is the datagram itself plus what the log needs to know about it, the packet it came from is
+    # reused by the sender straight away.
+    def __init__(self, sock, file_writer):
+        self._socket = sock
+        self._file_writer = file_writer
+        self._heap = []
+        # Breaks ties between segments due at the same time, so they go out in the order they were delayed.
+        self._scheduled = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, delay, datagram, address, fields):
+        with self._condition:
+            if self._closed:
+                return
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._scheduled, datagram, address, fields))
+            self._scheduled += 1
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        # Once we are closing, whatever is left has been asked to go out straight away.
+                        if wait <= 0 or self._closed:
+                            break
+                        self._condition.wait(wait)
+                    elif self._closed:
+                        return
+                    else:
+                        self._condition.wait()
+                release_time, scheduled, datagram, address, fields = heapq.heappop(self._heap)
+
+            # Send outside the lock so the sender never waits on us to schedule the next one.
+            try:
+                self._socket.sendto(datagram, address)
+                utility.write_log_fields("snd/delay", fields, self._file_writer)
+            except OSError:
+                # The socket has gone away underneath us, nothing left to deliver to.
+                pass
+
+    def close(self, drain=False):
+        # Stop the thread. The segments still waiting are either sent now or thrown away.
+        with self._condition:
+            self._closed = True
+            if not drain:
+                self._heap = []
+            self._condition.notify()
+        self._thread.join()
 
 
 class PLDModule:
-    def __init__(self):
+    def __init__(self, seed=None):
         self.probability_drop = 0
         self.probability_duplicate = 0
         self.probability_corrupt = 0
@@ -16,109 +96,415 @@ class PLDModule:
         self.probability_delay = 0
         self.reorder_max_delay = 0
         self.delay_max_delay = 0
+        # How many segments can be held back for reordering at once.
+        self.reorder_slots = 1
 
         self.linked_socket = None
         self.file_writer = None
+        # The counters for the sender's summary, each connection gives the PLD its own.
+        self.summary = utility.sender_log_file_summary
 
-        self.reorder_segment_wait = 0
-        self.reorder_segment = None
+        # Segments held back to be reordered, oldest first, as [segments sent since, datagram, fields for the log].
+        self.reorder_segments = []
 
-    def send_delayed_data(self, stp_packet, receiver_ip, receiver_port):
-        try:
-            self.linked_socket.sendto(stp_packet.raw, (receiver_ip, receiver_port))
-            utility.write_log("snd/delay", stp_packet, self.file_writer)
-        except OSError:
-            # The socket is closed and we are trying to call it. Just ignore it  # ¯\_(ツ)_/¯
-            pass
+        # Started the first time we delay a segment.
+        self.delay_line = None
+
+        # Our own generator, so nothing else drawing random numbers can change what happens to our segments. The
+        # decisions are made a batch at a time and handed out one per segment.
+        self._random = None
+        self._numpy_random = None
+        self._actions = []
+        self._delays = []
+        self._next_decision = 0
+        self.seed(seed)
+
+    def seed(self, seed):
+        self._random = random.Random(seed)
+        if numpy is not None:
+            # Both are the same Mersenne Twister drawing doubles the same way, so starting NumPy's from the state
+            # random.Random seeded itself into gives the same stream, whatever the seed was.
+            state = self._random.getstate()[1]
+            self._numpy_random = numpy.random.RandomState()
+            self._numpy_random.set_state(('MT19937', numpy.array(state[:624], dtype=numpy.uint32), state[624]))
+        else:
+            self._numpy_random = None
+        self._actions = []
+        self._delays = []
+        self._next_decision = 0
+
+    def _draw_decisions(self):
+        if self._numpy_random is not None:
+            draws = self._numpy_random.random_sample((DECISION_BATCH_SIZE, DRAWS_PER_SEGMENT))
+            actions = numpy.where(draws[:, 0] < self.probability_drop, DROP,
+                                  numpy.where(draws[:, 1] < self.probability_duplicate, DUPLICATE,
+                                              numpy.where(draws[:, 2] < self.probability_corrupt, CORRUPT, SEND)))
+            actions |= numpy.where(draws[:, 3] < self.probability_reorder, REORDER, 0)
+            actions |= numpy.where(draws[:, 4] < self.probability_delay, DELAY, 0)
+            self._actions = actions.tolist()
+            self._delays = (draws[:, 5] * self.delay_max_delay).tolist()
+        else:
+            draw = self._random.random
+            self._actions = []
+            self._delays = []
+            for _ in range(DECISION_BATCH_SIZE):
+                drop, duplicate, corrupt, reorder, delay, delay_time = \
+                    draw(), draw(), draw(), draw(), draw(), draw()
+                if drop < self.probability_drop:
+                    action = DROP
+                elif duplicate < self.probability_duplicate:
+                    action = DUPLICATE
+                elif corrupt < self.probability_corrupt:
+                    action = CORRUPT
+                else:
+                    action = SEND
+                if reorder < self.probability_reorder:
+                    action |= REORDER
+                if delay < self.probability_delay:
+                    action |= DELAY
+                self._actions.append(action)
+                self._delays.append(delay_time * self.delay_max_delay)
+        self._next_decision = 0
+
+    def next_decision(self):
+        # Returns (action, delay time) for the next segment.
+        if self._next_decision == len(self._actions):
+            self._draw_decisions()
+        index = self._next_decision
+        self._next_decision += 1
+        return self._actions[index], self._delays[index]
+
+    def close(self, drain=False):
+        # Call before closing the socket. Delayed segments which are still waiting are thrown away unless drain is set.
+        if self.delay_line is not None:
+            self.delay_line.close(drain)
+            self.delay_line = None
 
     def send_data(self, stp_packet, receiver_ip, receiver_port, retranmission=False):
-        if self.linked_socket is not None:
-            data = stp_packet.raw
-            rand_num = random.random()
-            event_log = ""
-
-            if rand_num < self.probability_drop:
-                utility.write_log("drop", stp_packet, self.file_writer)
-                utility.sender_log_file_summary["seg_dropped"] += 1
-                utility.sender_log_file_summary["seg_pld_messed"] += 1
+        if self.linked_socket is None:
+            print("You need to link the PLD Module with a socket before we can do anything.")
+            return
+
+        address = (receiver_ip, receiver_port)
+        action, delay_time = self.next_decision()
+        outcome = action & 3
+
+        if outcome == DROP:
+            utility.write_log("drop", stp_packet, self.file_writer)
+            self.summary["seg_dropped"] += 1
+            self.summary["seg_pld_messed"] += 1
+            return
+
+        # We only piece the packet together ourselves if we have to corrupt it.
+        data = None
+        if outcome == DUPLICATE:
+            stp_packet.send(self.linked_socket, address)
+            self.summary["seg_transmitted"] += 1
+            self.summary["seg_pld_messed"] += 1
+            utility.write_log("snd/RXT" if retranmission else "snd", stp_packet, self.file_writer)
+            self.summary["seg_dupped"] += 1
+            event_log = "snd/RXT/dup" if retranmission else "snd/dup"
+        elif outcome == CORRUPT:
+            data_byte_array = bytearray(stp_packet.raw)
+            data_byte_array[6] = data_byte_array[6] ^ 101  # ¯\_(ツ)_/¯
+            data = bytes(data_byte_array)
+            self.summary["seg_corrupted"] += 1
+            event_log = "snd/RXT/corr" if retranmission else "snd/corr"
+        else:
+            # Only a segment that has not been duplicated or corrupted can be reordered or delayed.
+            if action & REORDER and len(self.reorder_segments) < self.reorder_slots:
+                self.reorder_segments.append([0, bytes(stp_packet.raw), utility.log_fields(stp_packet)])
                 return
-            else:
-                rand_num = random.random()
 
-            if rand_num < self.probability_duplicate:
-                self.linked_socket.sendto(data, (receiver_ip, receiver_port))
-                utility.sender_log_file_summary["seg_transmitted"] += 1
-                utility.sender_log_file_summary["seg_pld_messed"] += 1
+            if action & DELAY:
+                # The packet is about to be reused, so the delay line gets a copy of the datagram.
+                if self.delay_line is None:
+                    self.delay_line = DelayLine(self.linked_socket, self.file_writer)
+                self.delay_line.schedule(delay_time, bytes(stp_packet.raw), address, utility.log_fields(stp_packet))
+                self.summary["seg_delayed"] += 1
+                self.summary["seg_pld_messed"] += 1
+                return
+            event_log = "snd/RXT" if retranmission else "snd"
 
-                if retranmission:
-                    utility.write_log("snd/RXT", stp_packet, self.file_writer)
-                    event_log = "snd/RXT/dup"
-                else:
-                    utility.write_log("snd", stp_packet, self.file_writer)
-                    event_log = "snd/dup"
+        if data is None:
+            stp_packet.send(self.linked_socket, address)
+        else:
+            self.linked_socket.sendto(data, address)
+        utility.write_log(event_log, stp_packet, self.file_writer)
 
-                utility.sender_log_file_summary["seg_dupped"] += 1
-                rand_num = 1
-            else:
-                rand_num = random.random()
-
-            if rand_num < self.probability_corrupt:
-                data_byte_array = bytearray(data)
-                data_byte_array[6] = data_byte_array[6] ^ 101  # ¯\_(ツ)_/¯
-                data = bytes(data_byte_array)
-                if retranmission:
-                    event_log = "snd/RXT/corr"
-                else:
-                    event_log = "snd/corr"
-                utility.sender_log_file_summary["seg_corrupted"] += 1
-                rand_num = 1
-            else:
-                rand_num = random.random()
+        # Every held segment goes out once maxOrder segments have been sent after it.
+        if self.reorder_segments:
+            for held in self.reorder_segments:
+                held[0] += 1
+            while self.reorder_segments and self.reorder_segments[0][0] >= self.reorder_max_delay:
+                count, datagram, fields = self.reorder_segments.pop(0)
+                self.linked_socket.sendto(datagram, address)
+                utility.write_log_fields("snd/delay", fields, self.file_writer)
+                self.summary["seg_reorder"] += 1
+                self.summary["seg_pld_messed"] += 1
+
+        self.summary["seg_pld_messed"] += 1
+
+
+# ================================================================================
+# STANDALONE PROXY
+# The PLD can also run on its own, as a UDP proxy sitting between the sender and the receiver:
+#
+#   python PLDModule.py listen_port receiver_ip receiver_port [--seed=50] [--drop=0.1] [--duplicate=0] [--corrupt=0]
+#       [--reorder=0] [--max-order=0] [--delay=0] [--max-delay=0] [--rate=0] [--burst=16384] [--queue=0] [--latency=0]
+#       [--report=0] [--idle-exit=0]
+#
+# The sender is pointed at listen_port with its own PLD probabilities at 0. Every option applies to both directions
+# unless given as --forward-<option>= (sender to receiver) or --reverse-<option>= (receiver to sender). On top of the
+# usual PLD impairments each direction models a bottleneck link: a token bucket of --burst= bytes refilled at --rate=
+# bytes per second (0 for no limit), a queue of up to --queue= bytes in front of it which drops whatever arrives when
+# it is full (0 for no limit), and --latency= milliseconds of propagation delay. --max-delay= is in milliseconds too.
+# Counters for each direction are printed every --report= seconds and on exit, and --idle-exit= stops the proxy once
+# nothing has passed through it for that many seconds.
+# ================================================================================
+LINK_OPTIONS = {
+    "drop": 0.0,
+    "duplicate": 0.0,
+    "corrupt": 0.0,
+    "reorder": 0.0,
+    "max-order": 0.0,
+    "delay": 0.0,
+    "max-delay": 0.0,
+    "rate": 0.0,
+    "burst": 16384.0,
+    "queue": 0.0,
+    "latency": 0.0,
+}
+LINK_COUNTERS = ["received", "delivered", "bytes_delivered", "dropped", "queue_dropped", "duplicated", "corrupted",
+                 "reordered", "delayed"]
+
+
+class LinkDirection:
+    # One direction through the proxy. Datagrams go through the PLD first, then queue for the bottleneck, and are
+    # delivered once they have been through it and the propagation delay is up.
+    def __init__(self, name, settings, seed):
+        self.name = name
+        self.pld = PLDModule(seed)
+        self.pld.probability_drop = settings["drop"]
+        self.pld.probability_duplicate = settings["duplicate"]
+        self.pld.probability_corrupt = settings["corrupt"]
+        self.pld.probability_reorder = settings["reorder"]
+        self.pld.reorder_max_delay = settings["max-order"]
+        self.pld.probability_delay = settings["delay"]
+        self.pld.delay_max_delay = settings["max-delay"] / 1000
+
+        self.rate = settings["rate"]
+        self.burst = settings["burst"]
+        self.queue_limit = settings["queue"]
+        self.latency = settings["latency"] / 1000
+
+        self.tokens = self.burst
+        self.last_refill = time.monotonic()
+        # Waiting for the bottleneck as (datagram, extra delay, socket, address).
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        # Held back to be reordered as [datagrams queued since, datagram, socket, address].
+        self.reorder_segments = []
+        self.counters = {name: 0 for name in LINK_COUNTERS}
 
-            if rand_num < self.probability_reorder and self.reorder_segment is None:
-                self.reorder_segment = utility.STPPacket()
-                utility.copy_stp_packet(stp_packet, self.reorder_segment)
+    def arrive(self, datagram, sock, address):
+        self.counters["received"] += 1
+        action, delay_time = self.pld.next_decision()
+        outcome = action & 3
+        if outcome == DROP:
+            self.counters["dropped"] += 1
+            return
+        if outcome == DUPLICATE:
+            self.counters["duplicated"] += 1
+            self.enqueue(datagram, 0, sock, address)
+        elif outcome == CORRUPT:
+            self.counters["corrupted"] += 1
+            datagram = bytearray(datagram)
+            datagram[6] ^= 101
+            datagram = bytes(datagram)
+        else:
+            if action & REORDER and len(self.reorder_segments) < self.pld.reorder_slots:
+                self.counters["reordered"] += 1
+                self.reorder_segments.append([0, datagram, sock, address])
                 return
-            else:
-                rand_num = random.random()
+            if action & DELAY:
+                self.counters["delayed"] += 1
+                self.enqueue(datagram, delay_time, sock, address)
+                return
+        self.enqueue(datagram, 0, sock, address)
+
+        # Held segments are let go once maxOrder datagrams have gone ahead of them.
+        if self.reorder_segments:
+            for held in self.reorder_segments:
+                held[0] += 1
+            while self.reorder_segments and self.reorder_segments[0][0] >= self.pld.reorder_max_delay:
+                count, held_datagram, held_sock, held_address = self.reorder_segments.pop(0)
+                self.enqueue(held_datagram, 0, held_sock, held_address)
+
+    def enqueue(self, datagram, extra_delay, sock, address):
+        if self.queue_limit and self.queued_bytes + len(datagram) > self.queue_limit:
+            self.counters["queue_dropped"] += 1
+            return
+        self.queue.append((datagram, extra_delay, sock, address))
+        self.queued_bytes += len(datagram)
+
+    def transmit(self, now, deliveries):
+        # Move whatever the token bucket allows from the queue onto the wire. Returns when the next datagram in the
+        # queue can go, or None if the queue is empty.
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        while self.queue:
+            datagram, extra_delay, sock, address = self.queue[0]
+            if self.rate > 0:
+                # A datagram bigger than the bucket can go once the bucket is full, leaving it in debt.
+                needed = min(len(datagram), self.burst)
+                if self.tokens < needed:
+                    return now + (needed - self.tokens) / self.rate
+                self.tokens -= len(datagram)
+            self.queue.popleft()
+            self.queued_bytes -= len(datagram)
+            deliveries.schedule(now + self.latency + extra_delay, datagram, sock, address, self)
+        return None
+
+
+class DeliveryLine:
+    # Datagrams that have left a bottleneck and are on their way, in the order they arrive.
+    def __init__(self):
+        self._heap = []
+        self._scheduled = 0
+
+    def schedule(self, due, datagram, sock, address, link):
+        heapq.heappush(self._heap, (due, self._scheduled, datagram, sock, address, link))
+        self._scheduled += 1
+
+    def deliver(self, now):
+        # Send everything that is due, and return when the next one is, or None.
+        while self._heap and self._heap[0][0] <= now:
+            due, scheduled, datagram, sock, address, link = heapq.heappop(self._heap)
+            try:
+                sock.sendto(datagram, address)
+                link.counters["delivered"] += 1
+                link.counters["bytes_delivered"] += len(datagram)
+            except OSError:
+                # The far end has gone, just like a real network we do not care.
+                pass
+        return self._heap[0][0] if self._heap else None
 
-            if rand_num < self.probability_delay:
-                # We will need to duplicate the packet to delay.
-                delay_segment = utility.STPPacket()
-                utility.copy_stp_packet(stp_packet, delay_segment)
 
-                delay_time = random.random() * self.delay_max_delay
-                delay_thread = threading.Timer(delay_time, self.send_delayed_data,
-                                               [delay_segment, receiver_ip, receiver_port])
-                delay_thread.start()
+class PLDProxy:
+    def __init__(self, listen_port, receiver_address, forward_settings, reverse_settings, seed):
+        self.receiver_address = receiver_address
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listen_socket.bind(("127.0.0.1", listen_port))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listen_socket, selectors.EVENT_READ)
+        # Each sender gets its own socket towards the receiver, so we know who to send the replies back to.
+        self.upstream_sockets = {}
+        self.clients = {}
+        self.forward = LinkDirection("forward", forward_settings, seed)
+        self.reverse = LinkDirection("reverse", reverse_settings, seed + 1)
+        self.deliveries = DeliveryLine()
+        # Every datagram is copied out as soon as it arrives, so one buffer big enough for anything UDP can carry
+        # will do.
+        self.receive_ring = utility.ReceiveRing(1, 65535)
 
-                utility.sender_log_file_summary["seg_delayed"] += 1
-                utility.sender_log_file_summary["seg_pld_messed"] += 1
+    def upstream_socket(self, client_address):
+        sock = self.upstream_sockets.get(client_address)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            self.upstream_sockets[client_address] = sock
+            self.clients[sock] = client_address
+            self.selector.register(sock, selectors.EVENT_READ)
+        return sock
+
+    def receive(self, sock):
+        # Drain everything that is waiting on the socket.
+        while True:
+            try:
+                data, address = self.receive_ring.receive(sock)
+            except (BlockingIOError, ConnectionRefusedError):
                 return
+            datagram = bytes(data)
+            if sock is self.listen_socket:
+                self.forward.arrive(datagram, self.upstream_socket(address), self.receiver_address)
             else:
-                rand_num = random.random()
+                self.reverse.arrive(datagram, self.listen_socket, self.clients[sock])
 
-            if rand_num != 1:
-                if retranmission:
-                    event_log = "snd/RXT"
-                else:
-                    event_log = "snd"
+    def report(self):
+        print("{:<16}{:>12}{:>12}".format("COUNTER", "FORWARD", "REVERSE"))
+        for name in LINK_COUNTERS:
+            print("{:<16}{:>12}{:>12}".format(name, self.forward.counters[name], self.reverse.counters[name]))
+        sys.stdout.flush()
 
-            self.linked_socket.sendto(data, (receiver_ip, receiver_port))
-            utility.write_log(event_log, stp_packet, self.file_writer)
+    def run(self, report_interval=0, idle_exit=0):
+        self.listen_socket.setblocking(False)
+        now = time.monotonic()
+        last_activity = now
+        next_report = now + report_interval if report_interval else None
+        next_event = None
+        try:
+            while True:
+                deadlines = [deadline for deadline in (next_event, next_report) if deadline is not None]
+                if idle_exit:
+                    deadlines.append(last_activity + idle_exit)
+                timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+                events = self.selector.select(timeout)
+                now = time.monotonic()
+                if events:
+                    last_activity = now
+                for key, mask in events:
+                    self.receive(key.fileobj)
 
-            if self.reorder_segment is not None:
-                self.reorder_segment_wait += 1
+                times = [self.forward.transmit(now, self.deliveries), self.reverse.transmit(now, self.deliveries),
+                         self.deliveries.deliver(now)]
+                times = [due for due in times if due is not None]
+                next_event = min(times) if times else None
 
-                if self.reorder_segment_wait >= self.reorder_max_delay:
-                    self.linked_socket.sendto(self.reorder_segment.raw, (receiver_ip, receiver_port))
-                    utility.write_log("snd/delay", self.reorder_segment, self.file_writer)
-                    self.reorder_segment = None
-                    self.reorder_segment_wait = 0
-                    utility.sender_log_file_summary["seg_reorder"] += 1
-                    utility.sender_log_file_summary["seg_pld_messed"] += 1
+                if next_report is not None and now >= next_report:
+                    self.report()
+                    next_report = now + report_interval
+                if idle_exit and next_event is None and now - last_activity >= idle_exit:
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.report()
+            self.selector.close()
+            for sock in self.upstream_sockets.values():
+                sock.close()
+            self.listen_socket.close()
 
-            utility.sender_log_file_summary["seg_pld_messed"] += 1
 
-        else:
-            print("You need to link the PLD Module with a socket before we can do anything.")
+def link_settings(options, direction):
+    settings = {}
+    for name, default in LINK_OPTIONS.items():
+        settings[name] = float(options.get(direction + "-" + name, options.get(name, default)))
+    return settings
+
+
+def main(argv):
+    arguments, options = utility.split_arguments(argv)
+    if len(arguments) != 3 or not utility.isstrint(arguments[0]) or not utility.isstrint(arguments[2]):
+        print("Usage: python PLDModule.py listen_port receiver_ip receiver_port [--option=value ...]")
+        return 1
+    try:
+        forward_settings = link_settings(options, "forward")
+        reverse_settings = link_settings(options, "reverse")
+        seed = int(float(options.get("seed", 50)))
+        report_interval = float(options.get("report", 0))
+        idle_exit = float(options.get("idle-exit", 0))
+    except ValueError as error:
+        print("Invalid option: {}".format(error))
+        return 1
+
+    proxy = PLDProxy(int(arguments[0]), (arguments[1], int(arguments[2])), forward_settings, reverse_settings, seed)
+    print("Forwarding 127.0.0.1 {} to {} {}".format(arguments[0], arguments[1], arguments[2]))
+    sys.stdout.flush()
+    proxy.run(report_interval, idle_exit)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
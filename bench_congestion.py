@@ -0,0 +1,141 @@
+#
+# Goodput of each congestion control algorithm under a set of PLD profiles. Every run is a real transfer over the
+# loopback interface: a receiver and a sender are started in a scratch directory, and goodput is the file size over
+# the time the sender took, provided the file arrived intact.
+#
+#   python bench_congestion.py [--algorithms=none,reno,cubic] [--profiles=clean,drop,delay,lossy] [--size=200000]
+#                              [--mws=5000] [--mss=500] [--gamma=4] [--seed=50] [--port=7000] [--timeout=300]
+#
+import filecmp
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import congestion
+import utility
+
+# The CPU time of the sender and receiver comes from the resource usage of our reaped children, which only Unix has.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# pDrop, pDuplicate, pCorrupt, pOrder, maxOrder, pDelay, maxDelay (ms)
+PROFILES = {
+    "clean": [0, 0, 0, 0, 0, 0, 0],
+    "drop": [0.05, 0, 0, 0, 0, 0, 0],
+    "delay": [0, 0, 0, 0, 0, 0.1, 100],
+    "lossy": [0.05, 0.02, 0.02, 0.02, 4, 0.05, 100],
+}
+
+DEFAULT_SIZE = 200000
+DEFAULT_MWS = 5000
+DEFAULT_MSS = 500
+DEFAULT_GAMMA = 4
+DEFAULT_SEED = 50
+DEFAULT_PORT = 7000
+DEFAULT_TIMEOUT = 300
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def children_cpu():
+    # Seconds of CPU, user and system, used by the children we have waited for so far.
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def timed_transfer(directory, receiver_arguments, sender_arguments, timeout):
+    # Starts receiver.py and then sender.py in directory with the given arguments and waits for both to finish.
+    # Returns the seconds the sender took and the CPU seconds of the sender and of the receiver, or None if the sender
+    # failed or either of them did not finish in time.
+    receiver = subprocess.Popen([sys.executable, os.path.join(HERE, "receiver.py")] + receiver_arguments,
+                                cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        # Give the receiver a moment to bind its port.
+        time.sleep(0.5)
+        cpu = children_cpu()
+        start = time.perf_counter()
+        try:
+            subprocess.run([sys.executable, os.path.join(HERE, "sender.py")] + sender_arguments, cwd=directory,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=timeout, check=True)
+        except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
+            return None
+        elapsed = time.perf_counter() - start
+        sender_cpu = children_cpu() - cpu
+        cpu = children_cpu()
+        receiver.wait(timeout)
+        receiver_cpu = children_cpu() - cpu
+    except subprocess.TimeoutExpired:
+        return None
+    finally:
+        if receiver.poll() is None:
+            receiver.kill()
+            receiver.wait()
+    return elapsed, sender_cpu, receiver_cpu
+
+
+def run_transfer(directory, port, settings, profile, algorithm, seed):
+    # Returns the seconds the sender took, or None if the transfer failed or did not finish in time.
+    arguments = ["127.0.0.1", str(port), "input.bin", str(settings["mws"]), str(settings["mss"]),
+                 str(settings["gamma"])]
+    arguments += [str(value) for value in PROFILES[profile]] + [str(seed), "--cc=" + algorithm, "--quiet"]
+    result = timed_transfer(directory, [str(port), "output.bin", "--quiet"], arguments, settings["timeout"])
+    if result is None:
+        return None
+    if not filecmp.cmp(os.path.join(directory, "input.bin"), os.path.join(directory, "output.bin"), shallow=False):
+        return None
+    return result[0]
+
+
+def main(argv):
+    arguments, options = utility.split_arguments(argv)
+    algorithms = options.get("algorithms", ",".join(congestion.ALGORITHMS)).split(",")
+    profiles = options.get("profiles", ",".join(PROFILES)).split(",")
+    for name in algorithms:
+        if name not in congestion.ALGORITHMS:
+            print("Unknown congestion control {}, choose from: {}".format(name, ", ".join(congestion.ALGORITHMS)))
+            return 1
+    for name in profiles:
+        if name not in PROFILES:
+            print("Unknown profile {}, choose from: {}".format(name, ", ".join(PROFILES)))
+            return 1
+
+    settings = {
+        "mws": int(options.get("mws", DEFAULT_MWS)),
+        "mss": int(options.get("mss", DEFAULT_MSS)),
+        "gamma": float(options.get("gamma", DEFAULT_GAMMA)),
+        "timeout": float(options.get("timeout", DEFAULT_TIMEOUT)),
+    }
+    size = int(options.get("size", DEFAULT_SIZE))
+    seed = int(options.get("seed", DEFAULT_SEED))
+    port = int(options.get("port", DEFAULT_PORT))
+
+    directory = tempfile.mkdtemp(prefix="bench_congestion.")
+    try:
+        with open(os.path.join(directory, "input.bin"), 'wb') as f:
+            f.write(bytes(random.Random(seed).getrandbits(8) for _ in range(size)))
+
+        print("{:<10}{:<10}{:>12}{:>14}".format("PROFILE", "CC", "SECONDS", "GOODPUT KB/S"))
+        for profile in profiles:
+            for algorithm in algorithms:
+                elapsed = run_transfer(directory, port, settings, profile, algorithm, seed)
+                # Each run gets a fresh port so a receiver that is still shutting down can not get in the way.
+                port += 1
+                if elapsed is None:
+                    print("{:<10}{:<10}{:>12}{:>14}".format(profile, algorithm, "FAILED", "-"))
+                else:
+                    print("{:<10}{:<10}{:>12.2f}{:>14.1f}".format(profile, algorithm, elapsed, size / elapsed / 1000))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,203 @@
+#
+# Sweeps real transfers over the loopback interface across every combination of MWS, MSS, gamma, PLD profile and
+# seed, and records what each one cost: wall time and goodput, the segments transmitted and retransmitted from the
+# sender's log summary, and the CPU time of the sender and the receiver. Each case is run --repeat= times and the run
+# with the median wall time is kept. The results can be written as CSV and JSON, and a JSON file from an earlier run
+# can be given with --baseline= to compare against, in which case any case whose goodput fell by more than
+# --tolerance= (a fraction) is reported and we exit with 1.
+#
+#   python bench_suite.py [--mws=5000,20000] [--mss=500,1000] [--gamma=4] [--profiles=clean,drop,delay,lossy]
+#                         [--seeds=50] [--size=1000000] [--repeat=1] [--port=7100] [--timeout=300]
+#                         [--sender-options="--cc=reno"] [--receiver-options=...] [--csv=results.csv]
+#                         [--json=results.json] [--baseline=baseline.json] [--tolerance=0.1]
+#
+# The PLD profiles are the ones bench_congestion.py uses. The input file is generated from --data-seed= (50 by
+# default), so runs on different trees and machines send the same bytes.
+#
+import csv
+import filecmp
+import glob
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import utility
+from bench_congestion import PROFILES, timed_transfer
+
+DEFAULT_MWS = "5000"
+DEFAULT_MSS = "500"
+DEFAULT_GAMMA = "4"
+DEFAULT_SEEDS = "50"
+DEFAULT_SIZE = 1000000
+DEFAULT_REPEAT = 1
+DEFAULT_PORT = 7100
+DEFAULT_TIMEOUT = 300
+DEFAULT_TOLERANCE = 0.1
+
+# What makes a case, and so which rows of a baseline are compared with which.
+CASE_FIELDS = ["mws", "mss", "gamma", "profile", "seed"]
+FIELDS = CASE_FIELDS + ["ok", "seconds", "goodput_kbps", "sender_cpu", "receiver_cpu", "seg_transmitted",
+                        "retrans_timeout", "retrans_fast", "dup_acks", "seg_dropped", "seg_corrupted", "seg_reorder",
+                        "seg_dupped", "seg_delayed", "segments_received", "segments_duplicate", "duplicate_ack_sent"]
+
+
+def read_summaries(directory, patterns):
+    # The summary counters of every log matching the patterns added up, so a striped transfer's logs count together.
+    total = {}
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(directory, pattern)):
+            for key, value in utility.read_summary(path).items():
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+def clear_logs(directory):
+    for pattern in ["Sender_log*.txt", "Sender_trace*.bin", "Receiver_log*.txt", "Receiver_trace*.bin", "output.bin"]:
+        for path in glob.glob(os.path.join(directory, pattern)):
+            os.remove(path)
+
+
+def run_case(directory, port, settings, case):
+    # One transfer. Returns a row with every field filled in, ok being False if the transfer failed, did not finish
+    # in time, or the file did not arrive intact.
+    clear_logs(directory)
+    row = dict(case, ok=False, seconds=None, goodput_kbps=None, sender_cpu=None, receiver_cpu=None)
+    arguments = ["127.0.0.1", str(port), "input.bin", str(case["mws"]), str(case["mss"]), str(case["gamma"])]
+    arguments += [str(value) for value in PROFILES[case["profile"]]] + [str(case["seed"]), "--quiet"]
+    result = timed_transfer(directory, [str(port), "output.bin", "--quiet"] + settings["receiver_options"],
+                            arguments + settings["sender_options"], settings["timeout"])
+    if result is None:
+        return row
+    row["seconds"], row["sender_cpu"], row["receiver_cpu"] = result
+    row["goodput_kbps"] = settings["size"] / row["seconds"] / 1000
+    row.update(read_summaries(directory, ["Sender_log*.txt", "Sender_trace*.bin"]))
+    row.update(read_summaries(directory, ["Receiver_log*.txt", "Receiver_trace*.bin"]))
+    row["ok"] = filecmp.cmp(os.path.join(directory, "input.bin"), os.path.join(directory, "output.bin"),
+                            shallow=False)
+    return row
+
+
+def case_key(row):
+    return tuple(str(row[field]) for field in CASE_FIELDS)
+
+
+def compare(rows, baseline, tolerance):
+    # Prints every case next to its baseline and returns how many of them regressed.
+    baseline_rows = {case_key(row): row for row in baseline}
+    regressions = 0
+    print()
+    print("{:<8}{:<8}{:<8}{:<10}{:<8}{:>16}{:>16}{:>10}".format("MWS", "MSS", "GAMMA", "PROFILE", "SEED",
+                                                                  "BASELINE KB/S", "GOODPUT KB/S", "CHANGE"))
+    for row in rows:
+        before = baseline_rows.get(case_key(row))
+        if before is None or not before["ok"]:
+            continue
+        if row["ok"]:
+            change = row["goodput_kbps"] / before["goodput_kbps"] - 1
+            regressed = change < -tolerance
+            result = "{:>16.1f}{:>+9.1f}%".format(row["goodput_kbps"], change * 100)
+        else:
+            regressed = True
+            result = "{:>16}{:>10}".format("FAILED", "-")
+        regressions += regressed
+        print("{:<8}{:<8}{:<8}{:<10}{:<8}{:>16.1f}{}{}".format(row["mws"], row["mss"], row["gamma"], row["profile"],
+                                                               row["seed"], before["goodput_kbps"], result,
+                                                               "  REGRESSED" if regressed else ""))
+    return regressions
+
+
+def main(argv):
+    arguments, options = utility.split_arguments(argv)
+    profiles = options.get("profiles", ",".join(PROFILES)).split(",")
+    for name in profiles:
+        if name not in PROFILES:
+            print("Unknown profile {}, choose from: {}".format(name, ", ".join(PROFILES)))
+            return 1
+
+    settings = {
+        "size": int(options.get("size", DEFAULT_SIZE)),
+        "timeout": float(options.get("timeout", DEFAULT_TIMEOUT)),
+        "sender_options": options.get("sender-options", "").split(),
+        "receiver_options": options.get("receiver-options", "").split(),
+    }
+    cases = [{"mws": int(mws), "mss": int(mss), "gamma": float(gamma), "profile": profile, "seed": int(seed)}
+             for mws in options.get("mws", DEFAULT_MWS).split(",")
+             for mss in options.get("mss", DEFAULT_MSS).split(",")
+             for gamma in options.get("gamma", DEFAULT_GAMMA).split(",")
+             for profile in profiles
+             for seed in options.get("seeds", DEFAULT_SEEDS).split(",")]
+    repeat = int(options.get("repeat", DEFAULT_REPEAT))
+    port = int(options.get("port", DEFAULT_PORT))
+    tolerance = float(options.get("tolerance", DEFAULT_TOLERANCE))
+
+    baseline = None
+    if "baseline" in options:
+        with open(options["baseline"]) as f:
+            baseline = json.load(f)["results"]
+
+    directory = tempfile.mkdtemp(prefix="bench_suite.")
+    rows = []
+    try:
+        size = settings["size"]
+        data = random.Random(int(options.get("data-seed", 50))).getrandbits(size * 8).to_bytes(size, 'little')
+        with open(os.path.join(directory, "input.bin"), 'wb') as f:
+            f.write(data)
+
+        print("{:<8}{:<8}{:<8}{:<10}{:<8}{:>10}{:>14}{:>10}{:>10}{:>8}{:>8}".format(
+            "MWS", "MSS", "GAMMA", "PROFILE", "SEED", "SECONDS", "GOODPUT KB/S", "CPU S", "SEGMENTS", "RXT", "FAST"))
+        for case in cases:
+            runs = []
+            for _ in range(repeat):
+                runs.append(run_case(directory, port, settings, case))
+                # Each run gets a fresh port so a receiver that is still shutting down can not get in the way.
+                port += 1
+            finished = sorted((run for run in runs if run["ok"]), key=lambda run: run["seconds"])
+            if len(finished) < len(runs):
+                row = next(run for run in runs if not run["ok"])
+            else:
+                row = finished[(len(finished) - 1) // 2]
+            rows.append(row)
+
+            prefix = "{:<8}{:<8}{:<8}{:<10}{:<8}".format(case["mws"], case["mss"], case["gamma"], case["profile"],
+                                                         case["seed"])
+            if not row["ok"]:
+                print(prefix + "{:>10}".format("FAILED"))
+            else:
+                print(prefix + "{:>10.2f}{:>14.1f}{:>10.2f}{:>10}{:>8}{:>8}".format(
+                    row["seconds"], row["goodput_kbps"], row["sender_cpu"] + row["receiver_cpu"],
+                    row.get("seg_transmitted", "-"), row.get("retrans_timeout", "-"), row.get("retrans_fast", "-")))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(directory)
+
+    if "csv" in options:
+        with open(options["csv"], 'w', newline='') as f:
+            writer = csv.DictWriter(f, FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+    if "json" in options:
+        with open(options["json"], 'w') as f:
+            json.dump({
+                "settings": {
+                    "size": settings["size"],
+                    "repeat": repeat,
+                    "sender_options": settings["sender_options"],
+                    "receiver_options": settings["receiver_options"],
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+                },
+                "results": rows,
+            }, f, indent=2)
+
+    if baseline is not None and compare(rows, baseline, tolerance):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,133 @@
+#
+# Congestion control for the sender. A controller keeps a congestion window in bytes that grows as ACKs arrive and
+# shrinks when a segment is lost, either because we fast retransmitted it or because the timer went off. The sender
+# never has more than min(congestion window, MWS) bytes in flight.
+#
+#   none   No congestion control, the window is always MWS. This is how the sender has always behaved.
+#   reno   Slow start followed by additive increase / multiplicative decrease (RFC 5681).
+#   cubic  CUBIC window growth (RFC 8312), which recovers faster than Reno on paths with a large window.
+#
+import math
+
+
+class CongestionControl:
+    # The base class is also the "none" controller, the window never moves from MWS.
+    def __init__(self, max_seg_size, max_win_size):
+        self.max_seg_size = max_seg_size
+        self.max_win_size = max_win_size
+        self.congestion_window = max_win_size
+        self.slow_start_threshold = max_win_size
+        # We only back off once per window of data. Until the cumulative ACK passes the highest sequence number that
+        # was sent when the loss was detected, further losses are part of the same congestion event.
+        self.recovery_point = 0
+
+    def window(self):
+        return max(min(int(self.congestion_window), self.max_win_size), self.max_seg_size)
+
+    def on_ack(self, acked_bytes, acknowledge_num, now):
+        pass
+
+    def on_fast_retransmit(self, flight_size, acknowledge_num, next_sequence_num, now):
+        pass
+
+    def on_timeout(self, flight_size, next_sequence_num, now):
+        pass
+
+
+class Reno(CongestionControl):
+    def __init__(self, max_seg_size, max_win_size):
+        CongestionControl.__init__(self, max_seg_size, max_win_size)
+        # Initial window from RFC 3390.
+        self.congestion_window = min(4 * max_seg_size, max(2 * max_seg_size, 4380))
+
+    def on_ack(self, acked_bytes, acknowledge_num, now):
+        if acknowledge_num < self.recovery_point:
+            # A partial ACK while recovering, the window stays where the loss put it.
+            return
+        if self.congestion_window < self.slow_start_threshold:
+            # Up to two segments per ACK (RFC 3465), so a receiver that delays its ACKs does not halve slow start.
+            self.congestion_window += min(acked_bytes, 2 * self.max_seg_size)
+        else:
+            self.congestion_avoidance(acked_bytes, now)
+        # There is no point growing the window past what MWS lets us use.
+        self.congestion_window = min(self.congestion_window, self.max_win_size)
+
+    def congestion_avoidance(self, acked_bytes, now):
+        # Roughly one segment per round trip.
+        self.congestion_window += self.max_seg_size * acked_bytes / self.congestion_window
+
+    def reduce(self, flight_size, now):
+        self.slow_start_threshold = max(flight_size / 2, 2 * self.max_seg_size)
+        self.congestion_window = self.slow_start_threshold
+
+    def on_fast_retransmit(self, flight_size, acknowledge_num, next_sequence_num, now):
+        if acknowledge_num < self.recovery_point:
+            return
+        self.recovery_point = next_sequence_num
+        self.reduce(flight_size, now)
+
+    def on_timeout(self, flight_size, next_sequence_num, now):
+        # Only lower the threshold if this is a new loss, a timeout during recovery means the retransmission was lost
+        # and the window has already been cut.
+        if next_sequence_num > self.recovery_point:
+            self.reduce(flight_size, now)
+        self.recovery_point = next_sequence_num
+        self.congestion_window = self.max_seg_size
+
+
+class Cubic(Reno):
+    # The window is counted in segments in the CUBIC function, C is in segments per second cubed.
+    C = 0.4
+    BETA = 0.7
+
+    def __init__(self, max_seg_size, max_win_size):
+        Reno.__init__(self, max_seg_size, max_win_size)
+        self.window_max = 0
+        self.epoch_start = None
+        self.origin_point = 0
+        self.time_to_origin = 0
+        self.reno_window = 0
+
+    def congestion_avoidance(self, acked_bytes, now):
+        segments = self.congestion_window / self.max_seg_size
+        if self.epoch_start is None:
+            # First ACK since the last loss, work out where the cubic curve starts.
+            self.epoch_start = now
+            if segments < self.window_max:
+                self.time_to_origin = math.pow((self.window_max - segments) / self.C, 1 / 3)
+                self.origin_point = self.window_max
+            else:
+                self.time_to_origin = 0
+                self.origin_point = segments
+            self.reno_window = segments
+
+        elapsed = now - self.epoch_start
+        target = self.origin_point + self.C * math.pow(elapsed - self.time_to_origin, 3)
+        acked_segments = acked_bytes / self.max_seg_size
+        if target > segments:
+            segments += (target - segments) / segments * acked_segments
+        else:
+            # Hardly grow at all while we are sitting on the plateau around the old maximum.
+            segments += 0.01 * acked_segments / segments
+
+        # Never grow slower than Reno would in the same time.
+        self.reno_window += 3 * (1 - self.BETA) / (1 + self.BETA) * acked_segments / segments
+        self.congestion_window = max(segments, self.reno_window) * self.max_seg_size
+
+    def reduce(self, flight_size, now):
+        segments = self.congestion_window / self.max_seg_size
+        # Fast convergence, if we lost before getting back to the last maximum, leave some room for other flows.
+        if segments < self.window_max:
+            self.window_max = segments * (1 + self.BETA) / 2
+        else:
+            self.window_max = segments
+        self.epoch_start = None
+        self.slow_start_threshold = max(self.congestion_window * self.BETA, 2 * self.max_seg_size)
+        self.congestion_window = self.slow_start_threshold
+
+
+ALGORITHMS = {
+    "none": CongestionControl,
+    "reno": Reno,
+    "cubic": Cubic,
+}
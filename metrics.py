@@ -0,0 +1,208 @@
+#
+# Live metrics for STP connections, in the Prometheus text format. Every connection given a Registry keeps its
+# summary counters there along with histograms of what it has seen, and start_endpoint serves the lot over HTTP on a
+# local TCP port or a Unix socket while the transfers run:
+#
+#   registry = metrics.Registry()
+#   await metrics.start_endpoint("127.0.0.1:9100", registry)     or "unix:/tmp/stp-metrics.sock"
+#   connection = await stp.connect("127.0.0.1", 5555, mws=5000, mss=500, metrics=registry)
+#
+#   curl http://127.0.0.1:9100/metrics
+#   curl --unix-socket /tmp/stp-metrics.sock http://localhost/metrics
+#
+import asyncio
+import bisect
+import collections
+import utility
+
+# How many connections that are over are still exported, the oldest are forgotten first.
+KEEP_CLOSED = 100
+
+# The throughput histogram gets a sample every this many seconds.
+RATE_INTERVAL = 1.0
+
+TIME_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+BYTES_BUCKETS = [2 ** power for power in range(9, 25)]
+RATE_BUCKETS = [10000, 30000, 100000, 300000, 1000000, 3000000, 10000000, 30000000, 100000000, 300000000]
+
+# The histograms each end keeps, with their buckets.
+HISTOGRAMS = {
+    "sender": {
+        "rtt_seconds": TIME_BUCKETS,
+        "rto_seconds": TIME_BUCKETS,
+        "retransmission_gap_seconds": TIME_BUCKETS,
+        "window_occupancy_bytes": BYTES_BUCKETS,
+        "throughput_bytes_per_second": RATE_BUCKETS,
+    },
+    "receiver": {
+        "window_occupancy_bytes": BYTES_BUCKETS,
+        "throughput_bytes_per_second": RATE_BUCKETS,
+    },
+}
+
+# Summary entries which are not counters, and the counters whose name would not work with _total added on.
+SUMMARY_GAUGES = {"file_size"}
+COUNTER_NAMES = {"segments_received_total": "segments"}
+
+HELP = {
+    "open": "Whether the connection is still open.",
+    "state": "The state the connection is in.",
+    "bytes_written": "Bytes written to the connection so far.",
+    "bytes_acked": "Bytes the receiver has acknowledged.",
+    "bytes_in_flight": "Bytes sent and not yet acknowledged.",
+    "congestion_window_bytes": "The congestion window.",
+    "advertised_window_bytes": "The window the receiver advertises.",
+    "reassembly_buffer_bytes": "Bytes received out of order waiting for the gap in front of them to be filled.",
+    "srtt_seconds": "The smoothed round trip time.",
+    "timeout_seconds": "The retransmission timeout as it is now.",
+    "rtt_seconds": "Round trip time samples.",
+    "rto_seconds": "The retransmission timeout, each time it changes.",
+    "retransmission_gap_seconds": "Time from a segment first being sent to it being sent again.",
+    "window_occupancy_bytes": "Bytes outstanding in the window, sampled on every ACK or out of order segment.",
+    "throughput_bytes_per_second": "Bytes acknowledged per second, sampled every RATE_INTERVAL seconds.",
+}
+HELP.update({"sender_" + key: label for key, label in utility.SENDER_SUMMARY_LABELS})
+HELP.update({"receiver_" + key: label for key, label in utility.RECEIVER_SUMMARY_LABELS})
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket and one for everything above the last, made cumulative when rendered.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class ConnectionMetrics:
+    # The metrics of one connection. summary is the connection's own summary dict, so its counters are always up to
+    # date, and gauges() returns a dict of the gauges, which are only worked out when someone asks for them.
+    def __init__(self, registry, role, labels, summary, gauges, now):
+        self.registry = registry
+        self.role = role
+        self.labels = labels
+        self.summary = summary
+        self.gauges = gauges
+        self.open = True
+        self.histograms = {name: Histogram(buckets) for name, buckets in HISTOGRAMS[role].items()}
+        self._rate_time = now
+        self._rate_bytes = 0
+
+    def close(self):
+        # The connection is over, it is kept around for a while so its final numbers can still be scraped.
+        self.registry.close(self)
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def sample_rate(self, now, total_bytes):
+        # Called with the bytes transferred so far whenever they go up, turned into a throughput sample once every
+        # RATE_INTERVAL seconds.
+        elapsed = now - self._rate_time
+        if elapsed >= RATE_INTERVAL:
+            self.observe("throughput_bytes_per_second", (total_bytes - self._rate_bytes) / elapsed)
+            self._rate_time = now
+            self._rate_bytes = total_bytes
+
+
+def format_labels(labels):
+    return ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                    for name, value in labels.items())
+
+
+class Registry:
+    def __init__(self, keep_closed=KEEP_CLOSED):
+        self.connections = []
+        self.closed = collections.deque(maxlen=keep_closed)
+
+    def add(self, role, labels, summary, gauges, now):
+        connection = ConnectionMetrics(self, role, labels, summary, gauges, now)
+        self.connections.append(connection)
+        return connection
+
+    def close(self, connection):
+        if connection.open:
+            connection.open = False
+            self.connections.remove(connection)
+            self.closed.append(connection)
+
+    def render(self):
+        # Every metric's samples have to be together, so they are gathered by name first.
+        metrics = collections.OrderedDict()
+
+        def add(name, kind, help_key, samples):
+            metric = metrics.setdefault(name, (kind, HELP.get(help_key, ""), []))
+            metric[2].extend(samples)
+
+        for connection in list(self.connections) + list(self.closed):
+            prefix = "stp_" + connection.role + "_"
+            labels = format_labels(connection.labels)
+            add(prefix + "open", "gauge", "open", ["{}open{{{}}} {}".format(prefix, labels, int(connection.open))])
+            for key, value in connection.summary.items():
+                if key in SUMMARY_GAUGES:
+                    name, kind = prefix + key, "gauge"
+                else:
+                    name, kind = prefix + COUNTER_NAMES.get(key, key) + "_total", "counter"
+                add(name, kind, connection.role + "_" + key, ["{}{{{}}} {}".format(name, labels, value)])
+            for key, value in connection.gauges().items():
+                add(prefix + key, "gauge", key, ["{}{}{{{}}} {}".format(prefix, key, labels, value)])
+            for key, histogram in connection.histograms.items():
+                name = prefix + key
+                samples = []
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    samples.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+                samples.append("{}_sum{{{}}} {}".format(name, labels, histogram.sum))
+                samples.append("{}_count{{{}}} {}".format(name, labels, histogram.count))
+                add(name, "histogram", key, samples)
+
+        lines = []
+        for name, (kind, help_text, samples) in metrics.items():
+            if help_text:
+                lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+class EndpointProtocol(asyncio.Protocol):
+    # Just enough HTTP for a scraper or curl: read the request up to the blank line, answer it and hang up.
+    def __init__(self, registry):
+        self.registry = registry
+        self.transport = None
+        self.request = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.request += data
+        if b"\r\n\r\n" not in self.request and b"\n\n" not in self.request:
+            if len(self.request) > 8192:
+                self.transport.close()
+            return
+        request_line = self.request.split(b"\n", 1)[0].split()
+        path = request_line[1].split(b"?", 1)[0] if len(request_line) > 1 else b"/"
+        if path in (b"/", b"/metrics"):
+            status, body = "200 OK", self.registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found, try /metrics.\n"
+        self.transport.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n"
+                             "Connection: close\r\n\r\n".format(status, len(body)).encode() + body)
+        self.transport.close()
+
+
+async def start_endpoint(address, registry, loop=None):
+    # Serve the registry at address, "host:port" or "unix:path". Returns the asyncio server, close it to stop.
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    if address.startswith("unix:"):
+        return await loop.create_unix_server(lambda: EndpointProtocol(registry), address[len("unix:"):])
+    host, _, port = address.rpartition(":")
+    return await loop.create_server(lambda: EndpointProtocol(registry), host or "127.0.0.1", int(port))
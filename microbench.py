@@ -0,0 +1,175 @@
+#
+# Microbenchmarks for the STP packet codec and the PLD. No networking is involved, this only measures how many packets
+# per second we can push through the encoder, the decoder, each of the checksum algorithms and the PLD for a range of
+# payload sizes, along with the memory each packet needs. The PLD sends into a stub socket that throws everything away.
+#
+#   python microbench.py [encode] [decode] [pld/decision] [pld/send] [checksum/crc32 ...] [--seconds=1]
+#                        [--sizes=0,50,500,1000,8000,65220]
+#
+# ALLOC B/PKT is the most memory a single packet had allocated at once, averaged over ALLOCATION_CALLS packets, which
+# for a hot path that should not allocate at all is the size of the temporaries it still makes.
+#
+import os
+import sys
+import time
+import tracemalloc
+import utility
+import PLDModule
+
+DEFAULT_SECONDS = 1
+DEFAULT_SIZES = [0, 50, 500, 1000, 8000, utility.MAX_SEGMENT_SIZE]
+ALLOCATION_CALLS = 1000
+
+# pDrop, pDuplicate, pCorrupt, pOrder, maxOrder for the PLD benchmarks. Nothing is delayed, as that needs a thread.
+PLD_PROBABILITIES = [0.05, 0.02, 0.02, 0.02, 3]
+PLD_SEED = 50
+
+
+class StubSocket:
+    # Stands in for the PLD's socket, taking datagrams the way a real one does and throwing them away.
+    def sendto(self, data, address):
+        return len(data)
+
+    def sendmsg(self, buffers, ancdata, flags, address):
+        return sum(len(buffer) for buffer in buffers)
+
+
+def measure(function, seconds):
+    # Run the function in batches until the time is up and return the number of calls per second.
+    batch = 1000
+    calls = 0
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < seconds:
+        for _ in range(batch):
+            function()
+        calls += batch
+        elapsed = time.perf_counter() - start
+    return calls / elapsed
+
+
+def measure_allocations(function):
+    # The most memory, in bytes, that a call had allocated at once, averaged over ALLOCATION_CALLS calls. The first
+    # call is left out so caches being filled do not count.
+    function()
+    total = 0
+    for _ in range(ALLOCATION_CALLS):
+        tracemalloc.start()
+        function()
+        total += tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return total / ALLOCATION_CALLS
+
+
+def bench_encode(payload_size):
+    packet = utility.STPPacket()
+    packet.ack = True
+    packet.window_size = 500
+    packet.payload = memoryview(bytes(payload_size))
+
+    def encode():
+        packet.sequence_num = (packet.sequence_num + payload_size + 1) & 0xFFFFFFFF
+        packet.assemble_stp_header()
+
+    return encode
+
+
+def bench_decode(payload_size):
+    # Decoding includes verifying the checksum, which is what the receiver does for every datagram.
+    packet = utility.STPPacket()
+    packet.window_size = 500
+    packet.payload = bytes(payload_size)
+    packet.assemble_stp_header()
+    data = bytes(packet.raw)
+
+    received = utility.STPPacket()
+
+    def decode():
+        if not received.break_raw_data(data):
+            raise AssertionError("Benchmark packet failed its checksum.")
+
+    return decode
+
+
+def make_pld():
+    pld = PLDModule.PLDModule(PLD_SEED)
+    pld.probability_drop, pld.probability_duplicate, pld.probability_corrupt, pld.probability_reorder, \
+        pld.reorder_max_delay = PLD_PROBABILITIES
+    pld.linked_socket = StubSocket()
+    # The cheapest log there is, so the benchmark is mostly the PLD itself.
+    pld.file_writer = utility.BinaryTrace(os.devnull)
+    pld.summary = dict(utility.sender_log_file_summary)
+    return pld
+
+
+def bench_pld_decision(payload_size):
+    # Just deciding what happens to a segment, which does not depend on its size.
+    return make_pld().next_decision
+
+
+def bench_pld_send(payload_size):
+    # Everything the PLD does with a segment the sender hands it, down to the socket.
+    pld = make_pld()
+    packet = utility.STPPacket()
+    packet.ack = True
+    packet.window_size = 500
+    packet.payload = memoryview(bytes(payload_size))
+
+    def send():
+        packet.sequence_num = (packet.sequence_num + payload_size + 1) & 0xFFFFFFFF
+        packet.assemble_stp_header()
+        pld.send_data(packet, "127.0.0.1", 5555)
+
+    return send
+
+
+def checksum_benchmark(name):
+    # Checksum a whole packet worth of data, the way the encoder does.
+    function = utility.CHECKSUM_ALGORITHMS[name][1]
+
+    def bench_checksum(payload_size):
+        data = memoryview(bytes(utility.STP_HEADER_SIZE + payload_size))
+        return lambda: function(data)
+
+    return bench_checksum
+
+
+BENCHMARKS = {
+    "encode": bench_encode,
+    "decode": bench_decode,
+    "pld/decision": bench_pld_decision,
+    "pld/send": bench_pld_send,
+}
+for checksum_name in utility.CHECKSUM_ALGORITHMS:
+    BENCHMARKS["checksum/" + checksum_name] = checksum_benchmark(checksum_name)
+SIZE_INDEPENDENT = {"pld/decision"}
+
+
+def main(argv):
+    arguments, options = utility.split_arguments(argv)
+    seconds = float(options.get("seconds", DEFAULT_SECONDS))
+    sizes = DEFAULT_SIZES
+    if "sizes" in options:
+        sizes = [int(size) for size in options["sizes"].split(",")]
+    names = arguments if arguments else list(BENCHMARKS)
+
+    print("{:<20}{:>10}{:>16}{:>12}{:>14}".format("BENCHMARK", "PAYLOAD", "PACKETS/SEC", "MB/SEC", "ALLOC B/PKT"))
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark {}, choose from: {}".format(name, ", ".join(BENCHMARKS)))
+            return 1
+        for size in sizes:
+            # Each measurement gets a fresh setup, so neither sees what the other left behind.
+            packets_per_second = measure(BENCHMARKS[name](size), seconds)
+            allocated = measure_allocations(BENCHMARKS[name](size))
+            # Benchmarks which do not depend on the payload size have no throughput to speak of.
+            if name in SIZE_INDEPENDENT:
+                throughput = "{:>12}".format("-")
+            else:
+                throughput = "{:>12.1f}".format(packets_per_second * size / 1000000)
+            print("{:<20}{:>10}{:>16,.0f}{}{:>14.0f}".format(name, size, packets_per_second, throughput, allocated))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
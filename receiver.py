@@ -1,10 +1,12 @@
-from colorama import Fore
-from colorama import Style
 from colorama import init
-import sys
+import asyncio
+import multiprocessing
+import os
 import socket
+import sys
 import utility
-import time
+import metrics
+import stp
 
 init()
 
@@ -12,186 +14,239 @@ rec_ip = "127.0.0.1"
 rec_port = 5555
 rec_data = 'received-test.txt'
 
-if len(sys.argv) >= 2:
-    if utility.isstrint(sys.argv[1]):
-        rec_port = int(sys.argv[1])
+arguments, options = utility.split_arguments(sys.argv[1:])
+
+if len(arguments) >= 1:
+    if utility.isstrint(arguments[0]):
+        rec_port = int(arguments[0])
     else:
         print('Error: Port argument is meant to be an integer.')
         exit()
 
-if len(sys.argv) >= 3:
-    rec_data = sys.argv[2]
-
-# Set up the socket to listen to using UDP
-sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-sock.bind((rec_ip, rec_port))
-
-ReceivedPacket = utility.STPPacket()
-SendingPacket = utility.STPPacket()
-receiver_file_handler = open("Receiver_log.txt", 'w')
-utility.create_log_file(receiver_file_handler)
-
-received_segments = {}
-
-# =============================================================
-# Getting a data packet that has arrived in tact
-# =============================================================
-receiver_running = True
-connection_established = False
-received_data_packet = False
-
-while receiver_running:
-    # ---------------------------
-    # Waiting to receive a syn packet
-    while not received_data_packet:
-        print("Listening on {} {}".format(rec_ip, rec_port))
-        data, address = sock.recvfrom(1024)  # Buffer size of 1024 bytes
-
-        if ReceivedPacket.break_raw_data(data):
-            utility.start_time = time.time()
-            utility.write_log("rcv", ReceivedPacket, receiver_file_handler)
-            utility.receiver_log_file_summary["segments_received_total"] += 1
-            received_data_packet = True
-        else:
-            print("Received packet was corrupted.")
-    received_data_packet = False
-
-    # Get the syn packet, return it with an ACK.
-    if ReceivedPacket.syn:
-        print("Received syn. Reply with ACK.")
-        SendingPacket.reset_flags()
-        SendingPacket.syn = True
-        SendingPacket.ack = True
-        SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + 1
-        SendingPacket.assemble_stp_header()
-
-        sock.sendto(SendingPacket.raw, address)
-        utility.write_log("snd", SendingPacket, receiver_file_handler)
-
-        SendingPacket.sequence_num += 1
+if len(arguments) >= 2:
+    rec_data = arguments[1]
+
+# The checksum algorithms we are willing to use if the sender asks for them. Turning checksums off has to be allowed
+# explicitly with --checksums=none,... as it is only safe on a trusted link.
+accepted_checksums = [name for name in utility.CHECKSUM_ALGORITHMS if name != "none"]
+if "checksums" in options:
+    accepted_checksums = options["checksums"].split(",")
+    for name in accepted_checksums:
+        if name not in utility.CHECKSUM_ALGORITHMS:
+            print('Error: Unknown checksum {}, choose from {}.'.format(name, ", ".join(utility.CHECKSUM_ALGORITHMS)))
+            exit()
+
+# How many bytes past our cumulative ACK we are prepared to take. By default it is the sender's maximum window size from
+# its SYN, --window= sets it outright.
+receive_window = 0
+if "window" in options:
+    if not utility.isstrint(options["window"]) or int(options["window"]) < 0:
+        print('Error: Window argument is meant to be a non-negative integer.')
+        exit()
+    receive_window = int(options["window"])
+
+# The largest segment we take from a sender with --max-mss=, by default as much as fits in a UDP datagram. Senders
+# asking for more are told to send less.
+max_segment_size = utility.MAX_SEGMENT_SIZE
+if "max-mss" in options:
+    if not utility.isstrint(options["max-mss"]) or int(options["max-mss"]) < 1:
+        print('Error: Max MSS argument is meant to be a positive integer.')
+        exit()
+    max_segment_size = int(options["max-mss"])
+    if max_segment_size > utility.MAX_SEGMENT_SIZE:
+        print('Warning: An MSS of {} does not fit in a UDP datagram, using {}.'.format(
+            max_segment_size, utility.MAX_SEGMENT_SIZE))
+
+# The socket's buffer sizes in bytes with --rcvbuf= and --sndbuf=. By default the receive buffer grows to take the
+# largest window a sender tells us about, and we are warned if the system will not give us as much as we asked for.
+socket_buffers = {}
+for name, argument in (("rcvbuf", "receive_buffer"), ("sndbuf", "send_buffer")):
+    if name in options:
+        if not utility.isstrint(options[name]) or int(options[name]) < 1:
+            print('Error: {} argument is meant to be a positive integer.'.format(name))
+            exit()
+        socket_buffers[argument] = int(options[name])
+
+# With --ack-every=N in order segments are acknowledged N at a time rather than one by one, or --ack-delay=
+# milliseconds after the first of them if the rest do not turn up. Segments out of order or filling a gap are still
+# acknowledged at once, so fast retransmit works as before.
+ack_options = {}
+if "ack-every" in options:
+    if not utility.isstrint(options["ack-every"]) or int(options["ack-every"]) < 1:
+        print('Error: Ack every argument is meant to be a positive integer.')
+        exit()
+    ack_options["ack_every"] = int(options["ack-every"])
+if "ack-delay" in options:
+    if not utility.isstrfloat(options["ack-delay"]) or not float(options["ack-delay"]) >= 0:
+        print('Error: Ack delay argument is meant to be a non-negative number of milliseconds.')
+        exit()
+    ack_options["ack_delay"] = float(options["ack-delay"]) / 1000
+    if ack_options["ack_delay"] >= stp.MIN_TIMEOUT:
+        print('Warning: An ACK delay of {} ms is longer than the sender\'s shortest timeout of {} ms.'.format(
+            options["ack-delay"], int(stp.MIN_TIMEOUT * 1000)))
+
+# Normally we take one transfer into rec_data and exit. With --serve we stay up and take any number of senders at once,
+# each connection getting its own output file and log named after rec_data and Receiver_log.txt, with the connection
+# number and the sender's address added on. A connection we have not heard from in --session-timeout= seconds is
+# given up on, which has to be longer than the sender's longest retransmission timeout.
+SERVE = "serve" in options
+SESSION_TIMEOUT = stp.SESSION_TIMEOUT
+if "session-timeout" in options:
+    if not utility.isstrfloat(options["session-timeout"]) or not float(options["session-timeout"]) > 0:
+        print('Error: Session timeout argument is meant to be a positive number of seconds.')
+        exit()
+    SESSION_TIMEOUT = float(options["session-timeout"])
+
+
+# With --workers= that many processes share the port, each running a server of its own, so the stripes of a striped
+# transfer, or different senders, are received on as many cores. The kernel keeps each sender with one of them.
+WORKERS = 1
+if "workers" in options:
+    if not utility.isstrint(options["workers"]) or int(options["workers"]) < 1:
+        print('Error: Workers argument is meant to be a positive integer.')
+        exit()
+    WORKERS = int(options["workers"])
+if WORKERS > 1 and not hasattr(socket, "SO_REUSEPORT"):
+    print('Error: --workers needs SO_REUSEPORT, which this platform does not have.')
+    exit()
+worker_number = 0
+
+# With --metrics=host:port or --metrics=unix:path every connection's counters and histograms can be scraped from there
+# in the Prometheus text format.
+METRICS_ADDRESS = options.get("metrics")
+if METRICS_ADDRESS is not None and WORKERS > 1:
+    print('Error: --metrics can not be used with --workers, as every worker has connections of its own.')
+    exit()
+
+
+def session_paths(session_id, address):
+    # In serve mode every connection gets its own files, named after the connection and the sender. Otherwise the
+    # only reason for more than one connection is a striped transfer, whose stripes all write to rec_data but each
+    # need a log of their own. Every worker counts its connections from 1, so they are told apart by the worker too.
+    if WORKERS > 1:
+        session_id = "{}.{}".format(worker_number, session_id)
+    if not SERVE:
+        if session_id == 1:
+            return rec_data, "Receiver_log.txt", "Receiver_trace.bin"
+        suffix = "-{}".format(session_id)
+        return rec_data, "Receiver_log" + suffix + ".txt", "Receiver_trace" + suffix + ".bin"
+    suffix = "-{}-{}-{}".format(session_id, address[0], address[1])
+    name, extension = os.path.splitext(rec_data)
+    output_path = name + suffix + extension
+    utility.console(utility.LOG_INFO, "Connection {} from {} {} writing to {}.",
+                    session_id, address[0], address[1], output_path)
+    return output_path, "Receiver_log" + suffix + ".txt", "Receiver_trace" + suffix + ".bin"
+
+
+# The stripes of each striped transfer that are over, keyed by the sender's host and the transfer id.
+finished_stripes = {}
+
+
+def transfer_finished(address, stripe):
+    # Whether the transfer a connection that has just closed was part of is over, which for a striped transfer means
+    # every stripe of it.
+    if stripe is None:
+        return True
+    transfer_id, offset, length, stripes = stripe
+    offsets = finished_stripes.setdefault((address[0], transfer_id), set())
+    offsets.add(offset)
+    return len(offsets) == stripes
+
+
+def start_server(on_session_closed, reuse_port=False, registry=None):
+    return stp.start_server(rec_ip, rec_port, session_paths, accepted_checksums=accepted_checksums,
+                            receive_window=receive_window, session_timeout=SESSION_TIMEOUT, trace="trace" in options,
+                            on_session_closed=on_session_closed, metrics=registry, max_segment_size=max_segment_size,
+                            reuse_port=reuse_port, **socket_buffers, **ack_options)
+
+
+async def serve():
+    finished = asyncio.get_running_loop().create_future()
+
+    def session_closed(session):
+        # Without --serve we are done once the one transfer is over.
+        if not SERVE and transfer_finished(session.address, session.stripe) and not finished.done():
+            finished.set_result(None)
+
+    registry = None
+    endpoint = None
+    if METRICS_ADDRESS is not None:
+        registry = metrics.Registry()
+        endpoint = await metrics.start_endpoint(METRICS_ADDRESS, registry)
+    server = await start_server(session_closed, registry=registry)
+    utility.console(utility.LOG_INFO, "Listening on {} {}", rec_ip, rec_port)
+    try:
+        await finished
+    finally:
+        server.close()
+        if endpoint is not None:
+            endpoint.close()
+            await endpoint.wait_closed()
+
+
+def run_server():
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        # With --serve we run until we are interrupted.
+        pass
+
+
+async def work(closed_sessions, stop):
+    server = await start_server(lambda session: closed_sessions.put((session.address, session.stripe)),
+                                reuse_port=True)
+    # The parent waits until every worker has its socket, as the kernel only spreads senders evenly over the sockets
+    # that are there when they start.
+    closed_sessions.put(None)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, stop.wait)
+    finally:
+        server.close()
+
+
+def run_worker(number, closed_sessions, stop):
+    # One of the --workers processes. It tells the parent about every connection that closes, and stops when the
+    # parent tells it to.
+    global worker_number
+    worker_number = number
+    # We may have been forked from the parent, whose console thread does not come along.
+    utility.start_console(utility.parse_console_level(options), background=False)
+    try:
+        asyncio.run(work(closed_sessions, stop))
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers():
+    closed_sessions = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=run_worker, args=(number + 1, closed_sessions, stop))
+               for number in range(WORKERS)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            closed_sessions.get()
+        utility.console(utility.LOG_INFO, "Listening on {} {} with {} workers", rec_ip, rec_port, WORKERS)
+        while True:
+            address, stripe = closed_sessions.get()
+            # Without --serve we are done once the one transfer is over.
+            if not SERVE and transfer_finished(address, stripe):
+                break
+    except KeyboardInterrupt:
+        # With --serve we run until we are interrupted.
+        pass
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+# The workers may start by running this script again, so only the parent listens.
+if __name__ == '__main__':
+    # Console output and the log files are written by background threads so the transfer never waits on them.
+    utility.start_console(utility.parse_console_level(options))
+    if WORKERS > 1:
+        run_workers()
     else:
-        continue
-
-    # Now we wait for the client's ACK
-    while not received_data_packet:
-        data, address = sock.recvfrom(1024)  # Buffer size of 1024 bytes
-
-        if ReceivedPacket.break_raw_data(data):
-            received_data_packet = True
-            utility.write_log("rcv", ReceivedPacket, receiver_file_handler)
-            utility.receiver_log_file_summary["segments_received_total"] += 1
-        else:
-            print("Received ACK packet was corrupted. Trying again ...")
-
-    if ReceivedPacket.ack:
-        print("Received the ACK, establish the connection.")
-        connection_established = True
-
-    # ----------------------------------------------------------------------------------------------------
-    # CONNECTION IS ESTABLISHED. TALKING WITH CLIENT
-    # For this assignment, we are going to immediately accept any data sent by the client to be stored into
-    # a file. We will only stop writing to the file when the sender asks us to close the connection.
-    output_file_handler = open(rec_data, 'wb')
-
-    while connection_established:
-        data, address = sock.recvfrom(1024)
-        utility.receiver_log_file_summary["segments_received_total"] += 1
-
-        if ReceivedPacket.break_raw_data(data):
-            utility.write_log("rcv", ReceivedPacket, receiver_file_handler)
-
-            if ReceivedPacket.fin:
-                connection_established = False
-            else:
-                # When we receive the client's sequence number, we are going to see that they have previous sent
-                # (sequence number) amount of data before this packet. We are then going to increment that
-                # sequence number with the number of data received in this current packet and send it back.
-                print("Received sequence of, {}".format(ReceivedPacket.sequence_num))
-
-                # Before we write to the output file, we will need to check if this sequence number received was
-                # dropped. We will check it with the previous packet we sent out. The previous packet we sent out
-                # will tell the client about how we were expecting that packet to arrive.
-                if SendingPacket.acknowledge_num != ReceivedPacket.sequence_num:
-                    print(Fore.LIGHTRED_EX +
-                          "Received packet with SEQ {} but expecting SEQ {}. Retransmit the last packet again\n"
-                          .format(ReceivedPacket.sequence_num, SendingPacket.acknowledge_num) +
-                          Style.RESET_ALL)
-                    SendingPacket.reset_flags()
-                    SendingPacket.ack = True
-                    sock.sendto(SendingPacket.raw, address)
-                    utility.write_log("snd/DA", SendingPacket, receiver_file_handler)
-                    utility.receiver_log_file_summary["segments_received"] += 1
-                    utility.receiver_log_file_summary["duplicate_ack_sent"] += 1
-
-                    if ReceivedPacket.sequence_num in received_segments:
-                        received_segments[ReceivedPacket.sequence_num] += 1
-                    else:
-                        received_segments[ReceivedPacket.sequence_num] = 1
-                else:
-                    output_file_handler.write(ReceivedPacket.payload)
-                    utility.receiver_log_file_summary["data_received"] += len(ReceivedPacket.payload)
-                    utility.receiver_log_file_summary["segments_received"] += 1
-                    SendingPacket.reset_flags()
-                    SendingPacket.ack = True
-                    SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + len(ReceivedPacket.payload)
-                    SendingPacket.assemble_stp_header()
-                    print(Fore.GREEN +
-                          "Data looks good. Sending packet with ACK {}\n"
-                          .format(SendingPacket.acknowledge_num) +
-                          Style.RESET_ALL)
-                    sock.sendto(SendingPacket.raw, address)
-                    utility.write_log("snd", SendingPacket, receiver_file_handler)
-
-                    if ReceivedPacket.sequence_num in received_segments:
-                        received_segments[ReceivedPacket.sequence_num] += 1
-                    else:
-                        received_segments[ReceivedPacket.sequence_num] = 1
-        else:
-            print(Fore.LIGHTRED_EX + "Received ACK packet was corrupted. Trying again ...\n" + Style.RESET_ALL)
-            # sock.sendto(SendingPacket.raw, address)
-            # utility.write_log("snd/DA", SendingPacket, "Receiver_log.txt")
-            utility.write_log("rcv/corr", ReceivedPacket, receiver_file_handler)
-            utility.receiver_log_file_summary["segments_corrupt"] += 1
-
-    # We have exit out the loop, that means we are going to shut down the system. Since we are assuming the
-    # handshakes are perfect, we can close it outside the loop.
-    # Received FIN, send the ACK.
-    print("Received FIN packet. Closing connection.")
-    print("Received sequence of, {}".format(ReceivedPacket.sequence_num))
-    SendingPacket.reset_flags()
-    SendingPacket.ack = True
-    # We are adding one byte to the acknowledge number as the FIN flag consumes 1 byte
-    SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + 1
-    SendingPacket.assemble_stp_header()
-    sock.sendto(SendingPacket.raw, address)
-    utility.write_log("snd", SendingPacket, receiver_file_handler)
-
-    # Close the application that needs the TCP connection and wait for it to close
-    output_file_handler.close()
-
-    # Application has shut down, time to send the fin to the client.
-    SendingPacket.reset_flags()
-    SendingPacket.fin = True
-    SendingPacket.assemble_stp_header()
-    sock.sendto(SendingPacket.raw, address)
-    utility.write_log("snd", SendingPacket, receiver_file_handler)
-
-    # Receive the client's ACK to close the connection.
-    while True:
-        data, address = sock.recvfrom(1024)
-        utility.receiver_log_file_summary["segments_received_total"] += 1
-        if ReceivedPacket.break_raw_data(data):
-            utility.write_log("rcv", ReceivedPacket, receiver_file_handler)
-            break
-        else:
-            print("Received corrupted data. Ignore!")
-
-    print("Receiver successfully has closed the connection.\n")
-
-    for key, value in received_segments.items():
-        if value > 1:
-            utility.receiver_log_file_summary["segments_duplicate"] += 1
-
-    utility.write_receiver_summary(receiver_file_handler)
-    receiver_file_handler.close()
-    break
\ No newline at end of file
+        run_server()
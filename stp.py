@@ -0,0 +1,1544 @@
+#
+# STP as a library. Both ends of a transfer run on an asyncio event loop, so any number of transfers can share one
+# process, and sender.py and receiver.py are just command line front ends to this.
+#
+#   connection = await stp.connect("127.0.0.1", 5555, mws=5000, mss=500)
+#   await connection.send_file("file.pdf")
+#   connection.write(b"more data")
+#   await connection.drain()
+#   await connection.close()
+#
+#   server = await stp.start_server("127.0.0.1", 5555, paths)
+#
+# where paths(session_id, address) returns the output file, log and trace paths for each connection the server takes.
+# Both connect and start_server take a metrics.Registry as metrics=, to have every connection's counters and
+# histograms exported live.
+#
+# A big file can also be striped, split into ranges which are sent over connections of their own from a pool of
+# processes, and which the server writes back into the one file:
+#
+#   summaries = stp.send_striped("127.0.0.1", 5555, "file.pdf", 4, mws=5000, mss=500)
+#
+from colorama import Fore
+import asyncio
+import collections
+import multiprocessing
+import os
+import random
+import socket
+import utility
+import PLDModule
+import congestion
+
+DEFAULT_GAMMA = 4
+ALPHA = 0.125
+BETA = 0.25
+FAST_RETRANSMIT_THRESHOLD = 3
+MAX_TIMEOUT = 60
+# Now that every ACK gives us an RTT sample the estimate can be trusted, so the floor only has to cover the receiver
+# being slow to answer now and again.
+MIN_TIMEOUT = 0.2
+# The event loop may run a timer a little before it is due, anything this close counts as having gone off.
+TIMER_SLACK = 0.001
+
+# With delayed ACKs the receiver waits at most this long for the next segment before acknowledging the last one. It has
+# to stay well under MIN_TIMEOUT, as the sender counts the wait in its round trip times.
+ACK_DELAY = 0.04
+
+# How many times the SYN is sent again before we decide there is no receiver.
+SYN_RETRIES = 5
+
+# After the server sends its FIN it sends it again if it is not acknowledged, first after MIN_TIMEOUT and then twice
+# as long each time, up to this many times before giving up on the ACK. A sender whose FIN has been acknowledged waits
+# as long as all of that takes for the server's FIN, then closes without it.
+FIN_RETRIES = 4
+FIN_WAIT_2_TIMEOUT = MIN_TIMEOUT * 2 ** FIN_RETRIES
+
+# A connection we have not heard from in this many seconds is given up on, which has to be longer than the sender's
+# longest retransmission timeout.
+SESSION_TIMEOUT = 120
+
+# The states a sender goes through.
+SYN_SENT = 0
+ESTABLISHED = 1
+FIN_WAIT = 2
+FIN_WAIT_2 = 3
+CLOSED = 4
+
+# The states a connection to the server goes through.
+SYN_RECEIVED = 0
+LAST_ACK = 2
+
+
+class BytesSource:
+    # Data handed to STPConnection.write, with the same interface as utility.FileSource.
+    def __init__(self, data):
+        self._view = memoryview(bytes(data))
+
+    def __len__(self):
+        return len(self._view)
+
+    def segment(self, offset, length):
+        return self._view[offset:offset + length]
+
+    def release(self, offset):
+        pass
+
+    def close(self):
+        pass
+
+
+class SendBuffer:
+    # Everything written to a connection, as a run of files and byte strings one after the other. Offsets count from
+    # the first byte ever written. A segment never spans two parts so it may come back shorter than asked for, and a
+    # part is closed as soon as the receiver has acknowledged all of it.
+    def __init__(self):
+        self._parts = collections.deque()
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, source):
+        if len(source) == 0:
+            source.close()
+            return
+        self._parts.append((self._length, source))
+        self._length += len(source)
+
+    def segment(self, offset, length):
+        for start, source in self._parts:
+            if offset < start + len(source):
+                return source.segment(offset - start, min(length, start + len(source) - offset))
+        return b""
+
+    def release(self, offset):
+        while self._parts and self._parts[0][0] + len(self._parts[0][1]) <= offset:
+            start, source = self._parts.popleft()
+            source.close()
+        if self._parts:
+            start, source = self._parts[0]
+            source.release(offset - start)
+
+    def close(self):
+        while self._parts:
+            start, source = self._parts.popleft()
+            source.close()
+
+
+class RingTransport:
+    # Stands in for the transport create_datagram_endpoint would give a protocol, but receives every datagram into a
+    # utility.ReceiveRing with recvfrom_into, so the packets decode in place rather than the loop allocating a new bytes
+    # object for each one. The data handed to datagram_received is a view into the ring, which is only good until it
+    # returns, anything kept longer has to be copied.
+    def __init__(self, loop, sock, protocol):
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._ring = utility.ReceiveRing()
+        self._closing = False
+        loop.add_reader(sock.fileno(), self._read_ready)
+        # Straight away rather than from the loop, so whoever made us can close us as soon as we are returned.
+        protocol.connection_made(self)
+
+    def _read_ready(self):
+        # Take a ring's worth of whatever is waiting, then let the timers have a look in.
+        for _ in range(utility.RECEIVE_RING_SIZE):
+            if self._closing:
+                return
+            try:
+                data, address = self._ring.receive(self._sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self._protocol.error_received(exc)
+            else:
+                self._protocol.datagram_received(data, address)
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._loop.call_soon(self._close)
+
+    def _close(self):
+        try:
+            self._protocol.connection_lost(None)
+        finally:
+            self._sock.close()
+
+
+async def create_endpoint(loop, sock, protocol):
+    # Start protocol receiving on sock through a RingTransport, or the loop's own transport where the loop can not
+    # watch a socket for us, as with the proactor loop on Windows.
+    try:
+        RingTransport(loop, sock, protocol)
+    except NotImplementedError:
+        await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+
+
+class STPConnection(asyncio.DatagramProtocol):
+    # The sending end of a transfer, made by connect(). Data goes out as the window allows and is resent when the
+    # receiver tells us it is missing or the timer goes off, everything is driven by ACKs arriving and timers firing.
+    def __init__(self, loop, sock, address, max_win_size, max_seg_size, gamma, pld, congestion_control, sack,
+                 timestamps, checksums, file_size, stripe, log, metrics=None):
+        self._loop = loop
+        self.sock = sock
+        self.address = address
+        self.transport = None
+        self.state = SYN_SENT
+        self.max_win_size = max_win_size
+        self.max_seg_size = max_seg_size
+        self.gamma = gamma
+        self.file_size = file_size
+        self.stripe = stripe
+        self.log = log
+        self.summary = dict.fromkeys(utility.sender_log_file_summary, 0)
+        self.source = SendBuffer()
+        # Our entry in the metrics registry, if we were given one.
+        self.metrics = None
+        if metrics is not None:
+            labels = {"peer": "{}:{}".format(*address)}
+            if stripe is not None:
+                labels["stripe"] = stripe[1]
+            self.metrics = metrics.add("sender", labels, self.summary, self._metrics_gauges, loop.time())
+
+        # Every segment goes out through the PLD, which counts what it does to them in our summary.
+        self.pld = pld
+        pld.linked_socket = sock
+        pld.file_writer = log
+        pld.summary = self.summary
+
+        # What we ask the receiver for in the SYN, the SYN/ACK tells us what we actually got.
+        self.sack_requested = sack
+        self.timestamps_requested = timestamps
+        self.checksum_offer = list(checksums)
+        self.sack_enabled = False
+        self.timestamps_enabled = False
+        # How much the receiver is willing to take past its cumulative ACK, it tells us again in every ACK.
+        self.advertised_window = 0
+
+        self.estimated_rtt = 0.500
+        self.deviation_rtt = 0.250
+        self.rtt_sampled = False
+        # Doubled every time the timer goes off and back to 1 as soon as we get a fresh RTT sample.
+        self.rto_backoff = 1
+        self.syn_time = 0
+        self.syn_retransmitted = False
+        self.syn_retries = 0
+
+        self.SendingPacket = utility.STPPacket()
+        self.RetransPacket = utility.STPPacket()
+        self.ReceivedPacket = utility.STPPacket()
+
+        # NOTE TO SELF: packet_index refers to the index of the bytes in the data written to us. While oldest_index
+        # and all of the acknowledgement & sequence numbers are based off their own index. Hence, make sure when
+        # converting any of the ack/seq/oldest index, subtract it with starting_bias.
+        self.starting_bias = 0
+        self.packet_index = 0
+        self.oldest_flag = True
+        self.oldest_index = 0
+        self.oldest_time = 0
+
+        # When each segment was first sent and which ones have been sent more than once. These are only needed when
+        # we do not have timestamps, as by Karn's rule an ACK for a segment sent more than once can not be timed.
+        self.send_times = {}
+        self.retransmitted_segments = set()
+
+        self.retransmit_index = 0
+        self.retransmit_num = 0
+        self.retransmitting = False
+        self.informed_user = False
+
+        # The scoreboard remembers the length of every segment we have sent that the cumulative ACK has not covered
+        # yet, keyed by sequence number. When SACK is in use, the segments the receiver told us it is holding are
+        # marked so that on a loss we only resend the holes. Segments waiting to be resent are queued as (sequence
+        # number, fast) and always go out before any new data.
+        self.scoreboard = {}
+        self.sacked_segments = set()
+        self.fast_retransmitted = set()
+        self.retransmit_queue = collections.deque()
+
+        # The congestion window limits how much of MWS we actually use, and we never send past the receiver's window.
+        self.congestion_control_name = congestion_control
+        self.congestion_control = congestion.ALGORITHMS[congestion_control](max_seg_size, max_win_size)
+        self.remaining_window_space = max_win_size
+
+        # When the receiver's window is too small for the next segment and nothing is in flight, we send it an empty
+        # segment every probe_timeout seconds to find out when it opens again.
+        self.probe_time = None
+        self.probe_timeout = 0
+
+        # There is only ever one timer. It is moved earlier when it has to be, and when it goes off before the
+        # deadline has come round it just sets itself again, so an ACK pushing the deadline back costs nothing.
+        self._timer = None
+        self._timer_time = None
+        self._deadline = None
+
+        self._closing = False
+        self._error = None
+        self._established = loop.create_future()
+        self._closed = loop.create_future()
+        # (offset, future) for everyone waiting for the receiver to acknowledge up to offset.
+        self._waiters = []
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # The API.
+
+    def write(self, data):
+        # Queue data to be sent, it goes out as soon as the window allows.
+        if self._closing or self.state == CLOSED:
+            raise ConnectionError("The connection is closing.")
+        self.source.append(BytesSource(data))
+        self.summary["file_size"] = len(self.source)
+        self._pump()
+
+    async def drain(self):
+        # Wait until no more than MWS bytes of what has been written are still waiting to be acknowledged, which is
+        # enough to keep the window full.
+        await self._wait_acknowledged(len(self.source) - self.max_win_size)
+
+    async def send_file(self, path, offset=0, length=None):
+        # Send a file, or length bytes of it from offset, and wait until the receiver has all of it.
+        self.source.append(utility.FileSource(path, offset, length))
+        self.summary["file_size"] = len(self.source)
+        self._pump()
+        await self._wait_acknowledged(len(self.source))
+
+    async def close(self):
+        # Send everything that is left, then close the connection.
+        if self.state != CLOSED:
+            self._closing = True
+            self._pump()
+        await self._closed
+
+    def abort(self):
+        # Give up on the connection without telling the receiver.
+        self._shutdown(ConnectionAbortedError("The connection was aborted."))
+
+    # ---------------------------------------------------------------------------------------------------------------
+    # The protocol.
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._send_syn()
+
+    def connection_lost(self, exc):
+        if self.state != CLOSED:
+            self._shutdown(exc or ConnectionError("The socket was closed."))
+
+    def error_received(self, exc):
+        utility.console(utility.LOG_DEBUG, "Socket error: {}", exc, colour=Fore.LIGHTRED_EX)
+
+    def datagram_received(self, data, address):
+        if address != self.address or self.state == CLOSED:
+            return
+        if not self.ReceivedPacket.break_raw_data(data):
+            utility.console(utility.LOG_DEBUG, "Received packet was corrupted.")
+            return
+
+        if self.state == SYN_SENT:
+            self._receive_syn_ack()
+        elif self.state == ESTABLISHED:
+            # A SYN/ACK sent again because our SYN was, we already have what we need from it.
+            if not self.ReceivedPacket.syn:
+                self._receive_ack()
+                self._pump()
+        else:
+            self._receive_closing()
+
+    def timeout_time(self):
+        timeout_time = self.estimated_rtt + self.gamma * self.deviation_rtt
+        if timeout_time > MAX_TIMEOUT:
+            timeout_time = MAX_TIMEOUT
+        if timeout_time < MIN_TIMEOUT:
+            timeout_time = MIN_TIMEOUT
+        return min(timeout_time * self.rto_backoff, MAX_TIMEOUT)
+
+    def update_rtt(self, sample_rtt):
+        if self.rtt_sampled:
+            self.estimated_rtt = (1 - ALPHA) * self.estimated_rtt + ALPHA * sample_rtt
+            self.deviation_rtt = (1 - BETA) * self.deviation_rtt + BETA * abs(sample_rtt - self.estimated_rtt)
+        else:
+            # The first sample replaces the initial guess outright.
+            self.estimated_rtt = sample_rtt
+            self.deviation_rtt = sample_rtt / 2
+            self.rtt_sampled = True
+        self.rto_backoff = 1
+        if self.metrics is not None:
+            self.metrics.observe("rtt_seconds", sample_rtt)
+            self.metrics.observe("rto_seconds", self.timeout_time())
+        utility.console(utility.LOG_DEBUG, "RTT of: {}", sample_rtt, colour=Fore.GREEN)
+
+    def _metrics_gauges(self):
+        return {
+            "state": self.state,
+            "bytes_written": len(self.source),
+            "bytes_acked": self._acknowledged(),
+            "bytes_in_flight": self.SendingPacket.sequence_num - self.oldest_index,
+            "congestion_window_bytes": self.congestion_control.window(),
+            "advertised_window_bytes": self.advertised_window,
+            "srtt_seconds": self.estimated_rtt,
+            "timeout_seconds": self.timeout_time(),
+        }
+
+    def _send(self, stp_packet):
+        stp_packet.assemble_stp_header()
+        stp_packet.send(self.sock, self.address)
+        utility.write_log("snd", stp_packet, self.log)
+        self.summary["seg_transmitted"] += 1
+
+    def _send_syn(self):
+        # This is to send the syn connection packet (Initialise STP)
+        SendingPacket = self.SendingPacket
+        SendingPacket.reset_flags()
+        SendingPacket.syn = True
+        SendingPacket.sequence_num = 0
+        SendingPacket.window_size = self.max_win_size
+        SendingPacket.mss = self.max_seg_size
+        SendingPacket.sack_permitted = self.sack_requested
+        SendingPacket.checksum_offer = self.checksum_offer
+        SendingPacket.file_size = self.file_size
+        SendingPacket.stripe = self.stripe
+        if self.timestamps_requested:
+            SendingPacket.timestamp = utility.timestamp_now()
+        self._send(SendingPacket)
+        self.syn_time = self._loop.time()
+        utility.console(utility.LOG_INFO, "Sender is now waiting for an ACK reply from the server.")
+        self._set_timer(self.syn_time + self.timeout_time())
+
+    def _receive_syn_ack(self):
+        ReceivedPacket = self.ReceivedPacket
+        if not ReceivedPacket.ack:
+            # Junk packet, ignore. This should not happen in this assignment as per the rules.
+            return
+
+        utility.write_log("rcv", ReceivedPacket, self.log)
+        self.sack_enabled = self.sack_requested and ReceivedPacket.sack_permitted
+        self.advertised_window = ReceivedPacket.window_size
+        self.timestamps_enabled = self.timestamps_requested and ReceivedPacket.timestamp is not None
+        # The receiver tells us the largest segment it takes, which may be less than we asked for. One that does not
+        # send the option at all takes whatever we send it.
+        if ReceivedPacket.mss and ReceivedPacket.mss < self.max_seg_size:
+            utility.console(utility.LOG_WARNING, "The receiver takes segments of up to {} bytes, not {}.",
+                            ReceivedPacket.mss, self.max_seg_size)
+            self.max_seg_size = ReceivedPacket.mss
+            self.congestion_control = congestion.ALGORITHMS[self.congestion_control_name](self.max_seg_size,
+                                                                                          self.max_win_size)
+        # The handshake gives us our first RTT sample, unless we had to send the SYN again and can not tell which
+        # copy the SYN/ACK is for.
+        if self.timestamps_enabled:
+            self.update_rtt(utility.timestamp_age(ReceivedPacket.timestamp_echo))
+        elif not self.syn_retransmitted:
+            self.update_rtt(self._loop.time() - self.syn_time)
+
+        # The SYN/ACK tells us which checksum the receiver picked, everything from here on uses it.
+        SendingPacket = self.SendingPacket
+        if ReceivedPacket.checksum_offer:
+            SendingPacket.checksum_algorithm = ReceivedPacket.checksum_offer[0]
+            ReceivedPacket.checksum_algorithm = ReceivedPacket.checksum_offer[0]
+        SendingPacket.reset_flags()
+        SendingPacket.ack = True
+        SendingPacket.sequence_num = 1
+        SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + 1
+        # Send a packet to tell the server we received their acknowledgement packet
+        self._send(SendingPacket)
+
+        # ----------------------------------------------
+        # Connection established, time to send our data.
+        self.state = ESTABLISHED
+        self.starting_bias = SendingPacket.sequence_num
+        self.oldest_index = SendingPacket.sequence_num
+        self.RetransPacket.checksum_algorithm = SendingPacket.checksum_algorithm
+        self.remaining_window_space = min(self.congestion_control.window(), self.advertised_window)
+        self._cancel_timer()
+        self._established.set_result(None)
+        self._pump()
+
+    def _pump(self):
+        # Send whatever the window lets us, then set the timer for whatever we are waiting on.
+        if self.state != ESTABLISHED:
+            return
+
+        # Retransmissions are held to the window like anything else, bar the segment the receiver is waiting on,
+        # which always goes at once as nothing else can move the cumulative ACK.
+        room = min(self.congestion_control.window(), self.advertised_window) - self._pipe()
+        while self.retransmit_queue:
+            retransmit_seq, fast_retransmit = self.retransmit_queue[0]
+            if retransmit_seq not in self.scoreboard or retransmit_seq in self.sacked_segments:
+                self.retransmit_queue.popleft()
+                continue
+            segment_size = self.scoreboard[retransmit_seq]
+            if segment_size > room and retransmit_seq != self.oldest_index:
+                break
+            self.retransmit_queue.popleft()
+            self._retransmit(retransmit_seq, fast_retransmit)
+            room -= segment_size
+            self.remaining_window_space -= segment_size
+
+        SendingPacket = self.SendingPacket
+        while True:
+            segment_size = self.max_seg_size
+            if 0 < self.remaining_window_space < segment_size and SendingPacket.sequence_num == self.oldest_index:
+                # The window is smaller than a segment and nothing is in flight, so no ACK is coming to open it any
+                # further. Send what fits rather than probe forever.
+                segment_size = self.remaining_window_space
+            file_bytes = self.source.segment(self.packet_index, segment_size)
+            if not self.remaining_window_space >= len(file_bytes) != 0:
+                break
+            utility.console(utility.LOG_DEBUG, "We are going to send bytes from {} to {}.", self.packet_index,
+                            self.packet_index + len(file_bytes))
+            utility.console(utility.LOG_DEBUG, "Sequence number: {}", SendingPacket.sequence_num)
+            # We still have space to send packets. Send it through.
+            self.probe_time = None
+            SendingPacket.reset_flags()
+            SendingPacket.payload = file_bytes
+            if self.timestamps_enabled:
+                SendingPacket.timestamp = utility.timestamp_now()
+            SendingPacket.assemble_stp_header()
+
+            self.pld.send_data(SendingPacket, self.address[0], self.address[1], self.retransmitting)
+            self.summary["seg_transmitted"] += 1
+            self.scoreboard[SendingPacket.sequence_num] = len(file_bytes)
+            # After going back to resend, the segments we send again are already in here.
+            if SendingPacket.sequence_num in self.send_times:
+                self.retransmitted_segments.add(SendingPacket.sequence_num)
+                if self.metrics is not None:
+                    self.metrics.observe("retransmission_gap_seconds",
+                                         self._loop.time() - self.send_times[SendingPacket.sequence_num])
+            else:
+                self.send_times[SendingPacket.sequence_num] = self._loop.time()
+            self.retransmitting = False
+
+            # If this is the first packet to be sent in the window, remember when it went.
+            if self.oldest_flag:
+                self.oldest_flag = False
+                self.oldest_time = self._loop.time()
+
+            # Prepare the next packet's reserved space.
+            SendingPacket.sequence_num = SendingPacket.sequence_num + len(file_bytes)
+            self.remaining_window_space -= len(file_bytes)
+            self.packet_index += len(file_bytes)
+            utility.console(utility.LOG_DEBUG, "We have {} bytes left in the window.\n",
+                            self.remaining_window_space, colour=Fore.CYAN)
+
+        if len(file_bytes) > 0:
+            # We ran out of space, time to wait for the server to send the ACK
+            if not self.informed_user:
+                utility.console(utility.LOG_DEBUG, "Ran out of window space. Wait for server's ACKs.",
+                                colour=Fore.YELLOW)
+                self.informed_user = True
+        elif SendingPacket.sequence_num == self.oldest_index:
+            # Everything written to us has arrived.
+            self._cancel_timer()
+            if self._closing:
+                utility.console(utility.LOG_INFO, "All data received. Stopping ...", colour=Fore.GREEN)
+                self._send_fin()
+            return
+        elif not self.informed_user:
+            utility.console(utility.LOG_INFO, "Finished sending data. Waiting to verify arrival of data.",
+                            colour=Fore.YELLOW)
+            self.informed_user = True
+
+        if len(file_bytes) > 0 and SendingPacket.sequence_num == self.oldest_index:
+            # Nothing is in flight, so no ACK is going to come along and open the window. Probe it instead.
+            if self.probe_time is None:
+                self.probe_time = self._loop.time()
+                self.probe_timeout = self.timeout_time()
+            self._set_timer(self.probe_time + self.probe_timeout)
+        else:
+            # The retransmission deadline is measured from when the oldest segment in the window was sent.
+            self._set_timer(self.oldest_time + self.timeout_time())
+
+    def _pipe(self):
+        # The bytes we take to still be in the network: everything sent and not cumulatively acknowledged, less what
+        # the receiver has SACKed and the holes waiting in the retransmit queue, which are taken to be lost.
+        pipe = self.SendingPacket.sequence_num - self.oldest_index
+        for sequence_num in self.sacked_segments:
+            pipe -= self.scoreboard[sequence_num]
+        for sequence_num, _ in self.retransmit_queue:
+            if sequence_num in self.scoreboard and sequence_num not in self.sacked_segments:
+                pipe -= self.scoreboard[sequence_num]
+        return pipe
+
+    def _retransmit(self, retransmit_seq, fast_retransmit):
+        utility.console(utility.LOG_DEBUG, "Retransmitting sequence number: {}", retransmit_seq,
+                        colour=Fore.LIGHTRED_EX)
+        RetransPacket = self.RetransPacket
+        RetransPacket.reset_flags()
+        RetransPacket.sequence_num = retransmit_seq
+        RetransPacket.acknowledge_num = self.SendingPacket.acknowledge_num
+        RetransPacket.window_size = self.max_win_size
+        RetransPacket.payload = self.source.segment(retransmit_seq - self.starting_bias,
+                                                    self.scoreboard[retransmit_seq])
+        if self.timestamps_enabled:
+            RetransPacket.timestamp = utility.timestamp_now()
+        RetransPacket.assemble_stp_header()
+        self.pld.send_data(RetransPacket, self.address[0], self.address[1], True)
+        self.summary["seg_transmitted"] += 1
+        if fast_retransmit:
+            self.summary["retrans_fast"] += 1
+        if self.metrics is not None and retransmit_seq in self.send_times:
+            self.metrics.observe("retransmission_gap_seconds", self._loop.time() - self.send_times[retransmit_seq])
+
+        self.retransmitted_segments.add(retransmit_seq)
+        if self.oldest_flag:
+            self.oldest_flag = False
+            self.oldest_time = self._loop.time()
+
+    def _probe(self):
+        utility.console(utility.LOG_DEBUG, "The receiver's window is closed, probing it.", colour=Fore.YELLOW)
+        RetransPacket = self.RetransPacket
+        RetransPacket.reset_flags()
+        RetransPacket.ack = True
+        RetransPacket.sequence_num = self.SendingPacket.sequence_num
+        RetransPacket.acknowledge_num = self.SendingPacket.acknowledge_num
+        RetransPacket.window_size = self.max_win_size
+        RetransPacket.payload = bytearray(0)
+        if self.timestamps_enabled:
+            RetransPacket.timestamp = utility.timestamp_now()
+        self._send(RetransPacket)
+        # Back off while the window stays closed.
+        self.probe_time = self._loop.time()
+        self.probe_timeout = min(self.probe_timeout * 2, MAX_TIMEOUT)
+
+    def _timed_out(self):
+        # We timed out, resend the packet that the server is expecting.
+        utility.console(utility.LOG_DEBUG, "Timed out, unable to establish a connection.", colour=Fore.LIGHTRED_EX)
+        SendingPacket = self.SendingPacket
+        self.summary["retrans_timeout"] += 1
+        if self.timeout_time() < MAX_TIMEOUT:
+            self.rto_backoff *= 2
+        if self.metrics is not None:
+            self.metrics.observe("rto_seconds", self.timeout_time())
+        self.congestion_control.on_timeout(SendingPacket.sequence_num - self.oldest_index, SendingPacket.sequence_num,
+                                           self._loop.time())
+        self.retransmit_queue.clear()
+        self.fast_retransmitted.clear()
+        self.oldest_flag = True
+        if self.sack_enabled:
+            # The receiver is holding everything it has SACKed, so only the holes need to go again. If there are
+            # none, the ACK covering them must have been lost, so nudge it with the oldest.
+            for sequence_num in sorted(self.scoreboard):
+                if sequence_num not in self.sacked_segments:
+                    self.retransmit_queue.append((sequence_num, False))
+            if not self.retransmit_queue:
+                self.retransmit_queue.append((self.oldest_index, False))
+            self.remaining_window_space = min(self.congestion_control.window(), self.advertised_window) - \
+                (SendingPacket.sequence_num - self.oldest_index)
+        else:
+            self.remaining_window_space = min(self.packet_index - (self.oldest_index - self.starting_bias),
+                                              self.congestion_control.window(), self.advertised_window)
+            self.packet_index = self.oldest_index - self.starting_bias
+            SendingPacket.sequence_num = self.oldest_index
+            self.retransmitting = True
+
+    def _receive_ack(self):
+        ReceivedPacket = self.ReceivedPacket
+        SendingPacket = self.SendingPacket
+        self.informed_user = False
+
+        # Mark everything the receiver says it is holding, whether or not this ACK moves the window.
+        for sack_start, sack_end in ReceivedPacket.sack_blocks:
+            sequence_num = sack_start
+            while sequence_num < sack_end and sequence_num in self.scoreboard:
+                self.sacked_segments.add(sequence_num)
+                sequence_num += self.scoreboard[sequence_num]
+
+        # We received a packet, check it against the oldest index. We will only process the packet if it is younger
+        # than the oldest index on record. By doing this, if one of the packets is lost midway, we still are able to
+        # proceed.
+        if ReceivedPacket.acknowledge_num > self.oldest_index:
+            utility.write_log("rcv", ReceivedPacket, self.log)
+            self.retransmit_num = 0
+            self.retransmit_index = ReceivedPacket.acknowledge_num
+            utility.console(utility.LOG_DEBUG, "Received acknowledgement of, {}", ReceivedPacket.acknowledge_num,
+                            colour=Fore.GREEN)
+            if self.timestamps_enabled and ReceivedPacket.timestamp is not None:
+                # The echo is the timestamp of the very copy that moved the ACK along, so every ACK can be timed,
+                # even the ones for retransmissions.
+                self.update_rtt(utility.timestamp_age(ReceivedPacket.timestamp_echo))
+            elif self.oldest_index in self.send_times and self.oldest_index not in self.retransmitted_segments:
+                # The segment that moves the cumulative ACK along is the one the receiver was waiting for. If we sent
+                # it more than once we can not tell which copy this is for, so it is not timed.
+                self.update_rtt(self._loop.time() - self.send_times[self.oldest_index])
+
+            # Everything below the cumulative ACK has arrived, drop it from the scoreboard.
+            for sequence_num in [s for s in self.scoreboard if s < ReceivedPacket.acknowledge_num]:
+                del self.scoreboard[sequence_num]
+                self.sacked_segments.discard(sequence_num)
+                self.fast_retransmitted.discard(sequence_num)
+                self.send_times.pop(sequence_num, None)
+                self.retransmitted_segments.discard(sequence_num)
+
+            self.congestion_control.on_ack(ReceivedPacket.acknowledge_num - self.oldest_index,
+                                           ReceivedPacket.acknowledge_num, self._loop.time())
+
+            # The receiver buffers out of order segments, so after a retransmission its cumulative ACK can jump past
+            # where we are currently sending from. Skip ahead rather than resend what it has.
+            if ReceivedPacket.acknowledge_num > SendingPacket.sequence_num:
+                SendingPacket.sequence_num = ReceivedPacket.acknowledge_num
+                self.packet_index = ReceivedPacket.acknowledge_num - self.starting_bias
+            self.source.release(ReceivedPacket.acknowledge_num - self.starting_bias)
+            # Now that we received an acknowledgement, slide the window space up
+            self.advertised_window = ReceivedPacket.window_size
+            self.remaining_window_space = min(self.congestion_control.window(), self.advertised_window) - \
+                (SendingPacket.sequence_num - ReceivedPacket.acknowledge_num)
+            utility.console(utility.LOG_DEBUG, "Congestion window is {} bytes.", self.congestion_control.window())
+            # Since we received an ACK and we slide the window up.
+            self.oldest_index = ReceivedPacket.acknowledge_num
+            self.oldest_flag = True
+            # Whatever is still in flight gets a full timeout from now.
+            self.oldest_time = self._loop.time()
+            if self.metrics is not None:
+                self.metrics.observe("window_occupancy_bytes", SendingPacket.sequence_num - self.oldest_index)
+                self.metrics.sample_rate(self.oldest_time, self._acknowledged())
+            self._wake_waiters()
+            return
+
+        utility.console(utility.LOG_DEBUG, "Received old packet with acknowledge of, {}. Ignore.",
+                        ReceivedPacket.acknowledge_num, colour=Fore.RED)
+        if ReceivedPacket.acknowledge_num == self.oldest_index:
+            # The ACK does not move the window along, but the receiver may have changed its size.
+            self.advertised_window = ReceivedPacket.window_size
+            self.remaining_window_space = min(self.congestion_control.window(), self.advertised_window) - \
+                (SendingPacket.sequence_num - self.oldest_index)
+
+        if SendingPacket.sequence_num == self.oldest_index:
+            # Nothing is in flight, so this is the answer to a window probe rather than a duplicate.
+            utility.write_log("rcv", ReceivedPacket, self.log)
+        elif self.retransmit_index == ReceivedPacket.acknowledge_num:
+            utility.write_log("rcv/DA", ReceivedPacket, self.log)
+            self.summary["dup_acks"] += 1
+            self.retransmit_num += 1
+            if self.retransmit_num >= FAST_RETRANSMIT_THRESHOLD:
+                utility.console(utility.LOG_DEBUG, "Looks like we need to retransmit, {}.",
+                                ReceivedPacket.acknowledge_num, colour=Fore.LIGHTRED_EX)
+                self.congestion_control.on_fast_retransmit(SendingPacket.sequence_num - self.oldest_index,
+                                                           ReceivedPacket.acknowledge_num, SendingPacket.sequence_num,
+                                                           self._loop.time())
+                if self.sack_enabled:
+                    # Every segment below the highest one the receiver holds that it has not SACKed is a hole. Each
+                    # hole is only fast retransmitted once, if that copy is lost as well we leave it to the timeout.
+                    highest_sacked = max(self.sacked_segments, default=ReceivedPacket.acknowledge_num)
+                    for sequence_num in sorted(self.scoreboard):
+                        if sequence_num > highest_sacked:
+                            break
+                        if sequence_num not in self.sacked_segments and sequence_num not in self.fast_retransmitted:
+                            self.fast_retransmitted.add(sequence_num)
+                            self.retransmit_queue.append((sequence_num, True))
+                else:
+                    # We have hit the fast retransmit threshold, go back to this acknowledge number and start
+                    # resending the packets.
+                    self.retransmit_queue.append((ReceivedPacket.acknowledge_num, True))
+                self.retransmit_num = 0
+        else:
+            self.retransmit_num = 0
+            self.retransmit_index = ReceivedPacket.acknowledge_num
+            utility.write_log("rcv", ReceivedPacket, self.log)
+
+    def _send_fin(self):
+        # We finished sending, now to close it.
+        utility.console(utility.LOG_INFO, "Closing the connection.")
+        SendingPacket = self.SendingPacket
+        SendingPacket.reset_flags()
+        SendingPacket.fin = True
+        SendingPacket.payload = bytearray(0)
+        self._send(SendingPacket)
+        self.state = FIN_WAIT
+        self._set_timer(self._loop.time() + self.timeout_time())
+
+    def _receive_closing(self):
+        ReceivedPacket = self.ReceivedPacket
+        SendingPacket = self.SendingPacket
+        utility.write_log("rcv", ReceivedPacket, self.log)
+        if self.state == FIN_WAIT:
+            # The FIN consumes a byte, so it is acknowledged with the sequence number after it. If that ACK went
+            # missing, the server's FIN tells us just as well.
+            if ReceivedPacket.acknowledge_num == SendingPacket.sequence_num + 1 or ReceivedPacket.fin:
+                utility.console(utility.LOG_DEBUG, "Received acknowledgement of, {}", ReceivedPacket.acknowledge_num)
+                SendingPacket.sequence_num += 1
+                self.state = FIN_WAIT_2
+                # The server sends its FIN again if this one is lost, but if it has gone away we would wait forever.
+                self._cancel_timer()
+                self._set_timer(self._loop.time() + FIN_WAIT_2_TIMEOUT)
+            else:
+                utility.console(utility.LOG_DEBUG, "Received acknowledgement of, {}. Not in sync, discard.",
+                                ReceivedPacket.acknowledge_num, colour=Fore.RED)
+                return
+
+        if self.state == FIN_WAIT_2 and ReceivedPacket.fin:
+            # Send the ACK back. We are adding one byte to the acknowledge number as the FIN flag consumes 1 byte
+            SendingPacket.reset_flags()
+            SendingPacket.ack = True
+            SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + 1
+            self._send(SendingPacket)
+            utility.console(utility.LOG_INFO, "Connection successfully closed.")
+            self._shutdown(None)
+
+    def _set_timer(self, deadline):
+        self._deadline = deadline
+        if self._timer is not None and self._timer_time <= deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_time = deadline
+        self._timer = self._loop.call_at(deadline, self._on_timer)
+
+    def _cancel_timer(self):
+        self._deadline = None
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self):
+        self._timer = None
+        if self._deadline is None:
+            return
+        if self._deadline - self._loop.time() > TIMER_SLACK:
+            self._set_timer(self._deadline)
+            return
+        self._deadline = None
+
+        if self.state == SYN_SENT:
+            if self.syn_retries == SYN_RETRIES:
+                self._shutdown(TimeoutError("The receiver did not answer our SYN."))
+                return
+            self.syn_retries += 1
+            self.syn_retransmitted = True
+            self.rto_backoff *= 2
+            self._send_syn()
+        elif self.state == ESTABLISHED:
+            if self.packet_index < len(self.source) and self.SendingPacket.sequence_num == self.oldest_index:
+                self._probe()
+            else:
+                self._timed_out()
+            self._pump()
+        elif self.state == FIN_WAIT:
+            self.rto_backoff *= 2
+            self.SendingPacket.assemble_stp_header()
+            self._send(self.SendingPacket)
+            self._set_timer(self._loop.time() + self.timeout_time())
+        elif self.state == FIN_WAIT_2:
+            # Everything we sent was acknowledged, so all we are missing is the server saying goodbye.
+            utility.console(utility.LOG_WARNING, "Gave up waiting for the receiver's FIN, closing the connection.")
+            self._shutdown(None)
+
+    def _acknowledged(self):
+        return self.oldest_index - self.starting_bias
+
+    async def _wait_acknowledged(self, offset):
+        if self._error is not None:
+            raise self._error
+        if self._acknowledged() >= offset:
+            return
+        waiter = self._loop.create_future()
+        self._waiters.append((offset, waiter))
+        await waiter
+
+    def _wake_waiters(self):
+        acknowledged = self._acknowledged()
+        waiting = []
+        for offset, waiter in self._waiters:
+            if waiter.done():
+                continue
+            if offset <= acknowledged:
+                waiter.set_result(None)
+            else:
+                waiting.append((offset, waiter))
+        self._waiters = waiting
+
+    def _shutdown(self, error):
+        if self.state == CLOSED:
+            return
+        self.state = CLOSED
+        self._error = error or ConnectionError("The connection is closed.")
+        self._cancel_timer()
+        # Anything the PLD is still holding back is of no use to the receiver now.
+        self.pld.close()
+        if self.transport is not None:
+            self.transport.close()
+        self.source.close()
+
+        utility.write_sender_summary(self.log, self.summary)
+        self.log.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
+        for offset, waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_exception(self._error)
+        self._waiters = []
+        if not self._established.done():
+            self._established.set_exception(self._error)
+        if error is None:
+            self._closed.set_result(None)
+        else:
+            self._closed.set_exception(error)
+
+
+async def connect(host, port, mws, mss, gamma=DEFAULT_GAMMA, pld=None, congestion_control="none", sack=True,
+                  timestamps=True, checksums=(), file_size=0, stripe=None, log_path="Sender_log.txt",
+                  trace_path="Sender_trace.bin", trace=False, metrics=None, receive_buffer=0, send_buffer=0, loop=None):
+    # Open a connection to the receiver at host and port. pld is a PLDModule.PLDModule to put the segments through,
+    # by default one that leaves them alone. file_size, if known, lets the receiver reserve the space up front. stripe
+    # is (transfer id, offset, length, number of stripes) for one connection of a striped transfer. metrics is a
+    # metrics.Registry to export the connection's metrics through. receive_buffer and send_buffer set the socket's
+    # buffer sizes, by default the send buffer is made big enough for a whole window.
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    if congestion_control not in congestion.ALGORITHMS:
+        raise ValueError("Unknown congestion control {}, choose from {}.".format(
+            congestion_control, ", ".join(congestion.ALGORITHMS)))
+    for name in checksums:
+        if name not in utility.CHECKSUM_ALGORITHMS:
+            raise ValueError("Unknown checksum {}, choose from {}.".format(
+                name, ", ".join(utility.CHECKSUM_ALGORITHMS)))
+
+    if mss > utility.MAX_SEGMENT_SIZE:
+        utility.console(utility.LOG_WARNING, "An MSS of {} does not fit in a UDP datagram, using {}.",
+                        mss, utility.MAX_SEGMENT_SIZE)
+        mss = utility.MAX_SEGMENT_SIZE
+
+    addresses = await loop.getaddrinfo(host, port, family=socket.AF_INET, type=socket.SOCK_DGRAM)
+    address = addresses[0][4]
+    if pld is None:
+        pld = PLDModule.PLDModule()
+
+    # We make the socket ourselves so the PLD can send on it from its own thread.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    # The PLD sends straight on the socket, so it has to be able to take a whole window at once.
+    utility.set_socket_buffer(sock, socket.SO_SNDBUF, send_buffer or utility.window_buffer_size(mws, mss),
+                              grow_only=not send_buffer)
+    if receive_buffer:
+        utility.set_socket_buffer(sock, socket.SO_RCVBUF, receive_buffer)
+    log = utility.BinaryTrace(trace_path) if trace else utility.EventLog(log_path)
+    log.start_clock()
+    connection = STPConnection(loop, sock, address, mws, mss, gamma, pld, congestion_control, sack, timestamps,
+                               checksums, file_size, stripe, log, metrics)
+    try:
+        await create_endpoint(loop, sock, connection)
+        await connection._established
+    except BaseException:
+        # Cancelled, timed out or refused, so stop sending SYNs and let go of the socket and the log. Nobody will be
+        # waiting for this connection to close.
+        connection.abort()
+        if connection.transport is None:
+            sock.close()
+        if not connection._closed.cancelled():
+            connection._closed.exception()
+        raise
+    return connection
+
+
+async def send_range(host, port, path, offset=0, length=None, **kwargs):
+    # Send a file, or length bytes of it from offset, over a connection of its own. The keyword arguments are passed
+    # on to connect. Returns the connection's summary.
+    connection = await connect(host, port, **kwargs)
+    await connection.send_file(path, offset, length)
+    await connection.close()
+    return connection.summary
+
+
+def send_stripe(job):
+    # Runs in a worker process of send_striped.
+    console_level, host, port, path, offset, length, kwargs = job
+    utility.start_console(console_level, background=False)
+    return asyncio.run(send_range(host, port, path, offset, length, **kwargs))
+
+
+def send_striped(host, port, path, stripes, plds=None, log_path="Sender_log.txt", trace_path="Sender_trace.bin",
+                 **kwargs):
+    # Split a file into stripes ranges and send each over its own connection from a pool of as many processes, so no
+    # one process has to checksum, log and keep the window for the whole file. plds gives every stripe its own
+    # PLDModule.PLDModule. Each stripe writes its own log, named after log_path or trace_path with the stripe number
+    # added. The other keyword arguments are passed on to connect. Returns the summary of every stripe.
+    file_size = os.path.getsize(path)
+    stripes = max(min(stripes, file_size), 1)
+    stripe_size = -(-file_size // stripes)
+    # Tells the server which connections belong to the same file.
+    transfer_id = random.getrandbits(32)
+
+    jobs = []
+    for index in range(stripes):
+        offset = index * stripe_size
+        name, extension = os.path.splitext(log_path)
+        trace_name, trace_extension = os.path.splitext(trace_path)
+        length = min(stripe_size, file_size - offset)
+        stripe_kwargs = dict(kwargs, file_size=file_size, stripe=(transfer_id, offset, length, stripes),
+                             log_path="{}-{}{}".format(name, index + 1, extension),
+                             trace_path="{}-{}{}".format(trace_name, index + 1, trace_extension))
+        if plds is not None:
+            stripe_kwargs["pld"] = plds[index]
+        jobs.append((utility.console_level, host, port, path, offset, length, stripe_kwargs))
+
+    pool = multiprocessing.Pool(stripes)
+    try:
+        return pool.map(send_stripe, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class StripedOutput:
+    # The one file every connection of a striped transfer writes its own range of. The file is made its full size
+    # up front, and each stripe then writes its range in place. It is never truncated, as stripes may be written by
+    # other servers sharing the port with us.
+    def __init__(self, path, file_size):
+        self.path = path
+        self.open_sessions = 0
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0))
+        try:
+            os.ftruncate(fd, file_size)
+        finally:
+            os.close(fd)
+
+
+class ReceiverSession:
+    # Everything the server knows about one connection. The server hands it every datagram that comes from its sender.
+    def __init__(self, server, session_id, address, output_path, log_path, trace_path):
+        self.server = server
+        self.session_id = session_id
+        self.address = address
+        self.output_path = output_path
+        self.state = SYN_RECEIVED
+        self.last_heard = server.loop.time()
+
+        self.SendingPacket = utility.STPPacket()
+        self.checksum_algorithm = utility.DEFAULT_CHECKSUM
+        self.log = utility.BinaryTrace(trace_path) if server.trace else utility.EventLog(log_path)
+        self.log.start_clock()
+        self.summary = dict.fromkeys(utility.receiver_log_file_summary, 0)
+        self.received_segments = {}
+        self.metrics = None
+        if server.metrics is not None:
+            self.metrics = server.metrics.add("receiver", {"session": session_id, "peer": "{}:{}".format(*address)},
+                                              self.summary, self._metrics_gauges, self.last_heard)
+
+        # Segments which arrived ahead of the one we are expecting are written straight to their place in the output
+        # file, and their lengths are remembered here, keyed by their sequence number, until the gap in front of them
+        # is filled. We only take as many as the sender's maximum window size which it tells us in the SYN, as the
+        # sender can never have more than that many bytes in flight past our cumulative ACK.
+        self.reassembly_buffer = {}
+        self.reassembly_buffer_bytes = 0
+        self.reassembly_window = 0
+        self.expected_file_size = 0
+        self.expected_data_size = 0
+        self.output_file = None
+        self.starting_bias = 0
+
+        # For one stripe of a striped transfer, the file all the stripes go into and the (transfer id, offset,
+        # length, number of stripes) from the SYN.
+        self.striped_output = None
+        self.stripe = None
+
+        # Selective acknowledgements are only used if the sender asked for them in its SYN.
+        self.sack_enabled = False
+
+        # If the sender asked for timestamps, every ACK echoes the timestamp of the last segment that moved our
+        # cumulative ACK along (or would have, for a window probe). Out of order segments do not change it, so a
+        # duplicate ACK still echoes the segment before the gap.
+        self.timestamps_enabled = False
+        self.recent_timestamp = 0
+
+        # With delayed ACKs, how many in order segments and bytes have arrived since we last sent anything, and the
+        # timer that acknowledges them if no more come along.
+        self.ack_pending = 0
+        self.ack_pending_bytes = 0
+        self._ack_timer = None
+
+        # Once we have sent our FIN, the timer that sends it again until the sender acknowledges it, and how many more
+        # times it may go.
+        self._fin_timer = None
+        self.fin_timeout = MIN_TIMEOUT
+        self.fin_retries = FIN_RETRIES
+
+    def join_stripes(self, striped_output, stripe):
+        self.striped_output = striped_output
+        self.stripe = stripe
+        self.output_path = striped_output.path
+        striped_output.open_sessions += 1
+
+    def _metrics_gauges(self):
+        return {
+            "state": self.state,
+            "reassembly_buffer_bytes": self.reassembly_buffer_bytes,
+            "advertised_window_bytes": self.advertised_window(),
+        }
+
+    def advertised_window(self):
+        # Out of order segments already sit inside the window, so only data still waiting to reach the disk closes it.
+        if self.output_file is None:
+            return self.reassembly_window
+        return min(self.reassembly_window, self.output_file.free_space())
+
+    def add_timestamp(self, stp_packet):
+        if self.timestamps_enabled:
+            stp_packet.timestamp = utility.timestamp_now()
+            stp_packet.timestamp_echo = self.recent_timestamp
+
+    def build_sack_blocks(self, most_recent_sequence):
+        # Merge the buffered segments into contiguous (start, end) ranges. The block holding the segment that just
+        # arrived goes first so the sender always learns about the latest arrival, even if we have more blocks than
+        # fit.
+        blocks = []
+        for sequence_num in sorted(self.reassembly_buffer):
+            end = sequence_num + self.reassembly_buffer[sequence_num]
+            if blocks and blocks[-1][1] == sequence_num:
+                blocks[-1][1] = end
+            else:
+                blocks.append([sequence_num, end])
+
+        blocks = [(start, end) for start, end in blocks]
+        for index, (start, end) in enumerate(blocks):
+            if start <= most_recent_sequence < end:
+                blocks.insert(0, blocks.pop(index))
+                break
+        return blocks[:utility.MAX_SACK_BLOCKS]
+
+    def send(self, event):
+        # Whatever we send acknowledges everything so far, so a delayed ACK is not needed any more.
+        if self.ack_pending:
+            self.cancel_delayed_ack()
+        self.SendingPacket.assemble_stp_header()
+        self.SendingPacket.send(self.server.sock, self.address)
+        utility.write_log(event, self.SendingPacket, self.log)
+
+    def send_ack(self, event, most_recent_sequence):
+        SendingPacket = self.SendingPacket
+        SendingPacket.reset_flags()
+        SendingPacket.ack = True
+        SendingPacket.window_size = self.advertised_window()
+        self.add_timestamp(SendingPacket)
+        if self.sack_enabled:
+            SendingPacket.sack_blocks = self.build_sack_blocks(most_recent_sequence)
+        self.send(event)
+
+    def delay_ack(self, ReceivedPacket, filled_gap):
+        # Called for every in order segment once it is in the file. Every segment is acknowledged at once unless the
+        # server was asked to delay them, in which case an ACK goes out every ack_every segments, or ACK_DELAY
+        # after the first one that has not been, whichever is sooner. Anything to do with a gap is still acknowledged
+        # at once so the sender finds out about losses as quickly as ever, as is the end of the file, and we never
+        # sit on half the window as the sender may be waiting for it.
+        self.ack_pending += 1
+        self.ack_pending_bytes += len(ReceivedPacket.payload)
+        if self.ack_pending >= self.server.ack_every or filled_gap or self.reassembly_buffer or \
+                self.ack_pending_bytes * 2 >= self.reassembly_window or \
+                self.summary["data_received"] == self.expected_data_size:
+            utility.console(utility.LOG_DEBUG, "Data looks good. Sending packet with ACK {}\n",
+                            self.SendingPacket.acknowledge_num, colour=Fore.GREEN)
+            self.send_ack("snd", ReceivedPacket.sequence_num)
+        elif self._ack_timer is None:
+            self._ack_timer = self.server.loop.call_later(self.server.ack_delay, self.send_delayed_ack)
+
+    def send_delayed_ack(self):
+        self._ack_timer = None
+        if self.state == ESTABLISHED and self.ack_pending:
+            self.send_ack("snd", self.SendingPacket.acknowledge_num)
+
+    def cancel_delayed_ack(self):
+        self.ack_pending = 0
+        self.ack_pending_bytes = 0
+        if self._ack_timer is not None:
+            self._ack_timer.cancel()
+            self._ack_timer = None
+
+    def receive_corrupted(self, ReceivedPacket):
+        self.last_heard = self.server.loop.time()
+        if self.state == ESTABLISHED:
+            utility.console(utility.LOG_DEBUG, "Received ACK packet was corrupted. Trying again ...\n",
+                            colour=Fore.LIGHTRED_EX)
+            # sock.sendto(SendingPacket.raw, address)
+            # utility.write_log("snd/DA", SendingPacket, "Receiver_log.txt")
+            utility.write_log("rcv/corr", ReceivedPacket, self.log)
+            self.summary["segments_received_total"] += 1
+            self.summary["segments_corrupt"] += 1
+        else:
+            if self.state == LAST_ACK:
+                self.summary["segments_received_total"] += 1
+            utility.console(utility.LOG_DEBUG, "Received packet was corrupted.")
+
+    def receive(self, ReceivedPacket):
+        self.last_heard = self.server.loop.time()
+        utility.write_log("rcv", ReceivedPacket, self.log)
+        self.summary["segments_received_total"] += 1
+
+        if ReceivedPacket.syn:
+            if self.state == SYN_RECEIVED:
+                # Our SYN/ACK may have gone missing, so answer it again.
+                self.receive_syn(ReceivedPacket)
+            else:
+                # A duplicate or reordered copy of the SYN we started with. Starting over would throw away the file.
+                utility.console(utility.LOG_DEBUG, "Received an old SYN, ignore.", colour=Fore.RED)
+        elif self.state == SYN_RECEIVED:
+            # Now we have the client's ACK. If it went missing the first data segment tells us just as well.
+            utility.console(utility.LOG_INFO, "Received the ACK, establish the connection.")
+            self.establish()
+            if len(ReceivedPacket.payload) > 0 or ReceivedPacket.fin:
+                self.receive_established(ReceivedPacket)
+        elif self.state == ESTABLISHED:
+            self.receive_established(ReceivedPacket)
+        elif self.state == LAST_ACK:
+            if ReceivedPacket.fin:
+                # The sender sent its FIN again, so it missed our ACK and perhaps our FIN as well.
+                self.receive_fin(ReceivedPacket)
+            elif ReceivedPacket.acknowledge_num == self.SendingPacket.sequence_num + 1:
+                # The client's ACK of our FIN, the connection is closed.
+                utility.console(utility.LOG_INFO, "Receiver successfully has closed the connection.\n")
+                self.close()
+
+    def receive_syn(self, ReceivedPacket):
+        # Get the syn packet, return it with an ACK.
+        utility.console(utility.LOG_INFO, "Received syn. Reply with ACK.")
+        self.reassembly_window = self.server.receive_window or ReceivedPacket.window_size
+        self.expected_file_size = ReceivedPacket.file_size
+        self.expected_data_size = ReceivedPacket.file_size
+        if self.stripe is not None:
+            # Only our stripe comes over this connection.
+            self.expected_data_size = self.stripe[2]
+        self.sack_enabled = ReceivedPacket.sack_permitted
+        self.timestamps_enabled = ReceivedPacket.timestamp is not None
+        self.recent_timestamp = ReceivedPacket.timestamp or 0
+
+        # The SYN may have been resent because our SYN/ACK went missing, so start the SYN/ACK from scratch.
+        SendingPacket = self.SendingPacket
+        SendingPacket.sequence_num = 0
+        SendingPacket.checksum_algorithm = utility.DEFAULT_CHECKSUM
+        SendingPacket.reset_flags()
+        SendingPacket.syn = True
+        SendingPacket.ack = True
+        SendingPacket.sack_permitted = self.sack_enabled
+        # A sender that tells us the segment size it wants gets told how much of it we take, and our socket is made
+        # big enough to take a whole window of them.
+        if ReceivedPacket.mss:
+            SendingPacket.mss = min(ReceivedPacket.mss, self.server.max_segment_size)
+            self.server.fit_receive_buffer(utility.window_buffer_size(self.reassembly_window, SendingPacket.mss))
+        checksum_algorithm = utility.negotiate_checksum(ReceivedPacket.checksum_offer, self.server.accepted_checksums)
+        if ReceivedPacket.checksum_offer:
+            SendingPacket.checksum_offer = [checksum_algorithm]
+        SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + 1
+        SendingPacket.window_size = self.advertised_window()
+        self.add_timestamp(SendingPacket)
+        self.send("snd")
+
+        # The SYN and SYN/ACK always use the default checksum, everything after uses the one we agreed on.
+        utility.console(utility.LOG_INFO, "Using the {} checksum.", checksum_algorithm)
+        SendingPacket.checksum_algorithm = checksum_algorithm
+        self.checksum_algorithm = checksum_algorithm
+
+        SendingPacket.sequence_num += 1
+
+    def establish(self):
+        # ----------------------------------------------------------------------------------------------------
+        # CONNECTION IS ESTABLISHED. TALKING WITH CLIENT
+        # For this assignment, we are going to immediately accept any data sent by the client to be stored into
+        # a file. We will only stop writing to the file when the sender asks us to close the connection.
+        # The file is written by a background thread, the window we advertise shrinks if it falls behind.
+        self.state = ESTABLISHED
+        if self.striped_output is not None:
+            self.output_file = utility.FileSink(self.output_path, background=True, offset=self.stripe[1])
+        else:
+            self.output_file = utility.FileSink(self.output_path, background=True)
+            self.output_file.preallocate(self.expected_file_size)
+        # The first byte of data carries the sequence number we acknowledged the SYN with, its offset in the file is 0.
+        self.starting_bias = self.SendingPacket.acknowledge_num
+
+    def receive_established(self, ReceivedPacket):
+        SendingPacket = self.SendingPacket
+        if ReceivedPacket.fin:
+            self.receive_fin(ReceivedPacket)
+        elif len(ReceivedPacket.payload) == 0:
+            # The sender is probing because we told it our window was full, let it know how much room there is now.
+            if ReceivedPacket.timestamp is not None:
+                self.recent_timestamp = ReceivedPacket.timestamp
+            self.send_ack("snd", ReceivedPacket.sequence_num)
+        else:
+            # When we receive the client's sequence number, we are going to see that they have previous sent
+            # (sequence number) amount of data before this packet. We are then going to increment that
+            # sequence number with the number of data received in this current packet and send it back.
+            utility.console(utility.LOG_DEBUG, "Received sequence of, {}", ReceivedPacket.sequence_num)
+
+            # Before we write to the output file, we will need to check if this sequence number received was
+            # dropped. We will check it with the previous packet we sent out. The previous packet we sent out
+            # will tell the client about how we were expecting that packet to arrive.
+            if SendingPacket.acknowledge_num != ReceivedPacket.sequence_num:
+                utility.console(utility.LOG_DEBUG,
+                                "Received packet with SEQ {} but expecting SEQ {}. "
+                                "Retransmit the last packet again\n",
+                                ReceivedPacket.sequence_num, SendingPacket.acknowledge_num, colour=Fore.LIGHTRED_EX)
+
+                # If the segment is ahead of what we are expecting and still inside the sender's window, hold on
+                # to it so the sender only needs to fill in the gap rather than resend everything after it.
+                window_end = SendingPacket.acknowledge_num + self.reassembly_window
+                if SendingPacket.acknowledge_num < ReceivedPacket.sequence_num < window_end and \
+                        ReceivedPacket.sequence_num not in self.reassembly_buffer and \
+                        self.reassembly_buffer_bytes + len(ReceivedPacket.payload) <= self.reassembly_window:
+                    self.output_file.write_at(ReceivedPacket.sequence_num - self.starting_bias, ReceivedPacket.payload)
+                    self.reassembly_buffer[ReceivedPacket.sequence_num] = len(ReceivedPacket.payload)
+                    self.reassembly_buffer_bytes += len(ReceivedPacket.payload)
+                    if self.metrics is not None:
+                        self.metrics.observe("window_occupancy_bytes", self.reassembly_buffer_bytes)
+
+                self.send_ack("snd/DA", ReceivedPacket.sequence_num)
+                self.summary["segments_received"] += 1
+                self.summary["duplicate_ack_sent"] += 1
+            else:
+                self.output_file.write(ReceivedPacket.payload)
+                self.summary["data_received"] += len(ReceivedPacket.payload)
+                self.summary["segments_received"] += 1
+                SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + len(ReceivedPacket.payload)
+
+                # This segment may have filled a gap, every segment after it that is now in order is already in
+                # the file so we just move past it. When the sender resends from a different place than it first sent
+                # from, buffered segments need not start where this one ended. One that starts behind our ACK is
+                # dropped, after moving past whatever part of it lies beyond, or it would hold its bytes out of our
+                # window for good.
+                filled_gap = False
+                while self.reassembly_buffer:
+                    covered = sorted(sequence_num for sequence_num in self.reassembly_buffer
+                                     if sequence_num <= SendingPacket.acknowledge_num)
+                    if not covered:
+                        break
+                    for sequence_num in covered:
+                        buffered_length = self.reassembly_buffer.pop(sequence_num)
+                        self.reassembly_buffer_bytes -= buffered_length
+                        beyond = sequence_num + buffered_length - SendingPacket.acknowledge_num
+                        if beyond > 0:
+                            self.output_file.skip(beyond)
+                            self.summary["data_received"] += beyond
+                            SendingPacket.acknowledge_num += beyond
+                            filled_gap = True
+                if self.metrics is not None:
+                    self.metrics.sample_rate(self.last_heard, self.summary["data_received"])
+
+                # When ACKs are delayed we echo the timestamp of the first segment the ACK covers, so the sender's
+                # round trip times include the wait and its timeout allows for it.
+                if ReceivedPacket.timestamp is not None and not self.ack_pending:
+                    self.recent_timestamp = ReceivedPacket.timestamp
+                self.delay_ack(ReceivedPacket, filled_gap)
+
+            # A segment counts as duplicated the first time it comes again, so the count is right while we run.
+            if ReceivedPacket.sequence_num in self.received_segments:
+                self.received_segments[ReceivedPacket.sequence_num] += 1
+                if self.received_segments[ReceivedPacket.sequence_num] == 2:
+                    self.summary["segments_duplicate"] += 1
+            else:
+                self.received_segments[ReceivedPacket.sequence_num] = 1
+
+    def receive_fin(self, ReceivedPacket):
+        # Received FIN, send the ACK.
+        utility.console(utility.LOG_INFO, "Received FIN packet. Closing connection.")
+        utility.console(utility.LOG_DEBUG, "Received sequence of, {}", ReceivedPacket.sequence_num)
+        SendingPacket = self.SendingPacket
+        SendingPacket.reset_flags()
+        SendingPacket.ack = True
+        # We are adding one byte to the acknowledge number as the FIN flag consumes 1 byte
+        SendingPacket.acknowledge_num = ReceivedPacket.sequence_num + 1
+        self.send("snd")
+
+        # Close the application that needs the TCP connection and wait for it to close
+        self.close_output()
+
+        # Application has shut down, time to send the fin to the client.
+        self.send_fin()
+        self.state = LAST_ACK
+
+    def send_fin(self):
+        SendingPacket = self.SendingPacket
+        SendingPacket.reset_flags()
+        SendingPacket.fin = True
+        self.send("snd")
+        if self._fin_timer is not None:
+            self._fin_timer.cancel()
+        self._fin_timer = self.server.loop.call_later(self.fin_timeout, self.fin_timed_out)
+
+    def fin_timed_out(self):
+        self._fin_timer = None
+        if self.state != LAST_ACK:
+            return
+        if self.fin_retries == 0:
+            # The sender is most likely gone, having missed nothing but our FIN or having sent an ACK we never got.
+            utility.console(utility.LOG_WARNING, "No ACK for our FIN, closing the connection.")
+            self.close()
+            return
+        self.fin_retries -= 1
+        self.fin_timeout *= 2
+        self.send_fin()
+
+    def close_output(self):
+        if self.output_file is not None:
+            self.output_file.close()
+            utility.console(utility.LOG_INFO, "Wrote {} bytes to {} in {} writes.",
+                            self.output_file.size, self.output_path, self.output_file.writes)
+            self.output_file = None
+
+    def close(self):
+        # Also used to give up on a connection, in which case the output file keeps whatever we had.
+        if self.state == CLOSED:
+            return
+        self.close_output()
+        self.cancel_delayed_ack()
+        if self._fin_timer is not None:
+            self._fin_timer.cancel()
+            self._fin_timer = None
+
+        utility.write_receiver_summary(self.log, self.summary)
+        self.log.close()
+        self.state = CLOSED
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.striped_output is not None:
+            self.striped_output.open_sessions -= 1
+        self.server.session_closed(self)
+
+
+class STPServer(asyncio.DatagramProtocol):
+    # Takes any number of senders at once on one socket. Every connection is a ReceiverSession, keyed by the sender's
+    # address, and paths(session_id, address) gives it its (output file, log, trace) paths. on_session_closed is
+    # called with each session once its connection is over, however it ended. The stripes of a striped transfer go
+    # into the output file of whichever of them we heard from first. metrics is a metrics.Registry to export every
+    # connection's metrics through. receive_buffer and send_buffer set the socket's buffer sizes, by default the
+    # receive buffer grows to take the largest window a sender has told us about. With ack_every above 1 in order
+    # segments are acknowledged that many at a time, or ack_delay seconds after the first, rather than one by one.
+    def __init__(self, paths, accepted_checksums=None, receive_window=0, session_timeout=SESSION_TIMEOUT,
+                 trace=False, on_session_closed=None, metrics=None, max_segment_size=utility.MAX_SEGMENT_SIZE,
+                 receive_buffer=0, send_buffer=0, ack_every=1, ack_delay=ACK_DELAY, loop=None):
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.paths = paths
+        # The checksum algorithms we are willing to use if the sender asks for them.
+        if accepted_checksums is None:
+            accepted_checksums = [name for name in utility.CHECKSUM_ALGORITHMS if name != "none"]
+        self.accepted_checksums = accepted_checksums
+        # How many bytes past our cumulative ACK we are prepared to take, 0 to go by the sender's MWS.
+        self.receive_window = receive_window
+        self.session_timeout = session_timeout
+        # The largest segment we take from a sender.
+        self.max_segment_size = min(max_segment_size, utility.MAX_SEGMENT_SIZE)
+        self.receive_buffer = receive_buffer
+        self.send_buffer = send_buffer
+        self.ack_every = ack_every
+        self.ack_delay = ack_delay
+        # The receive buffer size we last asked for ourselves.
+        self.fitted_receive_buffer = 0
+        self.trace = trace
+        self.on_session_closed = on_session_closed
+        self.metrics = metrics
+
+        self.sock = None
+        self.transport = None
+        self.sessions = {}
+        self.sessions_started = 0
+        # The striped transfers under way, keyed by the sender's host and the transfer id.
+        self.striped_outputs = {}
+        self.ReceivedPacket = utility.STPPacket()
+        self._reaper = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.receive_buffer:
+            utility.set_socket_buffer(self.sock, socket.SO_RCVBUF, self.receive_buffer)
+        if self.send_buffer:
+            utility.set_socket_buffer(self.sock, socket.SO_SNDBUF, self.send_buffer)
+        # Wake up now and again to give up on connections that have gone quiet.
+        self._reaper = self.loop.call_later(min(self.session_timeout, 1), self._reap)
+
+    def connection_lost(self, exc):
+        self.close()
+
+    def datagram_received(self, data, address):
+        # Each connection checks its packets with the checksum it agreed on, so we need to know who sent it first. A
+        # SYN always uses the default, so if a sender we know starts over we have to try that too.
+        ReceivedPacket = self.ReceivedPacket
+        session = self.sessions.get(address)
+        ReceivedPacket.checksum_algorithm = \
+            session.checksum_algorithm if session is not None else utility.DEFAULT_CHECKSUM
+        packet_ok = ReceivedPacket.break_raw_data(data)
+        if not packet_ok and session is not None and session.checksum_algorithm != utility.DEFAULT_CHECKSUM:
+            ReceivedPacket.checksum_algorithm = utility.DEFAULT_CHECKSUM
+            packet_ok = ReceivedPacket.break_raw_data(data) and ReceivedPacket.syn
+            if not packet_ok:
+                ReceivedPacket.checksum_algorithm = session.checksum_algorithm
+                ReceivedPacket.break_raw_data(data)
+
+        if not packet_ok:
+            if session is not None:
+                session.receive_corrupted(ReceivedPacket)
+            else:
+                utility.console(utility.LOG_DEBUG, "Received packet was corrupted.")
+            return
+
+        if ReceivedPacket.syn and (session is None or session.state == LAST_ACK):
+            # A new connection. If the sender was closing the last one, that connection is over. A SYN for a
+            # connection still being set up or in the middle of a transfer is an old copy, which the session sorts out.
+            replaced = session
+            self.sessions_started += 1
+            output_path, log_path, trace_path = self.paths(self.sessions_started, address)
+            session = ReceiverSession(self, self.sessions_started, address, output_path, log_path, trace_path)
+            if ReceivedPacket.stripe is not None:
+                key = (address[0], ReceivedPacket.stripe[0])
+                if key not in self.striped_outputs:
+                    self.striped_outputs[key] = StripedOutput(output_path, ReceivedPacket.file_size)
+                session.join_stripes(self.striped_outputs[key], ReceivedPacket.stripe)
+            self.sessions[address] = session
+            if replaced is not None:
+                replaced.close()
+        if session is not None:
+            session.receive(ReceivedPacket)
+
+    def fit_receive_buffer(self, size):
+        # Only asked for when it is more than we asked for before, so the warning if we can not have it is only given
+        # once for each size.
+        if not self.receive_buffer and size > self.fitted_receive_buffer:
+            self.fitted_receive_buffer = size
+            utility.set_socket_buffer(self.sock, socket.SO_RCVBUF, size, grow_only=True)
+
+    def session_closed(self, session):
+        if self.sessions.get(session.address) is session:
+            del self.sessions[session.address]
+        if session.striped_output is not None and session.striped_output.open_sessions == 0:
+            self.striped_outputs.pop((session.address[0], session.stripe[0]), None)
+        if self.on_session_closed is not None:
+            self.on_session_closed(session)
+
+    def _reap(self):
+        # Give up on anyone we have not heard from in a while, their sender is gone.
+        now = self.loop.time()
+        for address, session in list(self.sessions.items()):
+            if now - session.last_heard > self.session_timeout:
+                utility.console(utility.LOG_WARNING, "Connection {} from {} {} timed out.",
+                                session.session_id, address[0], address[1])
+                session.close()
+        self._reaper = self.loop.call_later(min(self.session_timeout, 1), self._reap)
+
+    def close(self):
+        # Stop listening. Connections still going are given up on.
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for session in list(self.sessions.values()):
+            session.close()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+
+async def start_server(host, port, paths, loop=None, reuse_port=False, **kwargs):
+    # Start an STPServer listening on host and port, the keyword arguments are passed on to it. With reuse_port,
+    # servers in several processes can listen on the same port, and the kernel keeps each sender with one of them.
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    # We make the socket ourselves so the sessions can send straight on it.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    server = STPServer(paths, loop=loop, **kwargs)
+    server.sock = sock
+    await create_endpoint(loop, sock, server)
+    return server
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utility  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def quiet_console():
+    # Only warnings get printed, as the command line scripts do with --quiet.
+    level = utility.console_level
+    utility.console_level = utility.LOG_WARNING
+    yield
+    utility.console_level = level
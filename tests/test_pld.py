@@ -0,0 +1,33 @@
+import pytest
+
+import PLDModule
+
+
+def make_pld(seed):
+    pld = PLDModule.PLDModule(seed)
+    pld.probability_drop = 0.3
+    pld.probability_duplicate = 0.1
+    pld.probability_corrupt = 0.1
+    pld.probability_reorder = 0.1
+    pld.probability_delay = 0.1
+    pld.delay_max_delay = 100
+    return pld
+
+
+def decisions(pld, count=3000):
+    # More than one batch, so drawing the next batch is covered too.
+    return [pld.next_decision() for _ in range(count)]
+
+
+def test_same_seed_same_decisions():
+    assert decisions(make_pld(50)) == decisions(make_pld(50))
+    assert decisions(make_pld(50)) != decisions(make_pld(51))
+
+
+@pytest.mark.parametrize("seed", [50, 0, 300, 123456789, -7, 2 ** 70, 3.5, "abc"])
+def test_numpy_decisions_match_pure_python(seed):
+    pytest.importorskip("numpy")
+    with_numpy = make_pld(seed)
+    pure_python = make_pld(seed)
+    pure_python._numpy_random = None
+    assert decisions(with_numpy) == decisions(pure_python)
@@ -0,0 +1,289 @@
+import asyncio
+import os
+import random
+import socket
+
+import pytest
+
+import metrics
+import PLDModule
+import stp
+import utility
+
+
+async def loopback_transfer(directory, data, during=None, server_options=None, **kwargs):
+    # Send data to a server on the loopback interface and wait for the server to finish with the connection. during
+    # is called with the connection once half the data has been acknowledged. server_options are passed on to
+    # start_server and the rest to connect. Returns the server and the sessions it closed, whose output files are
+    # output<session id>.bin in directory.
+    closed = []
+
+    def paths(session_id, address):
+        return tuple(os.path.join(directory, "{}{}.{}".format(name, session_id, extension))
+                     for name, extension in [("output", "bin"), ("Receiver_log", "txt"), ("Receiver_trace", "bin")])
+
+    server = await stp.start_server("127.0.0.1", 0, paths, on_session_closed=closed.append, **(server_options or {}))
+    try:
+        port = server.sock.getsockname()[1]
+        kwargs.setdefault("mws", 5000)
+        kwargs.setdefault("mss", 500)
+        connection = await stp.connect("127.0.0.1", port, log_path=os.path.join(directory, "Sender_log.txt"),
+                                       **kwargs)
+        half = len(data) // 2
+        connection.write(data[:half])
+        await connection._wait_acknowledged(half)
+        if during is not None:
+            await during(connection)
+        connection.write(data[half:])
+        await asyncio.wait_for(connection.close(), 60)
+        for _ in range(600):
+            if closed:
+                break
+            await asyncio.sleep(0.05)
+    finally:
+        server.close()
+    return server, closed
+
+
+def read_output(directory, session_id=1):
+    with open(os.path.join(directory, "output{}.bin".format(session_id)), 'rb') as f:
+        return f.read()
+
+
+def test_duplicate_syn_mid_transfer_is_ignored(tmp_path):
+    data = random.Random(1).getrandbits(8 * 100000).to_bytes(100000, 'little')
+
+    async def send_syn_again(connection):
+        syn = utility.STPPacket()
+        syn.syn = True
+        syn.window_size = connection.max_win_size
+        syn.assemble_stp_header()
+        syn.send(connection.sock, connection.address)
+        await asyncio.sleep(0.1)
+
+    server, closed = asyncio.run(loopback_transfer(str(tmp_path), data, during=send_syn_again))
+    assert server.sessions_started == 1
+    assert len(closed) == 1
+    assert read_output(str(tmp_path)) == data
+
+
+def silent_port():
+    # A socket nobody reads from, so a SYN sent to it is never answered.
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def test_cancelled_connect_stops_sending_syns(tmp_path):
+    log_path = str(tmp_path / "Sender_log.txt")
+    receiver = silent_port()
+
+    async def connect_and_give_up():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(stp.connect("127.0.0.1", receiver.getsockname()[1], mws=5000, mss=500,
+                                               log_path=log_path), 0.3)
+        # Longer than the first SYN timeout.
+        await asyncio.sleep(2)
+
+    try:
+        asyncio.run(connect_and_give_up())
+    finally:
+        receiver.close()
+    with open(log_path) as f:
+        log = f.read()
+    assert log.count("SYN") == 1
+    # The log was closed, which writes the summary.
+    assert "Size of the file" in log
+
+
+def test_connect_gives_up_after_syn_retries(tmp_path, monkeypatch):
+    monkeypatch.setattr(stp, "SYN_RETRIES", 0)
+    receiver = silent_port()
+    try:
+        with pytest.raises(TimeoutError):
+            asyncio.run(stp.connect("127.0.0.1", receiver.getsockname()[1], mws=5000, mss=500,
+                                    log_path=str(tmp_path / "Sender_log.txt")))
+    finally:
+        receiver.close()
+
+
+def make_pld(seed, drop=0.0, duplicate=0.0, corrupt=0.0, reorder=0.0):
+    pld = PLDModule.PLDModule(seed)
+    pld.probability_drop = drop
+    pld.probability_duplicate = duplicate
+    pld.probability_corrupt = corrupt
+    pld.probability_reorder = reorder
+    pld.reorder_max_delay = 3
+    return pld
+
+
+def metric_value(registry, name):
+    for line in registry.render().splitlines():
+        if line.startswith(name + "{"):
+            return float(line.rsplit(" ", 1)[1])
+    raise KeyError(name)
+
+
+def test_summary_metrics_are_live(tmp_path):
+    data = random.Random(2).getrandbits(8 * 100000).to_bytes(100000, 'little')
+    registry = metrics.Registry()
+    scraped = {}
+
+    async def scrape(connection):
+        scraped["file_size"] = metric_value(registry, "stp_sender_file_size")
+        scraped["duplicates"] = metric_value(registry, "stp_receiver_segments_duplicate_total")
+
+    asyncio.run(loopback_transfer(str(tmp_path), data, during=scrape, pld=make_pld(3, duplicate=0.2),
+                                  metrics=registry, server_options={"metrics": registry}))
+    # Only the first half has been written when we look.
+    assert scraped["file_size"] == len(data) // 2
+    assert scraped["duplicates"] > 0
+
+
+def test_segments_behind_the_ack_leave_the_reassembly_buffer(tmp_path):
+    # Go-back-N without SACK can resend from a different place than a segment was first sent from, so an out of order
+    # segment can end up starting behind our cumulative ACK rather than right at it.
+    data = bytes(range(256)) * 4
+    directory = str(tmp_path)
+
+    def paths(session_id, address):
+        return tuple(os.path.join(directory, name) for name in ("output.bin", "Receiver_log.txt", "Receiver_trace.bin"))
+
+    async def send_segments():
+        loop = asyncio.get_running_loop()
+        server = await stp.start_server("127.0.0.1", 0, paths)
+        address = server.sock.getsockname()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        sock.bind(("127.0.0.1", 0))
+        reply = utility.STPPacket()
+        try:
+            async def send(sequence_num, payload=b"", syn=False):
+                packet = utility.STPPacket()
+                packet.syn = syn
+                packet.ack = not syn
+                packet.sequence_num = sequence_num
+                packet.window_size = 5000
+                packet.file_size = len(data)
+                packet.payload = payload
+                packet.assemble_stp_header()
+                packet.send(sock, address)
+                assert reply.break_raw_data(await asyncio.wait_for(loop.sock_recv(sock, 65536), 5))
+                return reply.acknowledge_num
+
+            assert await send(0, syn=True) == 1
+            # 100 to 600 turns up first and is buffered, then 0 to 300 moves the ACK into the middle of it.
+            assert await send(101, data[100:600]) == 1
+            session = server.sessions[sock.getsockname()]
+            assert session.reassembly_buffer_bytes == 500
+            assert await send(1, data[:300]) == 601
+            assert session.reassembly_buffer == {}
+            assert session.reassembly_buffer_bytes == 0
+            assert await send(601, data[600:]) == len(data) + 1
+        finally:
+            sock.close()
+            server.close()
+
+    asyncio.run(send_segments())
+    with open(os.path.join(directory, "output.bin"), 'rb') as f:
+        assert f.read() == data
+
+
+@pytest.mark.parametrize("offered, accepted, expected", [
+    (("adler32", "crc32"), ["crc32", "adler32"], "adler32"),
+    (("none", "internet"), ["internet"], "internet"),
+    (("none",), ["crc32"], utility.DEFAULT_CHECKSUM),
+])
+def test_checksum_negotiation(tmp_path, offered, accepted, expected):
+    data = random.Random(4).getrandbits(8 * 20000).to_bytes(20000, 'little')
+    used = []
+
+    async def record_checksum(connection):
+        used.append(connection.SendingPacket.checksum_algorithm)
+
+    server, closed = asyncio.run(loopback_transfer(str(tmp_path), data, during=record_checksum, checksums=offered,
+                                                   server_options={"accepted_checksums": accepted}))
+    assert used == [expected]
+    assert closed[0].checksum_algorithm == expected
+    assert read_output(str(tmp_path)) == data
+
+
+@pytest.mark.parametrize("sack", [True, False])
+def test_transfer_with_lost_corrupted_and_reordered_segments(tmp_path, sack):
+    data = random.Random(5).getrandbits(8 * 200000).to_bytes(200000, 'little')
+    pld = make_pld(6, drop=0.1, duplicate=0.05, corrupt=0.05, reorder=0.1)
+    server, closed = asyncio.run(loopback_transfer(str(tmp_path), data, pld=pld, sack=sack))
+    assert len(closed) == 1
+    assert read_output(str(tmp_path)) == data
+    assert pld.summary["seg_dropped"] > 0
+    assert pld.summary["seg_corrupted"] > 0
+
+
+def test_sack_blocks_update_the_scoreboard(tmp_path):
+    # Play the receiver ourselves so we can choose what it SACKs.
+    receiver = silent_port()
+    receiver.setblocking(False)
+    packet = utility.STPPacket()
+
+    async def receive(loop):
+        data, address = await asyncio.wait_for(loop.sock_recvfrom(receiver, 65536), 5)
+        assert packet.break_raw_data(data)
+        return address
+
+    async def reply(loop, address, acknowledge_num, sack_blocks=(), syn=False):
+        packet.reset_flags()
+        packet.syn = syn
+        packet.ack = True
+        packet.sack_permitted = syn
+        packet.sack_blocks = list(sack_blocks)
+        packet.sequence_num = 0
+        packet.acknowledge_num = acknowledge_num
+        packet.window_size = 5000
+        packet.payload = b""
+        packet.assemble_stp_header()
+        await loop.sock_sendto(receiver, bytes(packet.raw), address)
+        # Let the sender take it in.
+        await asyncio.sleep(0.05)
+
+    async def send_and_sack():
+        loop = asyncio.get_running_loop()
+        connecting = asyncio.ensure_future(stp.connect("127.0.0.1", receiver.getsockname()[1], mws=5000, mss=500,
+                                                       timestamps=False, log_path=str(tmp_path / "Sender_log.txt")))
+        address = await receive(loop)
+        assert packet.syn and packet.sack_permitted
+        await reply(loop, address, packet.sequence_num + 1, syn=True)
+        connection = await connecting
+        assert connection.sack_enabled
+        try:
+            connection.write(bytes(2000))
+            segments = []
+            while len(segments) < 4:
+                await receive(loop)
+                if len(packet.payload) > 0:
+                    segments.append(packet.sequence_num)
+            assert sorted(connection.scoreboard) == segments
+            assert connection.sacked_segments == set()
+
+            # The first segment went missing, the receiver holds the other three.
+            await reply(loop, address, segments[0], [(segments[1], segments[3] + 500)])
+            assert connection.sacked_segments == set(segments[1:])
+            # A SACK block only marks segments it covers whole.
+            await reply(loop, address, segments[0], [(segments[0] + 1, segments[0] + 400)])
+            assert connection.sacked_segments == set(segments[1:])
+
+            # The cumulative ACK takes segments off the scoreboard along with their SACK marks.
+            await reply(loop, address, segments[2], [(segments[2], segments[3] + 500)])
+            assert sorted(connection.scoreboard) == segments[2:]
+            assert connection.sacked_segments == set(segments[2:])
+            await reply(loop, address, segments[3] + 500)
+            assert connection.scoreboard == {}
+            assert connection.sacked_segments == set()
+        finally:
+            connection.abort()
+        with pytest.raises(ConnectionAbortedError):
+            await connection.close()
+
+    try:
+        asyncio.run(send_and_sack())
+    finally:
+        receiver.close()
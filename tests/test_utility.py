@@ -0,0 +1,104 @@
+import pytest
+
+import utility
+
+
+def round_trip(packet):
+    packet.assemble_stp_header()
+    received = utility.STPPacket()
+    received.checksum_algorithm = packet.checksum_algorithm
+    assert received.break_raw_data(bytes(packet.raw))
+    return received
+
+
+@pytest.mark.parametrize("checksum_algorithm", sorted(utility.CHECKSUM_ALGORITHMS))
+def test_data_packet_round_trip(checksum_algorithm):
+    packet = utility.STPPacket()
+    packet.checksum_algorithm = checksum_algorithm
+    packet.ack = True
+    packet.sequence_num = 2 ** 32 - 1
+    packet.acknowledge_num = 12345
+    packet.window_size = 65536
+    packet.payload = bytes(range(256)) * 2
+    received = round_trip(packet)
+    assert (received.sequence_num, received.acknowledge_num, received.window_size) == (2 ** 32 - 1, 12345, 65536)
+    assert (received.syn, received.ack, received.fin) == (False, True, False)
+    assert bytes(received.payload) == bytes(range(256)) * 2
+
+
+def test_syn_options_round_trip():
+    packet = utility.STPPacket()
+    packet.syn = True
+    packet.mss = 1460
+    packet.sack_permitted = True
+    packet.checksum_offer = ["crc32", "adler32", "none"]
+    packet.file_size = 2 ** 40
+    packet.timestamp = 4000000000
+    packet.timestamp_echo = 7
+    received = round_trip(packet)
+    assert received.syn and not received.ack
+    assert received.mss == 1460
+    assert received.sack_permitted
+    assert received.checksum_offer == ["crc32", "adler32", "none"]
+    assert received.file_size == 2 ** 40
+    assert (received.timestamp, received.timestamp_echo) == (4000000000, 7)
+    assert received.stripe is None
+    assert len(received.payload) == 0
+
+
+def test_sack_blocks_round_trip():
+    packet = utility.STPPacket()
+    packet.ack = True
+    packet.sack_blocks = [(1000 * block, 1000 * block + 500) for block in range(1, utility.MAX_SACK_BLOCKS + 3)]
+    received = round_trip(packet)
+    # Only as many blocks as fit are sent, the first ones being the most important.
+    assert received.sack_blocks == packet.sack_blocks[:utility.MAX_SACK_BLOCKS]
+
+
+def test_options_of_one_packet_do_not_leak_into_the_next():
+    # Both ends decode every packet into the same STPPacket, so options have to be cleared as well as set.
+    packet = utility.STPPacket()
+    packet.syn = True
+    packet.mss = 500
+    packet.sack_permitted = True
+    packet.file_size = 10
+    packet.timestamp = 1
+    packet.assemble_stp_header()
+    received = utility.STPPacket()
+    assert received.break_raw_data(bytes(packet.raw))
+    packet.reset_flags()
+    packet.ack = True
+    packet.assemble_stp_header()
+    assert received.break_raw_data(bytes(packet.raw))
+    assert not received.syn
+    assert (received.mss, received.sack_permitted, received.file_size, received.timestamp) == (0, False, 0, None)
+
+
+def test_stripe_option_round_trip():
+    packet = utility.STPPacket()
+    packet.syn = True
+    packet.stripe = (0xDEADBEEF, 2 ** 40 + 1, 33335, 3)
+    assert round_trip(packet).stripe == (0xDEADBEEF, 2 ** 40 + 1, 33335, 3)
+
+
+@pytest.mark.parametrize("checksum_algorithm", sorted(set(utility.CHECKSUM_ALGORITHMS) - {"none"}))
+def test_corrupted_packet_fails_its_checksum(checksum_algorithm):
+    packet = utility.STPPacket()
+    packet.checksum_algorithm = checksum_algorithm
+    packet.payload = b"hello world"
+    packet.assemble_stp_header()
+    data = bytearray(packet.raw)
+    data[-1] ^= 0x01
+    received = utility.STPPacket()
+    received.checksum_algorithm = checksum_algorithm
+    assert not received.break_raw_data(bytes(data))
+
+
+def test_negotiate_checksum():
+    accepted = ["blake2b", "crc32", "adler32"]
+    # The sender's order of preference wins, not the receiver's.
+    assert utility.negotiate_checksum(["adler32", "crc32"], accepted) == "adler32"
+    assert utility.negotiate_checksum(["none", "crc32"], accepted) == "crc32"
+    # Nothing in common, or nothing offered, falls back to the default.
+    assert utility.negotiate_checksum(["none"], accepted) == utility.DEFAULT_CHECKSUM
+    assert utility.negotiate_checksum([], accepted) == utility.DEFAULT_CHECKSUM
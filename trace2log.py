@@ -0,0 +1,47 @@
+#
+# Converts a binary trace written with --trace back into the text log the sender and receiver normally write.
+#
+#   python trace2log.py Sender_trace.bin [Sender_log.txt]
+#
+# The log is written to standard output if no output file is given.
+#
+import sys
+import utility
+
+
+def convert(trace_path, output_file):
+    utility.create_log_file(output_file)
+    summaries = {}
+    for code, flags, elapsed_ns, sequence_num, data_bytes, acknowledge_num in utility.read_trace(trace_path):
+        if code in utility.TRACE_SUMMARY_KEYS:
+            key = utility.TRACE_SUMMARY_KEYS[code][sequence_num]
+            summaries.setdefault(code, {})[key] = (data_bytes << 32) | acknowledge_num
+        else:
+            output_file.write(utility.format_log_line(utility.TRACE_EVENTS[code], elapsed_ns, flags, sequence_num,
+                                                      data_bytes, acknowledge_num))
+
+    if utility.TRACE_SENDER_SUMMARY in summaries:
+        utility.write_sender_summary(output_file, summaries[utility.TRACE_SENDER_SUMMARY])
+    if utility.TRACE_RECEIVER_SUMMARY in summaries:
+        utility.write_receiver_summary(output_file, summaries[utility.TRACE_RECEIVER_SUMMARY])
+
+
+def main(argv):
+    if len(argv) not in (1, 2):
+        print("Usage: python trace2log.py trace_file [output_file]")
+        return 1
+
+    try:
+        if len(argv) == 2:
+            with open(argv[1], 'w') as output_file:
+                convert(argv[0], output_file)
+        else:
+            convert(argv[0], sys.stdout)
+    except (OSError, ValueError) as error:
+        print("Could not convert {}: {}".format(argv[0], error))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
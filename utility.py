@@ -1,15 +1,66 @@
 #
 # Utility functions are written here.
 #
+import atexit
 import struct
 import hashlib
+import mmap
+import os
+import queue
 import socket
+import sys
+import threading
 import time
+import zlib
 
 DEFAULT_STP_MAX_BYTES = 40 # The maximum amount of data a STP packet can hold.
 DEBUG = False
 
-start_time = 0
+# Options are carried after the fixed 32 byte header as (kind, length, value) triples, much like TCP. The length of the
+# whole option area is stored in the header byte that used to be padding, so packets without options are unchanged.
+STP_HEADER_SIZE = 32
+STP_HEADER = struct.Struct('!4s4sLLLBBBBQ')
+STP_CHECKSUM = struct.Struct('!Q')
+STP_CHECKSUM_OFFSET = 24
+ZERO_CHECKSUM = bytes(STP_CHECKSUM.size)
+MAX_OPTIONS_SIZE = 255
+OPTION_MSS = 2
+OPTION_SACK_PERMITTED = 4
+OPTION_SACK = 5
+OPTION_TIMESTAMP = 8
+OPTION_CHECKSUM = 14
+OPTION_FILE_SIZE = 16
+OPTION_STRIPE = 18
+MAX_SACK_BLOCKS = 8
+
+# The most a UDP datagram over IPv4 can carry, and so the largest segment we can send once the header and the most
+# options a packet can have are taken off.
+UDP_MAX_PAYLOAD = 65507
+MAX_SEGMENT_SIZE = UDP_MAX_PAYLOAD - STP_HEADER_SIZE - MAX_OPTIONS_SIZE
+
+# Datagrams are received into a ring of preallocated buffers and decoded where they land, each big enough for any
+# datagram.
+RECEIVE_BUFFER_SIZE = 65535
+RECEIVE_RING_SIZE = 8
+
+# Roughly what the kernel charges a socket buffer for each datagram on top of its data.
+DATAGRAM_OVERHEAD = 1024
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+# Console output levels. Everything that happens per packet is LOG_DEBUG, so --quiet (LOG_WARNING) keeps the terminal
+# out of the transfer loop entirely.
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_LEVELS = {"debug": LOG_DEBUG, "info": LOG_INFO, "warning": LOG_WARNING}
+CONSOLE_RESET = "\x1b[0m"
+
+# Log lines are queued for a background thread, which writes whatever has piled up in one go.
+LOG_QUEUE_SIZE = 65536
+LOG_BATCH_SIZE = 4096
+
+console_level = LOG_DEBUG
+console_writer = None
 
 sender_log_file_summary = {
     "file_size": 0,
@@ -34,6 +85,17 @@ receiver_log_file_summary = {
     "duplicate_ack_sent": 0
 }
 
+def timestamp_now():
+    # The value of the timestamp option, microseconds on the monotonic clock. It wraps every 71 minutes, which is fine
+    # as we only ever compare it with the timestamp of a packet that is a round trip old.
+    return int(time.monotonic() * 1000000) & 0xFFFFFFFF
+
+
+def timestamp_age(timestamp):
+    # Seconds since timestamp_now returned the given timestamp.
+    return ((timestamp_now() - timestamp) & 0xFFFFFFFF) / 1000000
+
+
 def isstrint(s):
     try:
         int(s)
@@ -42,12 +104,111 @@ def isstrint(s):
         return False
 
 
+def isstrfloat(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def split_arguments(arguments):
+    # Split the command line into the positional arguments and the optional "--name=value" / "--flag" ones, so the
+    # scripts can keep checking the number of positional arguments they need.
+    positional = []
+    options = {}
+    for argument in arguments:
+        if argument.startswith("--"):
+            name, _, value = argument[2:].partition("=")
+            options[name] = value if value else True
+        else:
+            positional.append(argument)
+    return positional, options
+
+
+# ================================================================================
+# CHECKSUMS
+# Each algorithm takes any number of buffers and checksums them as if they were one, so the receiver can skip over the
+# checksum field without copying the packet.
+# ================================================================================
+def checksum_blake2b(*buffers):
+    h = hashlib.blake2b(digest_size=4)
+    for buffer in buffers:
+        h.update(buffer)
+    return int.from_bytes(h.digest(), byteorder='little')
+
+
+def checksum_crc32(*buffers):
+    value = 0
+    for buffer in buffers:
+        value = zlib.crc32(buffer, value)
+    return value
+
+
+def checksum_adler32(*buffers):
+    value = 1
+    for buffer in buffers:
+        value = zlib.adler32(buffer, value)
+    return value
+
+
+def checksum_internet(*buffers):
+    # The RFC 1071 one's complement sum of 16 bit words. As 0x10000 is 1 modulo 0xFFFF, that sum is the big endian
+    # value of the data modulo 0xFFFF, which lets int.from_bytes do the adding for us. Buffers of odd length shift
+    # everything before them by a byte, and odd length data is padded with a zero byte at the end.
+    total = 0
+    length = 0
+    for buffer in buffers:
+        if len(buffer) & 1:
+            total <<= 8
+        total += int.from_bytes(buffer, byteorder='big')
+        length += len(buffer)
+    if length & 1:
+        total <<= 8
+
+    folded = total % 0xFFFF
+    if folded == 0 and total:
+        folded = 0xFFFF
+    return ~folded & 0xFFFF
+
+
+def checksum_none(*buffers):
+    # Only for trusted links such as loopback, corruption will go unnoticed.
+    return 0
+
+
+# The code is what goes on the wire in the checksum option. blake2b is what every connection starts with and is used
+# for the SYN and SYN/ACK, so it is always acceptable.
+CHECKSUM_ALGORITHMS = {
+    "blake2b": (0, checksum_blake2b),
+    "crc32": (1, checksum_crc32),
+    "adler32": (2, checksum_adler32),
+    "internet": (3, checksum_internet),
+    "none": (4, checksum_none),
+}
+CHECKSUM_NAMES = {code: name for name, (code, function) in CHECKSUM_ALGORITHMS.items()}
+DEFAULT_CHECKSUM = "blake2b"
+
+
+def negotiate_checksum(offered, accepted):
+    # The receiver picks the first algorithm the sender offered that it is willing to use.
+    for name in offered:
+        if name in accepted:
+            return name
+    return DEFAULT_CHECKSUM
+
+
 class STPPacket:
     # ================================================================================
     # CONSTRUCTOR
     # ================================================================================
     def __init__(self, stp_max_bytes=DEFAULT_STP_MAX_BYTES, source_address="127.0.0.1", dest_address="127.0.0.1"):
-        # This is where we define the STP header data
+        # This is where we define the STP header data. The addresses are kept in their packed form as well so we only
+        # pay for inet_aton when they change, not on every packet.
+        self._source_address = None
+        self._dest_address = None
+        self._packed_source_address = None
+        self._packed_dest_address = None
         self.source_address = source_address
         self.dest_address = dest_address
         self.sequence_num = 0
@@ -58,83 +219,256 @@ class STPPacket:
         self.fin = False
         self.checksum = 0
 
+        # Header options. SACK permitted is only ever set on the SYN and SYN/ACK, the SACK blocks are a list of
+        # (start, end) sequence ranges the receiver holds past its cumulative acknowledgement.
+        self.sack_permitted = False
+        self.sack_blocks = []
+
+        # The SYN lists the checksum algorithms the sender would like in order of preference, the SYN/ACK carries the
+        # one the receiver picked. checksum_algorithm is what this packet is actually checksummed with.
+        self.checksum_offer = []
+        self._checksum_function = None
+        self.checksum_algorithm = DEFAULT_CHECKSUM
+
+        # The SYN can tell the receiver how big the file is going to be so it can make room for it.
+        self.file_size = 0
+
+        # The largest segment the sender would like to send in the SYN, and the largest the receiver agreed to take in
+        # the SYN/ACK. 0 means the option is absent.
+        self.mss = 0
+
+        # A striped transfer sends one file over several connections at once. Each one's SYN carries (transfer id,
+        # offset of its range in the file, length of the range, number of stripes), so the receiver can put the ranges
+        # back together.
+        self.stripe = None
+
+        # The timestamp option, sent in the SYN if the sender wants to use it and on every packet after that if the
+        # receiver agreed. The receiver echoes the timestamp of the segment that caused each ACK so the sender can
+        # measure the round trip of every segment, retransmissions included. None means the option is absent.
+        self.timestamp = None
+        self.timestamp_echo = 0
+
         # This will hold the data to send. We can only send STP_MAX_BYTES bytes at max
         self.payload = bytearray(0)
 
-        # This is the raw byte data of the header
-        self.raw = None
-
-        self.assemble_format = '!LLLBBBxQ'
+        # After assemble_stp_header, header is a view of the header and options in _buffer, which is reused for the
+        # next packet we assemble, so anything holding on to a packet has to copy it first. The payload is never copied
+        # in behind it, send hands the two to the socket together. raw is only pieced together if someone asks.
+        self.header = None
+        self._raw = None
+        self._buffer = bytearray(STP_HEADER_SIZE + MAX_OPTIONS_SIZE)
+
+    @property
+    def raw(self):
+        if self._raw is None and self.header is not None:
+            self._raw = b"".join((self.header, self.payload))
+        return self._raw
+
+    @raw.setter
+    def raw(self, data):
+        self._raw = data
+
+    @property
+    def checksum_algorithm(self):
+        return self._checksum_algorithm
+
+    @checksum_algorithm.setter
+    def checksum_algorithm(self, name):
+        self._checksum_algorithm = name
+        self._checksum_function = CHECKSUM_ALGORITHMS[name][1]
+
+    @property
+    def source_address(self):
+        if self._source_address is None:
+            self._source_address = socket.inet_ntoa(self._packed_source_address)
+        return self._source_address
+
+    @source_address.setter
+    def source_address(self, address):
+        if address != self._source_address:
+            self._source_address = address
+            self._packed_source_address = socket.inet_aton(address)
+
+    @property
+    def dest_address(self):
+        if self._dest_address is None:
+            self._dest_address = socket.inet_ntoa(self._packed_dest_address)
+        return self._dest_address
+
+    @dest_address.setter
+    def dest_address(self, address):
+        if address != self._dest_address:
+            self._dest_address = address
+            self._packed_dest_address = socket.inet_aton(address)
 
     def reset_flags(self):
         self.syn = False
         self.ack = False
         self.fin = False
 
-    def assemble_stp_header(self):
-        # Assemble all of the information into the byte data but we are keeping the checksum 0 so we can check for
-        # corruption
-        self.raw = socket.inet_aton(self.source_address)
-        self.raw = self.raw + socket.inet_aton(self.dest_address)
+        # Options only ever apply to the packet being built.
+        self.sack_permitted = False
+        self.sack_blocks = []
+        self.checksum_offer = []
+        self.file_size = 0
+        self.mss = 0
+        self.stripe = None
+        self.timestamp = None
+        self.timestamp_echo = 0
+
+    def assemble_options(self):
+        options = b""
+        if self.mss:
+            options += struct.pack('!BBH', OPTION_MSS, 4, self.mss)
+        if self.sack_permitted:
+            options += struct.pack('!BB', OPTION_SACK_PERMITTED, 2)
+        if self.sack_blocks:
+            blocks = self.sack_blocks[:MAX_SACK_BLOCKS]
+            options += struct.pack('!BB', OPTION_SACK, 2 + 8 * len(blocks))
+            for start, end in blocks:
+                options += struct.pack('!LL', start, end)
+        if self.checksum_offer:
+            options += struct.pack('!BB', OPTION_CHECKSUM, 2 + len(self.checksum_offer))
+            options += bytes(CHECKSUM_ALGORITHMS[name][0] for name in self.checksum_offer)
+        if self.file_size:
+            options += struct.pack('!BBQ', OPTION_FILE_SIZE, 10, self.file_size)
+        if self.stripe is not None:
+            options += struct.pack('!BBLQQH', OPTION_STRIPE, 24, *self.stripe)
+        if self.timestamp is not None:
+            options += struct.pack('!BBLL', OPTION_TIMESTAMP, 10, self.timestamp, self.timestamp_echo)
+        return options
+
+    def break_options(self, options):
+        # Returns False if the option area is malformed, which can only really happen if it was corrupted.
+        self.sack_permitted = False
+        self.sack_blocks = []
+        self.checksum_offer = []
+        self.file_size = 0
+        self.mss = 0
+        self.stripe = None
+        self.timestamp = None
+        self.timestamp_echo = 0
+
+        index = 0
+        while index < len(options):
+            if index + 2 > len(options):
+                return False
+            kind = options[index]
+            length = options[index + 1]
+            if length < 2 or index + length > len(options):
+                return False
+            value = options[index + 2:index + length]
+
+            if kind == OPTION_MSS:
+                if len(value) != 2:
+                    return False
+                self.mss = struct.unpack('!H', value)[0]
+            elif kind == OPTION_SACK_PERMITTED:
+                self.sack_permitted = True
+            elif kind == OPTION_SACK:
+                if len(value) % 8 != 0:
+                    return False
+                self.sack_blocks = list(struct.iter_unpack('!LL', value))
+            elif kind == OPTION_CHECKSUM:
+                # Skip any algorithm we do not know about, the other end may be newer than us.
+                self.checksum_offer = [CHECKSUM_NAMES[code] for code in value if code in CHECKSUM_NAMES]
+            elif kind == OPTION_FILE_SIZE:
+                if len(value) != 8:
+                    return False
+                self.file_size = struct.unpack('!Q', value)[0]
+            elif kind == OPTION_STRIPE:
+                if len(value) != 22:
+                    return False
+                self.stripe = struct.unpack('!LQQH', value)
+            elif kind == OPTION_TIMESTAMP:
+                if len(value) != 8:
+                    return False
+                self.timestamp, self.timestamp_echo = struct.unpack('!LL', value)
+
+            index += length
+        return True
 
-        other_raw_data = struct.pack(
-            self.assemble_format,
+    def assemble_stp_header(self):
+        # Assemble the header and options straight into our buffer with the checksum zeroed, checksum them together with
+        # the payload, and then patch just the checksum field in place.
+        options = self.assemble_options()
+        payload_start = STP_HEADER_SIZE + len(options)
+
+        buffer = self._buffer
+        STP_HEADER.pack_into(
+            buffer,
+            0,
+            self._packed_source_address,
+            self._packed_dest_address,
             self.sequence_num,
             self.acknowledge_num,
             self.window_size,
             self.syn,
             self.ack,
             self.fin,
+            len(options),
             0
         )
-        self.raw = self.raw + other_raw_data + self.payload
+        buffer[STP_HEADER_SIZE:payload_start] = options
 
+        self.header = memoryview(buffer)[:payload_start]
+        self._raw = None
         self.calculate_checksum()
 
     def calculate_checksum(self):
-        # Using the blake2b hash library to compute an 8 byte hash as the checksum, we will then reassemble the
-        # header with this checksum
-        h = hashlib.blake2b(digest_size=4)
-        h.update(self.raw)
-        self.checksum = int.from_bytes(h.digest(), byteorder='little')
-
-        self.raw = socket.inet_aton(self.source_address)
-        self.raw = self.raw + socket.inet_aton(self.dest_address)
-        other_raw_data = struct.pack(
-            self.assemble_format,
-            self.sequence_num,
-            self.acknowledge_num,
-            self.window_size,
-            self.syn,
-            self.ack,
-            self.fin,
-            self.checksum
-        )
-        self.raw = self.raw + other_raw_data + self.payload
+        # Compute the checksum over the packet with a zeroed checksum field using whichever algorithm the connection
+        # negotiated, we then write it into the header.
+        self.checksum = self._checksum_function(self.header, self.payload)
+        STP_CHECKSUM.pack_into(self._buffer, STP_CHECKSUM_OFFSET, self.checksum)
+
+    def send(self, sock, address):
+        # Gather the header and payload straight from where they are, where the platform lets us.
+        if HAS_SENDMSG:
+            sock.sendmsg([self.header, self.payload], [], 0, address)
+        else:
+            sock.sendto(self.raw, address)
 
     def break_raw_data(self, data):
-        retrieved_data = struct.unpack(self.assemble_format, data[8:32])
-
-        # We are going to get the information from the data and set this STP packet to contain this information
-        # After wards, we are going to assemble the STP header again, calculate the checksum and compare it to the
-        # checksum we got from the stream.
-        self.source_address = socket.inet_ntoa(data[:4])
-        self.dest_address = socket.inet_ntoa(data[4:8])
-        self.sequence_num = retrieved_data[0]
-        self.acknowledge_num = retrieved_data[1]
-        self.window_size = retrieved_data[2]
-        self.syn = retrieved_data[3]
-        self.ack = retrieved_data[4]
-        self.fin = retrieved_data[5]
-        retrieved_checksum = retrieved_data[6]
-
-        self.payload = data[32:]
-
-        # We are now going to check if the header was broken
-        self.assemble_stp_header()
-
-        if self.checksum != retrieved_checksum:
+        # We are going to get the information from the data and set this STP packet to contain this information.
+        # The checksum is checked straight over the received bytes, with the checksum field swapped for zeroes, so
+        # nothing needs to be assembled again. The addresses are only turned back into strings if someone asks.
+        data = memoryview(data)
+        if len(data) < STP_HEADER_SIZE:
+            return False
+        retrieved_data = STP_HEADER.unpack_from(data)
+
+        self._source_address = None
+        self._dest_address = None
+        self._packed_source_address = retrieved_data[0]
+        self._packed_dest_address = retrieved_data[1]
+        self.sequence_num = retrieved_data[2]
+        self.acknowledge_num = retrieved_data[3]
+        self.window_size = retrieved_data[4]
+        self.syn = retrieved_data[5]
+        self.ack = retrieved_data[6]
+        self.fin = retrieved_data[7]
+        options_length = retrieved_data[8]
+        self.checksum = retrieved_data[9]
+
+        payload_start = STP_HEADER_SIZE + options_length
+        self.payload = data[payload_start:]
+        self.header = data[:payload_start]
+        self._raw = data
+
+        checksum = self._checksum_function(data[:STP_CHECKSUM_OFFSET], ZERO_CHECKSUM, data[STP_HEADER_SIZE:])
+        if checksum != self.checksum or payload_start > len(data):
             return False
+
+        if options_length:
+            return self.break_options(data[STP_HEADER_SIZE:payload_start])
+        self.mss = 0
+        self.sack_permitted = False
+        self.sack_blocks = []
+        self.checksum_offer = []
+        self.file_size = 0
+        self.stripe = None
+        self.timestamp = None
+        self.timestamp_echo = 0
         return True
 
     def load_payload(self, byte_data):
@@ -148,18 +482,332 @@ class STPPacket:
             counter = counter + 1
 
 
-def copy_stp_packet(source, dest):
-    dest.source_address = source.source_address
-    dest.dest_address = source.dest_address
-    dest.acknowledge_num = source.acknowledge_num
-    dest.sequence_num = source.sequence_num
-    dest.window_size = source.window_size
-    dest.syn = source.syn
-    dest.ack = source.ack
-    dest.fin = source.fin
-    dest.checksum = source.checksum
-    dest.payload = source.payload
-    dest.raw = source.raw
+def window_buffer_size(window, mss):
+    # How big a socket buffer has to be to hold a whole window of segments of the given size.
+    segments = -(-window // max(mss, 1))
+    return window + segments * (STP_HEADER_SIZE + DATAGRAM_OVERHEAD)
+
+
+def set_socket_buffer(sock, option, size, grow_only=False):
+    # Set SO_RCVBUF or SO_SNDBUF, and warn if the system would not give us all of it. With grow_only a buffer which
+    # is already big enough is left alone. Returns the size we ended up with.
+    name = "receive" if option == socket.SO_RCVBUF else "send"
+    # Linux doubles whatever it is asked for to leave room for its own bookkeeping, and reports the doubled size.
+    scale = 2 if sys.platform.startswith("linux") else 1
+    if grow_only and sock.getsockopt(socket.SOL_SOCKET, option) // scale >= size:
+        return sock.getsockopt(socket.SOL_SOCKET, option) // scale
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError as error:
+        console(LOG_WARNING, "Could not set the socket {} buffer to {} bytes: {}", name, size, error)
+    granted = sock.getsockopt(socket.SOL_SOCKET, option) // scale
+    if granted < size:
+        console(LOG_WARNING, "Asked for a socket {} buffer of {} bytes, the system limits it to {}.",
+                name, size, granted)
+    return granted
+
+
+class ReceiveRing:
+    # A handful of preallocated buffers which datagrams are received into in turn, rather than allocating a new one
+    # for every datagram. A received packet is a view into one of them, so it is only good until the ring comes back
+    # around, anything that needs to keep the data longer has to copy it.
+    def __init__(self, count=RECEIVE_RING_SIZE, size=RECEIVE_BUFFER_SIZE):
+        self._views = [memoryview(bytearray(size)) for _ in range(count)]
+        self._next = 0
+
+    def receive(self, sock):
+        view = self._views[self._next]
+        self._next = (self._next + 1) % len(self._views)
+        received, address = sock.recvfrom_into(view)
+        return view[:received], address
+
+
+class FileSource:
+    # The file we are sending, memory mapped rather than read in, so we can start sending straight away no matter how
+    # big it is. Segments are handed out as memoryview slices of the map, so they are never copied until a packet is
+    # assembled. Once the receiver has acknowledged a part of the file we tell the kernel we are done with those pages,
+    # which keeps what we hold on to down to roughly the window.
+    #
+    # offset and length pick out just a range of the file, which the offsets given to us are then relative to.
+    RELEASE_CHUNK = 1024 * 1024
+
+    def __init__(self, path, offset=0, length=None):
+        self._file = open(path, 'rb')
+        file_size = os.fstat(self._file.fileno()).st_size
+        offset = min(offset, file_size)
+        self.size = file_size - offset if length is None else min(length, file_size - offset)
+        self._offset = offset
+        self._map = None
+        self._released = 0
+
+        if self.size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)[offset:offset + self.size]
+        else:
+            # You can not map an empty file.
+            self._view = memoryview(b"")
+
+    def __len__(self):
+        return self.size
+
+    def segment(self, offset, length):
+        return self._view[offset:offset + length]
+
+    def release(self, offset):
+        # Everything before offset has been acknowledged. Only whole pages can be dropped, and we do it in large
+        # chunks so this is not a system call on every ACK.
+        if self._map is None or not hasattr(self._map, "madvise"):
+            return
+        offset += self._offset
+        end = offset - offset % mmap.PAGESIZE
+        if end - self._released >= self.RELEASE_CHUNK:
+            self._map.madvise(mmap.MADV_DONTNEED, self._released, end - self._released)
+            self._released = end
+
+    def close(self):
+        self._view.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # A packet is still holding a segment of the file, the map will be closed when it lets go.
+                pass
+        self._file.close()
+
+
+class FileSink:
+    # The file we are receiving into. In order data is gathered into a large buffer which is written out whenever it
+    # reaches the next BUFFER_SIZE boundary of the file, rather than one tiny write per segment. Segments which arrive
+    # out of order are written straight to their place in the file, so they do not need to be held in memory.
+    #
+    # With background set, the writes themselves are done by a thread so a slow disk does not stop us reading the
+    # socket. pending is how many bytes have been handed to the thread but not written yet, and free_space() is how
+    # much more we are willing to take on, which the receiver advertises as its window.
+    #
+    # With offset set we are writing one range of a file that others are writing the rest of, starting offset bytes
+    # in. The file is left as it is when we open it and is not trimmed when we close it.
+    BUFFER_SIZE = 1024 * 1024
+    MAX_PENDING = 4 * 1024 * 1024
+    _STOP = object()
+
+    def __init__(self, path, background=False, offset=None):
+        self._shared = offset is not None
+        self._offset = offset or 0
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        self._fd = os.open(path, flags if self._shared else flags | os.O_TRUNC)
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._buffered = 0
+        self._buffer_offset = 0
+        self.size = 0
+        self.writes = 0
+        self.pending = 0
+
+        self._jobs = None
+        self._error = None
+        if background:
+            self._pending_lock = threading.Lock()
+            self._jobs = queue.Queue()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def preallocate(self, size):
+        # Reserve the space up front when we know how big the file will be, where the platform lets us.
+        if size > 0 and hasattr(os, "posix_fallocate"):
+            try:
+                os.posix_fallocate(self._fd, self._offset, size)
+            except OSError:
+                # Not every file system supports it, in which case the file just grows as we write.
+                pass
+
+    def free_space(self):
+        return max(self.MAX_PENDING - self.pending, 0)
+
+    def _write_at(self, offset, data):
+        data = memoryview(data)
+        end = offset + len(data)
+        offset += self._offset
+        while len(data) > 0:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self._fd, data, offset)
+            else:
+                os.lseek(self._fd, offset, os.SEEK_SET)
+                written = os.write(self._fd, data)
+            self.writes += 1
+            data = data[written:]
+            offset += written
+        self.size = max(self.size, end)
+
+    def _submit(self, offset, data):
+        if self._jobs is None:
+            self._write_at(offset, data)
+            return
+        if self._error is not None:
+            raise self._error
+        with self._pending_lock:
+            self.pending += len(data)
+        self._jobs.put((offset, data))
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is self._STOP:
+                return
+            offset, data = job
+            try:
+                if self._error is None:
+                    self._write_at(offset, data)
+            except OSError as error:
+                # Reported back to the receiver on its next write.
+                self._error = error
+            with self._pending_lock:
+                self.pending -= len(data)
+
+    def write(self, payload):
+        # Append to the in order data.
+        payload = memoryview(payload)
+        while len(payload) > 0:
+            position = self._buffer_offset + self._buffered
+            space = self.BUFFER_SIZE - position % self.BUFFER_SIZE
+            chunk = min(space, len(payload))
+            self._buffer[self._buffered:self._buffered + chunk] = payload[:chunk]
+            self._buffered += chunk
+            payload = payload[chunk:]
+            if chunk == space:
+                self.flush()
+
+    def write_at(self, offset, payload):
+        # Out of order data goes straight to where it belongs. The payload is a view of a receive buffer that is about
+        # to be reused, so the writer thread gets its own copy.
+        self._submit(offset, payload if self._jobs is None else bytes(payload))
+
+    def skip(self, length):
+        # The next length bytes of in order data have already been written by write_at.
+        self.flush()
+        self._buffer_offset += length
+
+    def flush(self):
+        if self._buffered > 0:
+            if self._jobs is None:
+                self._write_at(self._buffer_offset, memoryview(self._buffer)[:self._buffered])
+            else:
+                # Hand the whole buffer over to the writer thread and carry on with a new one.
+                self._submit(self._buffer_offset, memoryview(self._buffer)[:self._buffered])
+                self._buffer = bytearray(self.BUFFER_SIZE)
+            self._buffer_offset += self._buffered
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+        if self._jobs is not None:
+            self._jobs.put(self._STOP)
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        # If we preallocated more than we were sent, trim the file back to what we actually have.
+        if not self._shared:
+            os.ftruncate(self._fd, self.size)
+        os.close(self._fd)
+
+
+class AsyncWriter:
+    # A bounded queue of lines waiting to be written to a stream, drained by a background thread. Callers only pay for
+    # putting a formatter and its arguments on the queue, the formatting and the writing happen on the thread, in
+    # batches of whatever has piled up. If the thread falls too far behind, callers wait for it rather than lose lines.
+    _STOP = object()
+
+    def __init__(self, stream, close_stream=True):
+        self._stream = stream
+        self._close_stream = close_stream
+        self._queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def put(self, formatter, *args):
+        self._queue.put((formatter, args))
+
+    def write(self, text):
+        self._queue.put((None, text))
+
+    def _drain(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < LOG_BATCH_SIZE:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            lines = []
+            for formatter, args in batch:
+                if formatter is self._STOP:
+                    running = False
+                elif formatter is None:
+                    lines.append(args)
+                else:
+                    lines.append(formatter(*args))
+            self._stream.write("".join(lines))
+            self._stream.flush()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put((self._STOP, ()))
+            self._thread.join()
+        if self._close_stream:
+            self._stream.close()
+
+
+class EventLog(AsyncWriter):
+    # Sender_log.txt and Receiver_log.txt. write_log and the summaries write to it as if it were the file.
+    def __init__(self, path):
+        AsyncWriter.__init__(self, open(path, 'w'))
+        create_log_file(self)
+        # Times are measured on the monotonic clock from when the log was opened, or start_clock() was last called.
+        self.start_monotonic = time.monotonic()
+
+    def start_clock(self):
+        self.start_monotonic = time.monotonic()
+
+    def record(self, event, elapsed_ns, flags, sequence_num, data_bytes, acknowledge_num):
+        self.put(format_log_line, event, elapsed_ns, flags, sequence_num, data_bytes, acknowledge_num)
+
+
+def _format_console(message, args, colour):
+    if args:
+        message = message.format(*args)
+    if colour:
+        message = colour + message + CONSOLE_RESET
+    return message + "\n"
+
+
+def parse_console_level(options):
+    # --quiet silences everything that happens per packet, --log-level=debug|info|warning picks the level outright.
+    if "quiet" in options:
+        return LOG_WARNING
+    return LOG_LEVELS[options.get("log-level", "debug")]
+
+
+def start_console(level=LOG_DEBUG, background=True):
+    # From here on console output goes through a background writer, flushed when the program exits. Without
+    # background it is printed straight away, which is what a worker process has to do as it may have been forked
+    # from one with a writer, whose thread does not come along.
+    global console_level, console_writer
+    console_level = level
+    if not background:
+        console_writer = None
+    elif console_writer is None:
+        console_writer = AsyncWriter(sys.stdout, close_stream=False)
+        atexit.register(console_writer.close)
+
+
+def console(level, message, *args, colour=None):
+    # Print a message if it is important enough. The message is only formatted with args if it gets printed.
+    if level < console_level:
+        return
+    if console_writer is None:
+        sys.stdout.write(_format_console(message, args, colour))
+    else:
+        console_writer.put(_format_console, message, args, colour)
 
 
 def create_log_file(output_file):
@@ -167,68 +815,192 @@ def create_log_file(output_file):
                 .format("EVENT", "TIME", "PACK TYPE", "SEQ NUM", "DATA BYTES", "ACK NUM"))
 
 
-def write_log(event, stp_packet, output_file):
-    # Store the current time so the following commands don't distort the time
-    current_time = time.time()
-    packet_type = ""
+# The packet type column for every combination of the SYN (1), ACK (2), FIN (4) and DATA (8) flags.
+PACKET_TYPES = ["/".join(name for bit, name in ((1, "SYN"), (2, "ACK"), (4, "FIN"), (8, "DATA")) if flags & bit)
+                for flags in range(16)]
 
-    if stp_packet.syn:
-        packet_type += "SYN"
 
-    if stp_packet.ack:
-        if len(packet_type) > 0:
-            packet_type += "/"
-        packet_type += "ACK"
+def packet_flags(stp_packet):
+    return (1 if stp_packet.syn else 0) | (2 if stp_packet.ack else 0) | (4 if stp_packet.fin else 0) | \
+           (8 if len(stp_packet.payload) > 0 else 0)
 
-    if stp_packet.fin:
-        if len(packet_type) > 0:
-            packet_type += "/"
-        packet_type += "FIN"
 
-    if len(stp_packet.payload) > 0:
-        if len(packet_type) > 0:
-            packet_type += "/"
-        packet_type += "DATA"
+def format_log_line(event, elapsed_ns, flags, sequence_num, data_bytes, acknowledge_num):
+    return "|{:^9}|{:^10}|{:^13}|{:^9}|{:^12}|{:^9}|\n".format(
+        event, str(elapsed_ns / 1e9)[0:10], PACKET_TYPES[flags], sequence_num, data_bytes, acknowledge_num)
 
-    output_file.write("|{:^9}|{:^10}|{:^13}|{:^9}|{:^12}|{:^9}|\n"
-                .format(event,
-                    str(current_time - start_time)[0:10],
-                    packet_type,
-                    stp_packet.sequence_num,
-                    len(stp_packet.payload),
-                    stp_packet.acknowledge_num
-                )
-            )
 
+def log_fields(stp_packet):
+    # Everything the log needs from a packet, for anything that wants to log a packet after it has let go of it.
+    return packet_flags(stp_packet), stp_packet.sequence_num, len(stp_packet.payload), stp_packet.acknowledge_num
 
-def write_sender_summary(output_file):
-    str_format = "{:60} {:>10}\n"
-    output_file.write("=======================================================================\n")
-    output_file.write(str_format.format("Size of the file (in Bytes)", sender_log_file_summary["file_size"]))
-    output_file.write(str_format.format(
-        "Segments transmitted (including drop & RXT)", sender_log_file_summary["seg_transmitted"]))
-    output_file.write(str_format.format("Number of Segments handled by PLD", sender_log_file_summary["seg_pld_messed"]))
-    output_file.write(str_format.format("Number of Segments dropped", sender_log_file_summary["seg_dropped"]))
-    output_file.write(str_format.format("Number of Segments Corrupted", sender_log_file_summary["seg_corrupted"]))
-    output_file.write(str_format.format("Number of Segments Re-ordered", sender_log_file_summary["seg_reorder"]))
-    output_file.write(str_format.format("Number of Segments Duplicated", sender_log_file_summary["seg_dupped"]))
-    output_file.write(str_format.format("Number of Segments Delayed", sender_log_file_summary["seg_delayed"]))
-    output_file.write(str_format.format(
-        "Number of Retransmissions due to TIMEOUT", sender_log_file_summary["retrans_timeout"]))
-    output_file.write(str_format.format("Number of FAST RETRANSMISSION", sender_log_file_summary["retrans_fast"]))
-    output_file.write(str_format.format("Number of DUP ACKS received", sender_log_file_summary["dup_acks"]))
-    output_file.write("=======================================================================\n")
+
+def write_log(event, stp_packet, output_file):
+    # Everything we need from the packet is taken now, as the packet will be reused as soon as we return.
+    write_log_fields(event, log_fields(stp_packet), output_file)
+
+
+def write_log_fields(event, fields, output_file):
+    # Store the current time so the following commands don't distort the time.
+    now = time.monotonic()
+    elapsed_ns = int((now - getattr(output_file, "start_monotonic", now)) * 1000000000)
+    record = (event, elapsed_ns) + fields
+
+    if isinstance(output_file, (EventLog, BinaryTrace)):
+        output_file.record(*record)
+    else:
+        output_file.write(format_log_line(*record))
+
+
+# ================================================================================
+# BINARY TRACE
+# A compact alternative to the text log. Each event is a fixed width record of (event code, flags, nanoseconds since
+# the start, sequence number, data bytes, acknowledgement number). Records are packed into a block buffer which is
+# zlib compressed and appended to the file whenever it fills up, as [compressed length, record count, data]. The
+# summary is stored as records too, with the counter's index as the sequence number and its value split across the
+# data bytes (the 16 bits above the low 32) and acknowledgement number (the low 32 bits), so a counter can go up to
+# 2**48 - 1. trace2log.py turns a trace back into the text log.
+# ================================================================================
+TRACE_MAGIC = b"STPTRACE\x01"
+TRACE_RECORD = struct.Struct('<BBQLHL')
+TRACE_BLOCK = struct.Struct('<LL')
+TRACE_BLOCK_RECORDS = 8192
+TRACE_EVENTS = ["snd", "rcv", "drop", "snd/RXT", "snd/dup", "snd/RXT/dup", "snd/corr", "snd/RXT/corr", "snd/delay",
+                "rcv/DA", "snd/DA", "rcv/corr"]
+TRACE_EVENT_CODES = {event: code for code, event in enumerate(TRACE_EVENTS)}
+TRACE_SENDER_SUMMARY = 254
+TRACE_RECEIVER_SUMMARY = 255
+TRACE_SUMMARY_KEYS = {
+    TRACE_SENDER_SUMMARY: list(sender_log_file_summary),
+    TRACE_RECEIVER_SUMMARY: list(receiver_log_file_summary),
+}
 
 
-def write_receiver_summary(output_file):
+class BinaryTrace:
+    def __init__(self, path):
+        self._file = open(path, 'wb')
+        self._file.write(TRACE_MAGIC)
+        self._buffer = bytearray(TRACE_RECORD.size * TRACE_BLOCK_RECORDS)
+        self._records = 0
+        # The PLD sends delayed segments from another thread.
+        self._lock = threading.Lock()
+        self.start_monotonic = time.monotonic()
+
+    def start_clock(self):
+        self.start_monotonic = time.monotonic()
+
+    def _append(self, code, flags, elapsed_ns, sequence_num, data_bytes, acknowledge_num):
+        with self._lock:
+            TRACE_RECORD.pack_into(self._buffer, self._records * TRACE_RECORD.size,
+                                   code, flags, elapsed_ns, sequence_num, data_bytes, acknowledge_num)
+            self._records += 1
+            if self._records == TRACE_BLOCK_RECORDS:
+                self._flush()
+
+    def record(self, event, elapsed_ns, flags, sequence_num, data_bytes, acknowledge_num):
+        self._append(TRACE_EVENT_CODES[event], flags, elapsed_ns, sequence_num, data_bytes, acknowledge_num)
+
+    def write_summary(self, kind, summary):
+        for index, key in enumerate(TRACE_SUMMARY_KEYS[kind]):
+            self._append(kind, 0, 0, index, summary[key] >> 32, summary[key] & 0xFFFFFFFF)
+
+    def _flush(self):
+        if self._records > 0:
+            block = zlib.compress(memoryview(self._buffer)[:self._records * TRACE_RECORD.size], 1)
+            self._file.write(TRACE_BLOCK.pack(len(block), self._records))
+            self._file.write(block)
+            self._records = 0
+
+    def close(self):
+        with self._lock:
+            self._flush()
+        self._file.close()
+
+
+def read_trace(path):
+    # Returns every record in the trace as a tuple of (code, flags, elapsed_ns, sequence_num, data_bytes,
+    # acknowledge_num).
+    records = []
+    with open(path, 'rb') as f:
+        if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+            raise ValueError("{} is not an STP trace.".format(path))
+        while True:
+            block_header = f.read(TRACE_BLOCK.size)
+            if len(block_header) < TRACE_BLOCK.size:
+                break
+            length, count = TRACE_BLOCK.unpack(block_header)
+            records.extend(TRACE_RECORD.iter_unpack(zlib.decompress(f.read(length))))
+    return records
+
+
+# The label each summary counter is written under in the text logs, in order.
+SENDER_SUMMARY_LABELS = [
+    ("file_size", "Size of the file (in Bytes)"),
+    ("seg_transmitted", "Segments transmitted (including drop & RXT)"),
+    ("seg_pld_messed", "Number of Segments handled by PLD"),
+    ("seg_dropped", "Number of Segments dropped"),
+    ("seg_corrupted", "Number of Segments Corrupted"),
+    ("seg_reorder", "Number of Segments Re-ordered"),
+    ("seg_dupped", "Number of Segments Duplicated"),
+    ("seg_delayed", "Number of Segments Delayed"),
+    ("retrans_timeout", "Number of Retransmissions due to TIMEOUT"),
+    ("retrans_fast", "Number of FAST RETRANSMISSION"),
+    ("dup_acks", "Number of DUP ACKS received"),
+]
+
+RECEIVER_SUMMARY_LABELS = [
+    ("data_received", "Amount of data received (bytes)"),
+    ("segments_received_total", "Total Segments Received"),
+    ("segments_received", "Data segments received"),
+    ("segments_corrupt", "Data segments with Bit Errors"),
+    ("segments_duplicate", "Duplicate data segments received"),
+    ("duplicate_ack_sent", "Duplicate ACKs sent"),
+]
+
+
+def _write_summary(output_file, labels, summary):
     str_format = "{:60} {:>10}\n"
     output_file.write("=======================================================================\n")
-    output_file.write(str_format.format("Amount of data received (bytes)", receiver_log_file_summary["data_received"]))
-    output_file.write(str_format.format("Total Segments Received",
-                                        receiver_log_file_summary["segments_received_total"]))
-    output_file.write(str_format.format("Data segments received", receiver_log_file_summary["segments_received"]))
-    output_file.write(str_format.format("Data segments with Bit Errors", receiver_log_file_summary["segments_corrupt"]))
-    output_file.write(str_format.format("Duplicate data segments received",
-                                        receiver_log_file_summary["segments_duplicate"]))
-    output_file.write(str_format.format("Duplicate ACKs sent", receiver_log_file_summary["duplicate_ack_sent"]))
+    for key, label in labels:
+        output_file.write(str_format.format(label, summary[key]))
     output_file.write("=======================================================================\n")
+
+
+def write_sender_summary(output_file, summary=None):
+    if summary is None:
+        summary = sender_log_file_summary
+    if isinstance(output_file, BinaryTrace):
+        output_file.write_summary(TRACE_SENDER_SUMMARY, summary)
+        return
+    _write_summary(output_file, SENDER_SUMMARY_LABELS, summary)
+
+
+def write_receiver_summary(output_file, summary=None):
+    if summary is None:
+        summary = receiver_log_file_summary
+    if isinstance(output_file, BinaryTrace):
+        output_file.write_summary(TRACE_RECEIVER_SUMMARY, summary)
+        return
+    _write_summary(output_file, RECEIVER_SUMMARY_LABELS, summary)
+
+
+def read_summary(path):
+    # The summary counters at the end of a log, or of a binary trace, as one dict keyed like sender_log_file_summary
+    # and receiver_log_file_summary. A log that never got its summary gives an empty dict.
+    summary = {}
+    with open(path, 'rb') as f:
+        is_trace = f.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+    if is_trace:
+        for code, flags, elapsed_ns, sequence_num, data_bytes, acknowledge_num in read_trace(path):
+            if code in TRACE_SUMMARY_KEYS:
+                summary[TRACE_SUMMARY_KEYS[code][sequence_num]] = (data_bytes << 32) | acknowledge_num
+        return summary
+
+    keys = {label: key for key, label in SENDER_SUMMARY_LABELS + RECEIVER_SUMMARY_LABELS}
+    with open(path) as f:
+        for line in f:
+            label, _, value = line.rstrip().rpartition(" ")
+            label = label.strip()
+            if label in keys and value.isdigit():
+                summary[keys[label]] = int(value)
+    return summary